@@ -16,21 +16,33 @@
 
 from ..errors import BuildError
 from ..input import RecipeSet, walkPackagePath
+from ..scheduler import Call, JobServer, Resources, Scheduler, Spawn, Wait
 from ..state import BobState
 from ..tty import colorize
-from ..utils import asHexStr, hashDirectory, hashFile, removePath, emptyDirectory
+from ..utils import asHexStr, hashDirectory, GitObjectCache, removePath, emptyDirectory
+from ..watcher import getJournal, startWatcher
 from datetime import datetime
 from glob import glob
 from pipes import quote
 from tempfile import TemporaryFile
 import argparse
+import base64
 import datetime
+import fcntl
+import http.client
+import multiprocessing
 import os
+import queue
 import shutil
+import socket
 import stat
 import subprocess
 import tarfile
-import urllib.request, urllib.error
+import threading
+import time
+import urllib.parse
+import urllib.request
+import zlib
 
 # Output verbosity:
 #    <= -2: package name
@@ -58,9 +70,30 @@ class Bijection(dict):
         del self.__rev[self[key]]
         super().__delitem__(key)
 
-def hashWorkspace(step):
-    return hashDirectory(step.getWorkspacePath(),
-        os.path.join(step.getWorkspacePath(), "..", "cache.bin"))
+def hashWorkspace(step, algorithm="sha1", workers=None):
+    """Hash the workspace of the step with *workers* threads (default: number of CPUs).
+
+    If the watcher of the project is running only the changed directories are
+    looked at. Unmodified files of git checkouts are looked up by their git
+    object id before they are read. Build and package steps only hash the
+    files that are in the hash scope of their recipe.
+    """
+    journal = getJournal(step.getWorkspacePath())
+    objects = None
+    scope = {}
+    if step.isCheckoutStep():
+        if step.getGitDirectories():
+            objects = GitObjectCache(".bob-git-objects.sqlite3", step.getWorkspacePath(),
+                                     step.getGitDirectories(), algorithm)
+    else:
+        scope = step.getPackage().getRecipe().getHashScope(
+            "build" if step.isBuildStep() else "package")
+    ret = hashDirectory(step.getWorkspacePath(),
+        os.path.join(step.getWorkspacePath(), "..", "cache.bin"),
+        workers or multiprocessing.cpu_count(), algorithm, journal, objects,
+        scope.get("include"), scope.get("exclude"))
+    if journal is not None: journal.commit()
+    return ret
 
 class DummyArchive:
     def uploadPackage(self, buildId, path):
@@ -89,7 +122,6 @@ class LocalArchive:
             tar.add(path, arcname=".")
 
     def downloadPackage(self, buildId, path):
-        print(colorize("   DOWNLOAD  {}...".format(path), "32"), end="")
         packageResultId = asHexStr(buildId)
         packageResultPath = os.path.join(self.__basePath, packageResultId[0:2],
                                          packageResultId[2:4])
@@ -100,68 +132,241 @@ class LocalArchive:
             os.makedirs(path)
             with tarfile.open(packageResultFile, "r:gz") as tar:
                 tar.extractall(path)
-            print(colorize("ok", "32"))
+            print(colorize("   DOWNLOAD  {}...ok".format(path), "32"))
             return True
         else:
-            print(colorize("not found", "33"))
+            print(colorize("   DOWNLOAD  {}...".format(path), "32") + colorize("not found", "33"))
             return False
 
 
 class SimpleHttpArchive:
+    """Binary archive on a plain HTTP(S) server.
+
+    All requests share a pool of keep-alive connections. A connection is only
+    used by one thread at a time and is put back into the pool when its
+    response was read completely.
+
+    The proxy is taken from the usual ``http_proxy``/``https_proxy`` and
+    ``no_proxy`` environment variables. HTTPS connections are tunneled through
+    the proxy.
+    """
+
     def __init__(self, spec):
-        self.__url = spec["url"]
+        self.__url = urllib.parse.urlparse(spec["url"])
+        if self.__url.scheme == "http":
+            self.__connectionClass = http.client.HTTPConnection
+        elif self.__url.scheme == "https":
+            self.__connectionClass = http.client.HTTPSConnection
+        else:
+            raise BuildError("Unsupported archive URL scheme: '{}'".format(
+                self.__url.scheme))
+        self.__pool = []
+        self.__lock = threading.Lock()
+
+        self.__proxy = None
+        self.__proxyHeaders = {}
+        proxy = urllib.request.getproxies().get(self.__url.scheme)
+        if proxy and not urllib.request.proxy_bypass(self.__url.netloc):
+            if "://" not in proxy: proxy = "http://" + proxy
+            self.__proxy = urllib.parse.urlparse(proxy)
+            if self.__proxy.username is not None:
+                credentials = "{}:{}".format(
+                    urllib.parse.unquote(self.__proxy.username),
+                    urllib.parse.unquote(self.__proxy.password or ""))
+                self.__proxyHeaders["Proxy-Authorization"] = "Basic " + \
+                    base64.b64encode(credentials.encode("utf8")).decode("ascii")
 
     def _makeUrl(self, buildId):
+        return self.__url.scheme + "://" + self.__url.netloc + self._makePath(buildId)
+
+    def _makePath(self, buildId):
         packageResultId = asHexStr(buildId)
-        return "/".join([self.__url, packageResultId[0:2], packageResultId[2:4],
-            packageResultId[4:] + ".tgz"])
+        return "/".join([self.__url.path.rstrip("/"), packageResultId[0:2],
+            packageResultId[2:4], packageResultId[4:] + ".tgz"])
+
+    def __request(self, method, buildId, body=None, headers={}):
+        """Send a request on a pooled connection.
+
+        Returns the connection and the response. The response must be read
+        completely before the connection is given back by :meth:`__release`.
+        An idle connection that was closed by the server in the meantime is
+        replaced by a new one. A file *body* is sent from its beginning.
+        """
+        while True:
+            with self.__lock:
+                connection = self.__pool.pop() if self.__pool else None
+            reused = connection is not None
+            if not reused: connection = self.__connect()
+            try:
+                if hasattr(body, "seek"): body.seek(0)
+                if (self.__proxy is not None) and (self.__url.scheme == "http"):
+                    # plain HTTP proxies want to see the absolute URL
+                    connection.request(method, self._makeUrl(buildId), body,
+                                       dict(headers, **self.__proxyHeaders))
+                else:
+                    connection.request(method, self._makePath(buildId), body, headers)
+                return (connection, connection.getresponse())
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                if not reused: raise
+
+    def __connect(self):
+        if self.__proxy is None:
+            return self.__connectionClass(self.__url.hostname, self.__url.port)
+        port = self.__proxy.port or (443 if self.__proxy.scheme == "https" else 80)
+        connection = self.__connectionClass(self.__proxy.hostname, port)
+        if self.__url.scheme == "https":
+            connection.set_tunnel(self.__url.hostname, self.__url.port,
+                                  self.__proxyHeaders)
+        return connection
+
+    def __release(self, connection, response):
+        if response.will_close or not response.isclosed():
+            connection.close()
+        else:
+            with self.__lock:
+                self.__pool.append(connection)
 
     def uploadPackage(self, buildId, path):
         url = self._makeUrl(buildId)
 
         # check if already there
         try:
-            try:
-                req = urllib.request.Request(url=url, method='HEAD')
-                f = urllib.request.urlopen(req)
+            (connection, response) = self.__request("HEAD", buildId)
+            response.read()
+            self.__release(connection, response)
+            if response.status == 200:
                 print("   UPLOAD    skipped ({} exists in archive)".format(path))
                 return
-            except urllib.error.HTTPError as e:
-                if e.code != 404:
-                    raise BuildError("Error for HEAD on "+url+": "+e.reason)
+            elif response.status != 404:
+                raise BuildError("Error for HEAD on "+url+": "+response.reason)
 
             print(colorize("   UPLOAD    {}".format(path), "32"))
+            # The archive is sent in blocks from the file
             with TemporaryFile() as tmpFile:
                 with tarfile.open(fileobj=tmpFile, mode="w:gz") as tar:
                     tar.add(path, arcname=".")
-                tmpFile.seek(0)
-                req = urllib.request.Request(url=url, data=tmpFile.read(),
-                                             method='PUT')
-                f = urllib.request.urlopen(req)
-        except urllib.error.URLError as e:
-            raise BuildError("Error uploading package: "+str(e.reason))
+                size = tmpFile.tell()
+                (connection, response) = self.__request("PUT", buildId, tmpFile,
+                    { "Content-Length" : str(size) })
+                response.read()
+                self.__release(connection, response)
+                if response.status < 200 or response.status >= 300:
+                    raise BuildError("Error uploading package: "+response.reason)
+        except (http.client.HTTPException, OSError) as e:
+            raise BuildError("Error uploading package: "+str(e))
 
     def downloadPackage(self, buildId, path):
         ret = False
-        print(colorize("   DOWNLOAD  {}...".format(path), "32"), end="")
-        url = self._makeUrl(buildId)
         try:
-            (localFilename, headers) = urllib.request.urlretrieve(url)
-            removePath(path)
-            os.makedirs(path)
-            with tarfile.open(localFilename, "r:gz", errorlevel=1) as tar:
-                tar.extractall(path)
-            ret = True
-            print(colorize("ok", "32"))
-        except urllib.error.URLError as e:
-            print(colorize(str(e.reason), "33"))
-        except OSError as e:
-            raise BuildError("Error: " + str(e))
-        finally:
-            urllib.request.urlcleanup()
+            # The archive is extracted while it is received
+            (connection, response) = self.__request("GET", buildId)
+            try:
+                if response.status == 200:
+                    removePath(path)
+                    os.makedirs(path)
+                    try:
+                        with tarfile.open(fileobj=response, mode="r|gz", errorlevel=1) as tar:
+                            tar.extractall(path)
+                        response.read()
+                    except (http.client.HTTPException, ConnectionError, socket.timeout):
+                        # do not leave a partial result behind
+                        emptyDirectory(path)
+                        raise
+                    except (OSError, EOFError, tarfile.TarError, zlib.error) as e:
+                        emptyDirectory(path)
+                        if response.isclosed() and response.length:
+                            # the server went away in the middle of the archive
+                            raise http.client.IncompleteRead(b'', response.length)
+                        raise BuildError("Error: " + str(e))
+                    reason = None
+                else:
+                    response.read()
+                    reason = response.reason
+            except:
+                connection.close()
+                raise
+            self.__release(connection, response)
+
+            if reason is None:
+                ret = True
+                print(colorize("   DOWNLOAD  {}...ok".format(path), "32"))
+            else:
+                print(colorize("   DOWNLOAD  {}...".format(path), "32") + colorize(reason, "33"))
+        except (http.client.HTTPException, OSError) as e:
+            print(colorize("   DOWNLOAD  {}...".format(path), "32") + colorize(str(e), "33"))
 
         return ret
 
+class UploadQueue:
+    """Upload packages to the binary archive in the background.
+
+    Up to *jobs* packages are uploaded concurrently by worker threads. At most
+    *size* uploads may be pending so that the build cannot run arbitrarily far
+    ahead of the archive. Each Build-Id is only uploaded once. The lock file
+    descriptor that is passed along with an upload is closed when the upload
+    is done or dropped.
+    """
+
+    def __init__(self, archive, jobs=2, size=16):
+        self.__archive = archive
+        self.__queue = queue.Queue(size)
+        self.__buildIds = set()
+        self.__lock = threading.Lock()
+        self.__errors = []
+        self.__workers = [ threading.Thread(target=self.__worker, daemon=True)
+                           for i in range(jobs) ]
+        for w in self.__workers: w.start()
+
+    def put(self, buildId, path, block=True, lock=None):
+        """Queue the upload of *path* as *buildId*.
+
+        Returns False if the queue is full and *block* is False. The *lock* is
+        kept by the caller in this case.
+        """
+        with self.__lock:
+            if buildId in self.__buildIds:
+                if lock is not None: os.close(lock)
+                return True
+            self.__buildIds.add(buildId)
+        try:
+            self.__queue.put((buildId, path, lock), block)
+        except queue.Full:
+            with self.__lock: self.__buildIds.discard(buildId)
+            return False
+        return True
+
+    def close(self, cancel=False):
+        """Wait for the pending uploads and stop the workers.
+
+        With *cancel* only the running uploads are finished. Returns the list
+        of errors of the failed uploads.
+        """
+        if cancel:
+            try:
+                while True:
+                    (buildId, path, lock) = self.__queue.get_nowait()
+                    if lock is not None: os.close(lock)
+            except queue.Empty:
+                pass
+        for w in self.__workers: self.__queue.put(None)
+        for w in self.__workers: w.join()
+        return self.__errors
+
+    def __worker(self):
+        while True:
+            item = self.__queue.get()
+            if item is None: break
+            (buildId, path, lock) = item
+            try:
+                self.__archive.uploadPackage(buildId, path)
+            except BuildError as e:
+                self.__errors.append(e)
+            except Exception as e:
+                self.__errors.append(BuildError("Error uploading {}: {}".format(path, str(e))))
+            finally:
+                if lock is not None: os.close(lock)
+
 class LocalBuilder:
 
     RUN_TEMPLATE = """#!/bin/bash
@@ -333,8 +538,10 @@ esac
         return fmt
 
     def __init__(self, recipes, verbose, force, skipDeps, buildOnly, preserveEnv,
-                 envWhiteList, bobRoot, cleanBuild):
+                 envWhiteList, bobRoot, cleanBuild, jobs=1, jobServer=0,
+                 checkoutJobs=None, downloadJobs=None, uploadJobs=2):
         self.__recipes = recipes
+        self.__hashAlgorithm = recipes.hashAlgorithm()
         self.__wasRun= Bijection()
         self.__verbose = max(-2, min(2, verbose))
         self.__force = force
@@ -346,9 +553,20 @@ esac
         self.__archive = DummyArchive()
         self.__doDownload = False
         self.__doUpload = False
+        self.__uploads = None
         self.__downloadDepth = 0xffff
         self.__bobRoot = bobRoot
         self.__cleanBuild = cleanBuild
+        self.__hashBuilds = not cleanBuild
+        self.__jobs = jobs
+        self.__checkoutJobs = checkoutJobs or jobs
+        self.__downloadJobs = downloadJobs or jobs
+        self.__uploadJobs = uploadJobs
+        self.__jobServerSize = jobServer
+        self.__jobServer = None
+        self.__locks = {}
+        self.__hashing = set()
+        self.__prefetched = set()
 
     def setArchiveHandler(self, archive):
         self.__doDownload = True
@@ -366,6 +584,33 @@ esac
     def setUploadMode(self, mode):
         self.__doUpload = mode
 
+    def finishUploads(self, cancel=False):
+        """Wait until the queued packages were uploaded.
+
+        Raises a BuildError if an upload failed. With *cancel* the uploads
+        that were not started yet are dropped and failures are only reported
+        as warnings.
+        """
+        if self.__uploads is None: return
+        errors = self.__uploads.close(cancel)
+        self.__uploads = None
+        if not errors:
+            pass
+        elif cancel:
+            for e in errors:
+                print(colorize("WARNING: upload failed: ", "33") + e.slogan)
+        else:
+            raise BuildError("{} package(s) could not be uploaded".format(len(errors)),
+                help="\n".join(e.slogan for e in errors))
+
+    def setHashBuilds(self, enable):
+        """Hash the result of build steps also in release mode.
+
+        Otherwise a rebuilt build step gets a timestamp as result hash and all
+        downstream steps have to be rebuilt too.
+        """
+        self.__hashBuilds = enable or not self.__cleanBuild
+
     def saveBuildState(self):
         # save as plain dict
         BobState().setBuildState(dict(self.__wasRun))
@@ -395,13 +640,38 @@ esac
     def _constructDir(self, step, label):
         created = False
         workDir = step.getWorkspacePath()
+        yield from self._lockDir(step)
         if not os.path.isdir(workDir):
             os.makedirs(workDir)
             created = True
         return (workDir, created)
 
+    def _lockDir(self, step):
+        """Lock the directory of the step against other Bob processes.
+
+        The lock is held until the step is finished and released by
+        :meth:`_unlockDir`. Locking an already locked directory again does
+        nothing.
+        """
+        workDir = step.getWorkspacePath()
+        if workDir in self.__locks: return
+        lockDir = os.path.dirname(workDir)
+        os.makedirs(lockDir, exist_ok=True)
+        fd = os.open(os.path.join(lockDir, "lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        self.__locks[workDir] = fd
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._info("   WAIT      {} (used by other Bob process)".format(workDir))
+            yield Call(fcntl.flock, fd, fcntl.LOCK_EX, cpu=0)
+
+    def _unlockDir(self, step):
+        fd = self.__locks.pop(step.getWorkspacePath(), None)
+        if fd is not None: os.close(fd)
+
     def _runShell(self, step, scriptName):
         workspacePath = step.getWorkspacePath()
+        print(colorize("   {:10}{}".format(scriptName.upper(), workspacePath), "32"))
         if not os.path.isdir(workspacePath): os.makedirs(workspacePath)
 
         # construct environment
@@ -421,6 +691,13 @@ esac
                                      if k in self.__envWhiteList }
         runEnv.update(stepEnv)
 
+        # Let make processes of the step join our jobserver. The descriptors
+        # are inherited through the sandbox.
+        passFds = ()
+        if self.__jobServer is not None:
+            runEnv["MAKEFLAGS"] = self.__jobServer.getMakeFlags()
+            passFds = self.__jobServer.getFds()
+
         # sandbox
         sandbox = []
         sandboxSetup = ""
@@ -481,8 +758,11 @@ esac
             print("set -o errtrace", file=f)
             print("set -o nounset", file=f)
             print("set -o pipefail", file=f)
-            print("trap 'RET=$? ; echo \"\x1b[31;1mStep failed on line ${LINENO}: Exit status ${RET}; Command:\x1b[0;31m ${BASH_COMMAND}\x1b[0m\" >&2 ; exit $RET' ERR", file=f)
-            print("trap 'for i in \"${_BOB_TMP_CLEANUP[@]-}\" ; do rm -f \"$i\" ; done' EXIT", file=f)
+            print("trap 'RET=$? ; echo \"\x1b[31;1mStep failed on line ${LINENO}: "
+                  "Exit status ${RET}; Command:\x1b[0;31m ${BASH_COMMAND}\x1b[0m\" >&2 ; "
+                  "exit $RET' ERR", file=f)
+            print("trap 'for i in \"${_BOB_TMP_CLEANUP[@]-}\" ; do rm -f \"$i\" ; done' "
+                  "EXIT", file=f)
             print("", file=f)
             print("# Special args:", file=f)
             print("declare -A BOB_ALL_PATHS=( {} )".format(" ".join(sorted(
@@ -513,76 +793,261 @@ esac
         elif self.__verbose >= 2:
             cmdLine.append('-vv')
 
-        proc = subprocess.Popen(cmdLine, cwd=step.getWorkspacePath(), env=runEnv)
+        started = time.monotonic()
+        proc = subprocess.Popen(cmdLine, cwd=step.getWorkspacePath(), env=runEnv,
+                                pass_fds=passFds)
         try:
             if proc.wait() != 0:
                 raise BuildError("Build script {} returned with {}"
                                     .format(absRunFile, proc.returncode),
-                                 help="You may resume at this point with '--resume' after fixing the error.")
+                                 help="You may resume at this point with '--resume' "
+                                      "after fixing the error.")
         except KeyboardInterrupt:
             raise BuildError("User aborted while running {}".format(absRunFile),
                              help = "Run again with '--resume' to skip already built packages.")
 
+        return time.monotonic() - started
+
+    def _runStep(self, step, scriptName):
+        if step.isCheckoutStep():
+            # Checkouts are I/O bound and have their own pool of jobs.
+            call = Call(self._runShell, step, scriptName, cpu=0, pool="checkout")
+        else:
+            if step.isBuildStep():
+                resources = step.getPackage().getRecipe().getResources()
+            else:
+                resources = { "cpu" : 1, "memory" : 0 }
+            call = Call(self._runShell, step, scriptName, cpu=resources["cpu"],
+                        memory=resources["memory"], jobToken=True)
+        duration = yield call
+        BobState().setStepDuration(step.getVariantId(), duration)
+
     def _info(self, *args, **kwargs):
         if self.__verbose >= -1:
             print(*args, **kwargs)
 
-    def cook(self, steps, parentPackage, done=set(), depth=0):
-        currentPackage = self.__currentPackage
-        ret = None
-
+    def _showPackage(self, package):
+        if package != self.__currentPackage:
+            self.__currentPackage = package
+            print(">>", colorize("/".join(package.getStack()), "32;1"))
+
+    def cook(self, steps, depth=0):
+        """Build the given steps and everything they depend on.
+
+        Returns a list with the results of the steps, which is the workspace
+        path for package steps.
+        """
+        # Steps that were never run are assumed to take an average time.
+        # Hashing is not accounted for.
+        durations = BobState().getAllStepDurations()
+        average = (sum(durations) / len(durations)) if durations else 1.0
+        weight = lambda key: 0 if isinstance(key, tuple) else \
+            (BobState().getStepDuration(key) or average)
+        admission = [Resources()]
+        if self.__jobServerSize:
+            self.__jobServer = JobServer(self.__jobServerSize)
+            admission.append(self.__jobServer)
+        pools = { "checkout" : self.__checkoutJobs, "hash" : self.__jobs,
+                  "upload" : 1 }
+        if self.__doPrefetch(): pools["download"] = self.__downloadJobs
+        try:
+            return Scheduler(self.__jobs, weight, admission, pools).run(
+                [ self.__task(s, depth) for s in steps ])
+        except KeyboardInterrupt:
+            raise BuildError("User aborted",
+                             help = "Run again with '--resume' to skip already built packages.")
+        finally:
+            if self.__jobServer is not None:
+                self.__jobServer.close()
+                self.__jobServer = None
+
+    def __task(self, step, depth):
+        return (step.getVariantId(), lambda: self._cook(step, depth))
+
+    def __hashTask(self, step, inputHashes=None):
+        return (("hash", step.getVariantId()),
+                lambda: self._hashWorkspace(step, inputHashes))
+
+    def _waitHashes(self, steps):
+        """Wait until the result hashes of *steps* are known.
+
+        Only the steps that are still hashed in the background are waited for.
+        Their hash task was spawned already. The result hash of all other
+        steps is known.
+        """
+        pending = [ self.__hashTask(s) for s in steps
+                    if s.getWorkspacePath() in self.__hashing ]
+        if pending: yield Wait(pending)
+
+    def _spawnHash(self, step, inputHashes=None):
+        """Hash the workspace of *step* in the background.
+
+        The result hash is stored together with the *inputHashes* of the step
+        so that the step is only considered to be done once it was hashed.
+        The workspace stays locked until then.
+        """
+        self.__hashing.add(step.getWorkspacePath())
+        yield Spawn([ self.__hashTask(step, inputHashes) ])
+
+    def _hashWorkspace(self, step, inputHashes):
+        try:
+            path = step.getWorkspacePath()
+            BobState().setResultHash(path, (yield Call(hashWorkspace, step,
+                self.__hashAlgorithm, pool="hash")))
+            if inputHashes is not None: BobState().setInputHashes(path, inputHashes)
+            self._setAlreadyRun(step)
+        finally:
+            self.__hashing.discard(step.getWorkspacePath())
+            self._unlockDir(step)
+
+    def __downloadTask(self, step, buildId):
+        return (("download", step.getVariantId()),
+                lambda: self._downloadPackage(step, buildId))
+
+    def __prefetchTask(self, step, depth):
+        return (("prefetch", step.getVariantId()),
+                lambda: self._prefetch(step, depth))
+
+    def _spawnPrefetch(self, step, depth):
+        """Start to download the dependencies of *step* in the background.
+
+        Only the package steps that would be built next are considered. Their
+        own dependencies are only looked at if they cannot be downloaded.
+        """
+        if not self.__doPrefetch() or self.__skipDeps: return
+        deps = []
+        seen = set()
+        def collect(s):
+            for d in s.getAllDepSteps():
+                if d in seen: continue
+                seen.add(d)
+                if d.isPackageStep():
+                    deps.append(d)
+                elif d.isValid():
+                    collect(d)
+        collect(step)
+        yield Spawn([ self.__prefetchTask(d, depth+1) for d in deps ])
+
+    def _prefetch(self, packageStep, depth):
+        if self._wasAlreadyRun(packageStep): return
+        packageBuildId = None
+        if (depth >= self.__downloadDepth) and not self.__excludeFromArchive(packageStep):
+            # Build-Ids that need a checkout first are not known in advance.
+            if self.__getIndeterministicCheckouts(packageStep): return
+            packageBuildId = yield from self._getBuildId(packageStep, depth)
+        if packageBuildId:
+            self.__prefetched.add(packageStep.getVariantId())
+            (packageDone, packageExecuted) = (yield Wait([
+                self.__downloadTask(packageStep, packageBuildId) ]))[0]
+            if packageDone: return
+        yield from self._spawnPrefetch(packageStep, depth)
+
+    def _downloadPackage(self, packageStep, packageBuildId):
+        """Try to download the result of *packageStep* from the archive.
+
+        Returns a tuple that tells if the package is done and if it was
+        actually downloaded. The workspace stays locked.
+        """
+        prettyPackagePath = yield from self._preparePackageDir(packageStep)
+        oldInputHashes = BobState().getInputHashes(prettyPackagePath)
+        # prune directory if we previously downloaded something different
+        if isinstance(oldInputHashes, bytes) and (oldInputHashes != packageBuildId):
+            print(colorize("   PRUNE     {} (build-id changed)".format(prettyPackagePath), "33"))
+            emptyDirectory(prettyPackagePath)
+            BobState().delInputHashes(prettyPackagePath)
+            BobState().delResultHash(prettyPackagePath)
+
+        # Try to download the package if the directory is currently
+        # empty. If the directory holds a result and was downloaded it
+        # we're done.
+        if BobState().getResultHash(prettyPackagePath) is None:
+            if (yield Call(self.__archive.downloadPackage, packageBuildId,
+                           prettyPackagePath, cpu=0, pool="download")):
+                BobState().setInputHashes(prettyPackagePath, packageBuildId)
+                return (True, True)
+        elif isinstance(oldInputHashes, bytes):
+            self._info("   PACKAGE   skipped (deterministic output in {})"
+                        .format(prettyPackagePath))
+            return (True, False)
+        return (False, False)
+
+    def __doPrefetch(self):
+        return self.__doDownload and (self.__downloadDepth != 0xffff)
+
+    def __excludeFromArchive(self, packageStep):
+        # Exclude packages that provide host tools when not building in a sandbox
+        return packageStep.doesProvideTools() and (packageStep.getSandbox() is None)
+
+    def _upload(self, buildId, path):
+        """Queue the upload of a package.
+
+        If too many uploads are pending the current step waits for a free slot
+        on a worker thread. All other steps go on. The workspace stays locked
+        against other Bob processes until the package was uploaded.
+        """
+        if self.__uploads is None:
+            self.__uploads = UploadQueue(self.__archive, self.__uploadJobs)
+        # The lock is held until all duplicates of its descriptor are closed.
+        lock = self.__locks.get(path)
+        if lock is not None: lock = os.dup(lock)
+        try:
+            if not self.__uploads.put(buildId, path, False, lock):
+                yield Call(self.__uploads.put, buildId, path, True, lock,
+                           cpu=0, pool="upload")
+        except:
+            if lock is not None: os.close(lock)
+            raise
+
+    def _cookSteps(self, steps, parentPackage, depth):
         # skip everything except the current package
         if self.__skipDeps:
             steps = [ s for s in steps if s.getPackage() == parentPackage ]
 
-        for step in reversed(steps):
-            # skip if already processed steps
-            if step in done:
-                continue
+        ret = yield Wait([ self.__task(s, depth) for s in reversed(steps) ])
 
-            # update if package changes
-            if step.getPackage() != self.__currentPackage:
-                self.__currentPackage = step.getPackage()
-                print(">>", colorize("/".join(self.__currentPackage.getStack()), "32;1"))
+        # back to original package
+        self._showPackage(parentPackage)
+        return ret
 
-            # execute step
-            ret = None
-            try:
-                if step.isCheckoutStep():
-                    if step.isValid():
-                        self._cookCheckoutStep(step, done, depth)
-                elif step.isBuildStep():
-                    if step.isValid():
-                        self._cookBuildStep(step, done, depth)
-                else:
-                    assert step.isPackageStep() and step.isValid()
-                    ret = self._cookPackageStep(step, done, depth)
-            except BuildError as e:
-                e.pushFrame(step.getPackage().getName())
-                raise e
+    def _cook(self, step, depth):
+        # update if package changes
+        self._showPackage(step.getPackage())
 
-            # mark as done
-            done.add(step)
+        # execute step
+        ret = None
+        try:
+            if step.isCheckoutStep():
+                if step.isValid():
+                    yield from self._cookCheckoutStep(step, depth)
+            elif step.isBuildStep():
+                if step.isValid():
+                    yield from self._cookBuildStep(step, depth)
+            else:
+                assert step.isPackageStep() and step.isValid()
+                ret = yield from self._cookPackageStep(step, depth)
+        except BuildError as e:
+            for frame in reversed(step.getPackage().getStack()):
+                e.pushFrame(frame)
+            raise e
+        finally:
+            # The workspace is unlocked by the background hash task
+            if step.getWorkspacePath() not in self.__hashing:
+                self._unlockDir(step)
 
-        # back to original package
-        if currentPackage != self.__currentPackage:
-            self.__currentPackage = currentPackage
-            if currentPackage:
-                print(">>", colorize("/".join(self.__currentPackage.getStack()), "32;1"))
         return ret
 
-    def _cookCheckoutStep(self, checkoutStep, done, depth):
+    def _cookCheckoutStep(self, checkoutStep, depth):
         checkoutDigest = checkoutStep.getVariantId()
         if self._wasAlreadyRun(checkoutStep):
             prettySrcPath = self._getAlreadyRun(checkoutStep)
             self._info("   CHECKOUT  skipped (reuse {})".format(prettySrcPath))
         else:
             # depth first
-            self.cook(checkoutStep.getAllDepSteps(), checkoutStep.getPackage(),
-                      done, depth+1)
+            yield from self._cookSteps(checkoutStep.getAllDepSteps(),
+                                       checkoutStep.getPackage(), depth+1)
 
             # get directory into shape
-            (prettySrcPath, created) = self._constructDir(checkoutStep, "src")
+            (prettySrcPath, created) = yield from self._constructDir(checkoutStep, "src")
             oldCheckoutState = BobState().getDirectoryState(prettySrcPath, {})
             if created:
                 # invalidate result if folder was created
@@ -601,8 +1066,10 @@ esac
                 for (scmDir, scmDigest) in oldCheckoutState.copy().items():
                     if (scmDir is not None) and (scmDigest != checkoutState.get(scmDir)):
                         scmPath = os.path.normpath(os.path.join(prettySrcPath, scmDir))
-                        atticName = datetime.datetime.now().isoformat()+"_"+os.path.basename(scmPath)
-                        print(colorize("   ATTIC     {} (move to ../attic/{})".format(scmPath, atticName), "33"))
+                        atticName = (datetime.datetime.now().isoformat() + "_" +
+                                     os.path.basename(scmPath))
+                        print(colorize("   ATTIC     {} (move to ../attic/{})"
+                                       .format(scmPath, atticName), "33"))
                         atticPath = os.path.join(prettySrcPath, "..", "attic")
                         if not os.path.isdir(atticPath):
                             os.makedirs(atticPath)
@@ -610,8 +1077,7 @@ esac
                         del oldCheckoutState[scmDir]
                         BobState().setDirectoryState(prettySrcPath, oldCheckoutState)
 
-                print(colorize("   CHECKOUT  {}".format(prettySrcPath), "32"))
-                self._runShell(checkoutStep, "checkout")
+                yield from self._runStep(checkoutStep, "checkout")
 
                 # reflect new checkout state
                 BobState().setDirectoryState(prettySrcPath, checkoutState)
@@ -620,25 +1086,26 @@ esac
 
             # We always have to rehash the directory as the user might have
             # changed the source code manually.
-            BobState().setResultHash(prettySrcPath, hashWorkspace(checkoutStep))
-            self._setAlreadyRun(checkoutStep)
+            yield from self._spawnHash(checkoutStep)
 
-    def _cookBuildStep(self, buildStep, done, depth):
+    def _cookBuildStep(self, buildStep, depth):
         buildDigest = buildStep.getVariantId()
         if self._wasAlreadyRun(buildStep):
             prettyBuildPath = self._getAlreadyRun(buildStep)
             self._info("   BUILD     skipped (reuse {})".format(prettyBuildPath))
         else:
             # depth first
-            self.cook(buildStep.getAllDepSteps(), buildStep.getPackage(), done, depth+1)
+            yield from self._cookSteps(buildStep.getAllDepSteps(), buildStep.getPackage(),
+                                       depth+1)
 
             # get directory into shape
-            (prettyBuildPath, created) = self._constructDir(buildStep, "build")
+            (prettyBuildPath, created) = yield from self._constructDir(buildStep, "build")
             oldBuildDigest = BobState().getDirectoryState(prettyBuildPath)
             if created or (buildDigest != oldBuildDigest):
                 if (oldBuildDigest is not None) and (buildDigest != oldBuildDigest):
                     # build something different -> prune workspace
-                    print(colorize("   PRUNE     {} (recipe changed)".format(prettyBuildPath), "33"))
+                    print(colorize("   PRUNE     {} (recipe changed)".format(prettyBuildPath),
+                                   "33"))
                     emptyDirectory(prettyBuildPath)
                 # invalidate build step
                 BobState().delInputHashes(prettyBuildPath)
@@ -648,120 +1115,148 @@ esac
                 BobState().setDirectoryState(prettyBuildPath, buildDigest)
 
             # run build if input has changed
+            yield from self._waitHashes(buildStep.getArguments())
             buildInputHashes = [ BobState().getResultHash(i.getWorkspacePath())
                 for i in buildStep.getArguments() if i.isValid() ]
-            if (not self.__force) and (BobState().getInputHashes(prettyBuildPath) == buildInputHashes):
+            if (not self.__force) and \
+               (BobState().getInputHashes(prettyBuildPath) == buildInputHashes):
                 self._info("   BUILD     skipped (unchanged input for {})".format(prettyBuildPath))
                 # We always rehash the directory in development mode as the
                 # user might have compiled the package manually.
                 if not self.__cleanBuild:
-                    BobState().setResultHash(prettyBuildPath, hashWorkspace(buildStep))
+                    yield from self._spawnHash(buildStep)
+                else:
+                    self._setAlreadyRun(buildStep)
             else:
-                print(colorize("   BUILD     {}".format(prettyBuildPath), "32"))
-                if self.__cleanBuild: emptyDirectory(prettyBuildPath)
-                self._runShell(buildStep, "build")
-                # Use timestamp in release mode and only hash in development mode
-                BobState().setResultHash(prettyBuildPath,
-                                         datetime.datetime.utcnow()
-                                             if self.__cleanBuild
-                                             else hashWorkspace(buildStep))
-                BobState().setInputHashes(prettyBuildPath, buildInputHashes)
-            self._setAlreadyRun(buildStep)
-
-    def _cookPackageStep(self, packageStep, done, depth):
+                if self.__cleanBuild:
+                    # The old result is gone. Never take it for the new one
+                    # if the build fails.
+                    BobState().delInputHashes(prettyBuildPath)
+                    emptyDirectory(prettyBuildPath)
+                yield from self._runStep(buildStep, "build")
+                # Use timestamp in release mode unless the result should be
+                # hashed. An unchanged hash avoids rebuilding downstream steps.
+                if self.__hashBuilds:
+                    yield from self._spawnHash(buildStep, buildInputHashes)
+                else:
+                    BobState().setResultHash(prettyBuildPath, datetime.datetime.utcnow())
+                    BobState().setInputHashes(prettyBuildPath, buildInputHashes)
+                    self._setAlreadyRun(buildStep)
+
+    def _preparePackageDir(self, packageStep):
         packageDigest = packageStep.getVariantId()
+        (prettyPackagePath, created) = yield from self._constructDir(packageStep, "dist")
+        oldPackageDigest = BobState().getDirectoryState(prettyPackagePath)
+        if created or (packageDigest != oldPackageDigest):
+            if (oldPackageDigest is not None) and (packageDigest != oldPackageDigest):
+                # package something different -> prune workspace
+                print(colorize("   PRUNE     {} (recipe changed)".format(prettyPackagePath), "33"))
+                emptyDirectory(prettyPackagePath)
+            # invalidate result if folder was created
+            BobState().delInputHashes(prettyPackagePath)
+            BobState().delResultHash(prettyPackagePath)
+
+        if packageDigest != oldPackageDigest:
+            BobState().setDirectoryState(prettyPackagePath, packageDigest)
+
+        return prettyPackagePath
+
+    def _cookPackageStep(self, packageStep, depth):
         if self._wasAlreadyRun(packageStep):
             prettyPackagePath = self._getAlreadyRun(packageStep)
             self._info("   PACKAGE   skipped (reuse {})".format(prettyPackagePath))
         else:
             # get directory into shape
-            (prettyPackagePath, created) = self._constructDir(packageStep, "dist")
-            oldPackageDigest = BobState().getDirectoryState(prettyPackagePath)
-            if created or (packageDigest != oldPackageDigest):
-                if (oldPackageDigest is not None) and (packageDigest != oldPackageDigest):
-                    # package something different -> prune workspace
-                    print(colorize("   PRUNE     {} (recipe changed)".format(prettyPackagePath), "33"))
-                    emptyDirectory(prettyPackagePath)
-                # invalidate result if folder was created
-                BobState().delInputHashes(prettyPackagePath)
-                BobState().delResultHash(prettyPackagePath)
-
-            if packageDigest != oldPackageDigest:
-                BobState().setDirectoryState(prettyPackagePath, packageDigest)
+            prettyPackagePath = yield from self._preparePackageDir(packageStep)
 
             # Can we just download the result? If we download a package the
             # Build-Id is stored as input hash. In this case we have to make
             # sure that the Build-Id is still the same. If the input hash is
             # not a bytes object we have apparently not downloaded the result.
             # Dont' mess with it and fall back to regular build machinery.
+            # A result that was already prefetched is always taken.
             packageDone = False
             packageExecuted = False
-            if packageStep.doesProvideTools() and (packageStep.getSandbox() is None):
-                # Exclude packages that provide host tools when not building in a sandbox
+            if self.__excludeFromArchive(packageStep):
                 packageBuildId = None
+            elif self.__doDownload or self.__doUpload:
+                packageBuildId = yield from self._getBuildId(packageStep, depth)
             else:
-                packageBuildId = self._getBuildId(packageStep, done, depth) \
-                    if (self.__doDownload or self.__doUpload) else None
-            if packageBuildId and (depth >= self.__downloadDepth):
-                oldInputHashes = BobState().getInputHashes(prettyPackagePath)
-                # prune directory if we previously downloaded something different
-                if isinstance(oldInputHashes, bytes) and (oldInputHashes != packageBuildId):
-                    print(colorize("   PRUNE     {} (build-id changed)".format(prettyPackagePath), "33"))
-                    emptyDirectory(prettyPackagePath)
-                    BobState().delInputHashes(prettyPackagePath)
-                    BobState().delResultHash(prettyPackagePath)
-
-                # Try to download the package if the directory is currently
-                # empty. If the directory holds a result and was downloaded it
-                # we're done.
-                if BobState().getResultHash(prettyPackagePath) is None:
-                    if self.__archive.downloadPackage(packageBuildId, prettyPackagePath):
-                        BobState().setInputHashes(prettyPackagePath, packageBuildId)
-                        packageDone = True
-                        packageExecuted = True
-                elif isinstance(oldInputHashes, bytes):
-                    self._info("   PACKAGE   skipped (deterministic output in {})".format(prettyPackagePath))
-                    packageDone = True
+                packageBuildId = None
+            if packageBuildId and ((depth >= self.__downloadDepth) or
+                                   (packageStep.getVariantId() in self.__prefetched)):
+                (packageDone, packageExecuted) = (yield Wait([
+                    self.__downloadTask(packageStep, packageBuildId) ]))[0]
 
             # package it if needed
             if not packageDone:
                 # depth first
-                self.cook(packageStep.getAllDepSteps(), packageStep.getPackage(), done, depth+1)
+                yield from self._spawnPrefetch(packageStep, depth)
+                yield from self._cookSteps(packageStep.getAllDepSteps(),
+                                           packageStep.getPackage(), depth+1)
 
+                yield from self._waitHashes(packageStep.getArguments())
                 packageInputHashes = [ BobState().getResultHash(i.getWorkspacePath())
                     for i in packageStep.getArguments() if i.isValid() ]
-                if (not self.__force) and (BobState().getInputHashes(prettyPackagePath) == packageInputHashes):
-                    self._info("   PACKAGE   skipped (unchanged input for {})".format(prettyPackagePath))
+                if (not self.__force) and \
+                   (BobState().getInputHashes(prettyPackagePath) == packageInputHashes):
+                    self._info("   PACKAGE   skipped (unchanged input for {})"
+                                .format(prettyPackagePath))
                 else:
-                    print(colorize("   PACKAGE   {}".format(prettyPackagePath), "32"))
+                    # The new input hashes are only recorded after hashing.
+                    BobState().delInputHashes(prettyPackagePath)
                     emptyDirectory(prettyPackagePath)
-                    self._runShell(packageStep, "package")
+                    yield from self._runStep(packageStep, "package")
                     packageExecuted = True
                     if packageBuildId and self.__doUpload:
-                        self.__archive.uploadPackage(packageBuildId, prettyPackagePath)
+                        yield from self._upload(packageBuildId, prettyPackagePath)
             else:
                 # do not change input hashes
                 packageInputHashes = BobState().getInputHashes(prettyPackagePath)
 
             # Rehash directory if content was changed
             if packageExecuted:
-                BobState().setResultHash(prettyPackagePath, hashWorkspace(packageStep))
-                BobState().setInputHashes(prettyPackagePath, packageInputHashes)
-            self._setAlreadyRun(packageStep)
+                yield from self._spawnHash(packageStep, packageInputHashes)
+            else:
+                self._setAlreadyRun(packageStep)
 
         return prettyPackagePath
 
-    def _getBuildId(self, step, done, depth):
-        if step.isCheckoutStep():
-            bid = step.getBuildId()
-            if bid is None:
-                # do checkout
-                self.cook([step], step.getPackage(), done, depth)
-                # return directory hash
-                bid = BobState().getResultHash(step.getWorkspacePath())
+    def __getIndeterministicCheckouts(self, step):
+        # The Build-Id of indeterministic checkouts is the hash of their
+        # result. These have to be checked out first.
+        checkouts = []
+        seen = set()
+        def collect(s):
+            if s in seen: return b''
+            seen.add(s)
+            if s.isCheckoutStep():
+                if s.getBuildId() is None: checkouts.append(s)
+            else:
+                s.getDigest(collect, True)
+            return b''
+        step.getDigest(collect, True)
+        return checkouts
+
+    def _getBuildId(self, step, depth):
+        checkouts = self.__getIndeterministicCheckouts(step)
+        if checkouts:
+            yield Wait([ self.__task(s, depth) for s in checkouts ])
+            yield from self._waitHashes(checkouts)
+            self._showPackage(step.getPackage())
+
+        buildIds = {}
+        def calculate(s):
+            if s in buildIds: return buildIds[s]
+            if s.isCheckoutStep():
+                bid = s.getBuildId()
+                if bid is None:
+                    bid = BobState().getResultHash(s.getWorkspacePath())
+            else:
+                bid = s.getDigest(calculate, True)
+            buildIds[s] = bid
             return bid
-        else:
-            return step.getDigest(lambda s: self._getBuildId(s, done, depth+1), True)
+        return step.getDigest(calculate, True)
 
 
 def touch(packages):
@@ -785,6 +1280,22 @@ def commonBuildDevelop(parser, argv, bobRoot, develop):
         help="Don't checkout, just build and package")
     parser.add_argument('--resume', default=False, action='store_true',
         help="Resume build where it was previously interrupted")
+    parser.add_argument('-j', '--jobs', metavar="N", type=int, nargs='?',
+        default=1, const=multiprocessing.cpu_count(),
+        help="Number of steps that are run in parallel (default: 1, without N: number of CPUs)")
+    parser.add_argument('--jobserver', metavar="N", type=int, nargs='?',
+        default=0, const=multiprocessing.cpu_count(),
+        help="Share N make jobs between all steps (without N: number of CPUs)")
+    parser.add_argument('--checkout-jobs', metavar="N", type=int,
+        help="Number of checkout steps that are run in parallel (default: same as --jobs)")
+    parser.add_argument('--download-jobs', metavar="N", type=int,
+        help="Number of packages that are downloaded in parallel (default: same as --jobs)")
+    parser.add_argument('--upload-jobs', metavar="N", type=int, default=2,
+        help="Number of packages that are uploaded in parallel (default: 2)")
+    parser.add_argument('--watch', default=False, action='store_true',
+        help="Start a watcher that tracks changes of the workspaces")
+    parser.add_argument('--hash-builds', default=False, action='store_true',
+        help="Hash build results in release mode to skip unchanged downstream steps")
     parser.add_argument('-q', '--quiet', default=0, action='count',
         help="Decrease verbosity (may be specified multiple times)")
     parser.add_argument('-v', '--verbose', default=0, action='count',
@@ -839,10 +1350,24 @@ def commonBuildDevelop(parser, argv, bobRoot, develop):
 
     if (len(args.packages) > 1) and args.destination:
         raise BuildError("Destination may only be specified when building a single package")
+    if args.jobs < 1:
+        parser.error("Number of jobs must be at least 1")
+    if args.jobserver < 0:
+        parser.error("Number of jobserver jobs must not be negative")
+    if (args.checkout_jobs is not None) and (args.checkout_jobs < 1):
+        parser.error("Number of checkout jobs must be at least 1")
+    if (args.download_jobs is not None) and (args.download_jobs < 1):
+        parser.error("Number of download jobs must be at least 1")
+    if args.upload_jobs < 1:
+        parser.error("Number of upload jobs must be at least 1")
 
     builder = LocalBuilder(recipes, args.verbose - args.quiet, args.force,
                            args.no_deps, args.build_only, args.preserve_env,
-                           envWhiteList, bobRoot, cleanBuild)
+                           envWhiteList, bobRoot, cleanBuild, args.jobs,
+                           args.jobserver, args.checkout_jobs, args.download_jobs,
+                           args.upload_jobs)
+    if args.watch and not startWatcher():
+        print(colorize("WARNING: could not start workspace watcher", "33"))
 
     archiveSpec = recipes.archiveSpec()
     archiveBackend = archiveSpec.get("backend", "none")
@@ -853,16 +1378,21 @@ def commonBuildDevelop(parser, argv, bobRoot, develop):
     elif archiveBackend != "none":
         raise BuildError("Invalid archive backend: "+archiveBackend)
     builder.setUploadMode(args.upload)
+    builder.setHashBuilds(args.hash_builds)
     builder.setDownloadMode(args.download)
     if args.resume: builder.loadBuildState()
 
+    packages = [ walkPackagePath(rootPackages, p) for p in args.packages ]
     try:
-        for p in args.packages:
-            package = walkPackagePath(rootPackages, p)
-            prettyResultPath = builder.cook([package.getPackageStep()], package)
-            print("Build result is in", prettyResultPath)
+        results = builder.cook([ p.getPackageStep() for p in packages ])
+    except BaseException:
+        builder.finishUploads(True)
+        raise
     finally:
         builder.saveBuildState()
+    builder.finishUploads()
+    for prettyResultPath in results:
+        print("Build result is in", prettyResultPath)
 
     # copy build result if requested
     if args.destination:
@@ -871,30 +1401,34 @@ def commonBuildDevelop(parser, argv, bobRoot, develop):
         shutil.copytree(prettyResultPath, args.destination, symlinks=True)
 
 def doBuild(argv, bobRoot):
-    parser = argparse.ArgumentParser(prog="bob build", description='Build packages in release mode.')
+    parser = argparse.ArgumentParser(prog="bob build",
+                                     description='Build packages in release mode.')
     commonBuildDevelop(parser, argv, bobRoot, False)
 
 def doDevelop(argv, bobRoot):
-    parser = argparse.ArgumentParser(prog="bob dev", description='Build packages in development mode.')
+    parser = argparse.ArgumentParser(prog="bob dev",
+                                     description='Build packages in development mode.')
     commonBuildDevelop(parser, argv, bobRoot, True)
 
 ### Clean #############################
 
-def collectPaths(package):
-    paths = set()
-    checkoutStep = package.getCheckoutStep()
-    if checkoutStep.isValid(): paths.add(checkoutStep.getWorkspacePath())
-    buildStep = package.getBuildStep()
-    if buildStep.isValid(): paths.add(buildStep.getWorkspacePath())
-    paths.add(package.getPackageStep().getWorkspacePath())
+def collectSteps(package, steps):
+    packageStep = package.getPackageStep()
+    if packageStep in steps: return
+    steps.add(packageStep)
+    for step in [package.getCheckoutStep(), package.getBuildStep()]:
+        if step.isValid(): steps.add(step)
     for d in package.getDirectDepSteps():
-        paths |= collectPaths(d.getPackage())
-    return paths
+        collectSteps(d.getPackage(), steps)
 
 def doClean(argv, bobRoot):
     parser = argparse.ArgumentParser(prog="bob clean", description='Clean unused directories.')
     parser.add_argument('--dry-run', default=False, action='store_true',
         help="Don't delete, just print what would be deleted")
+    parser.add_argument('--state', default=False, action='store_true',
+        help="Drop stale entries from the state too")
+    parser.add_argument('--keep-durations', metavar="DAYS", type=int, default=30,
+        help="Keep step durations that were recorded in the last DAYS days (default: 30)")
     parser.add_argument('-v', '--verbose', default=False, action='store_true',
         help="Print what is done")
     args = parser.parse_args(argv)
@@ -908,24 +1442,45 @@ def doClean(argv, bobRoot):
     nameFormatter = LocalBuilder.makeRunnable(nameFormatter)
 
     # collect all used paths (with and without sandboxing)
-    usedPaths = set()
+    usedSteps = set()
     rootPackages = recipes.generatePackages(nameFormatter,
                                             sandboxEnabled=True).values()
     for root in rootPackages:
-        usedPaths |= collectPaths(root)
+        collectSteps(root, usedSteps)
     rootPackages = recipes.generatePackages(nameFormatter,
                                             sandboxEnabled=False).values()
     for root in rootPackages:
-        usedPaths |= collectPaths(root)
+        collectSteps(root, usedSteps)
+    usedPaths = set(os.path.dirname(s.getWorkspacePath()) for s in usedSteps)
 
     # get all known existing paths
     allPaths = BobState().getAllNameDirectores()
     allPaths = set([ d for d in allPaths if os.path.exists(d) ])
 
     # delete unused directories
-    for d in allPaths - usedPaths:
+    unusedPaths = allPaths - usedPaths
+    for d in unusedPaths:
         if args.verbose or args.dry_run:
             print("rm", d)
         if not args.dry_run:
             removePath(d)
 
+    # drop state of directories that are gone and old step durations
+    if args.state:
+        def keepPath(path):
+            if (path in unusedPaths) or (os.path.dirname(path) in unusedPaths):
+                return False
+            return os.path.exists(path)
+        oldSize = BobState().getSize()
+        stale = BobState().collectGarbage(keepPath, args.keep_durations * 24 * 60 * 60,
+                                          args.dry_run)
+        details = ", ".join("{}: {}".format(section, num)
+                            for (section, num) in sorted(stale.items()))
+        if args.dry_run:
+            print("Would drop {} state entries ({})".format(sum(stale.values()), details))
+        else:
+            BobState().compact()
+            print("Dropped {} state entries ({}), state shrunk from {} to {} KiB"
+                    .format(sum(stale.values()), details, oldSize // 1024,
+                            BobState().getSize() // 1024))
+
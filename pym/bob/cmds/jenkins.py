@@ -97,12 +97,13 @@ def getBuildIdSpec(step):
 
 
 class JenkinsJob:
-    def __init__(self, name, displayName, prefix, root, archiveBackend):
+    def __init__(self, name, displayName, prefix, root, archiveBackend, hashAlgorithm):
         self.__name = name
         self.__displayName = displayName
         self.__prefix = prefix
         self.__isRoot = root
         self.__archive = archiveBackend
+        self.__hashAlgorithm = hashAlgorithm
         self.__checkoutSteps = {}
         self.__buildSteps = {}
         self.__packageSteps = {}
@@ -232,7 +233,9 @@ class JenkinsJob:
         cmds.append("")
         cmds.append("# create build-id")
         cmds.append("cd $WORKSPACE")
-        cmds.append("bob-hash-engine --state .state -o {} <<'EOF'".format(JenkinsJob._buildIdName(d)))
+        cmds.append("bob-hash-engine --state .state{} -o {} <<'EOF'".format(
+            "" if self.__hashAlgorithm == "sha1" else " --algorithm " + self.__hashAlgorithm,
+            JenkinsJob._buildIdName(d)))
         cmds.append(getBuildIdSpec(d))
         cmds.append("EOF")
 
@@ -496,13 +499,14 @@ class JenkinsJob:
                 done.add(key)
 
 
-def _genJenkinsJobs(p, jobs, prefix, archiveBackend):
+def _genJenkinsJobs(p, jobs, prefix, archiveBackend, hashAlgorithm):
     displayName = prefix + p.getRecipe().getName()
     name = escapeJobName(displayName)
     if name in jobs:
         jj = jobs[name]
     else:
-        jj = JenkinsJob(name, displayName, prefix, p.getRecipe().isRoot(), archiveBackend)
+        jj = JenkinsJob(name, displayName, prefix, p.getRecipe().isRoot(), archiveBackend,
+                        hashAlgorithm)
         jobs[name] = jj
 
     checkout = p.getCheckoutStep()
@@ -516,7 +520,7 @@ def _genJenkinsJobs(p, jobs, prefix, archiveBackend):
     allDeps = p.getAllDepSteps()
     jj.addDependencies(allDeps)
     for d in allDeps:
-        _genJenkinsJobs(d.getPackage(), jobs, prefix, archiveBackend)
+        _genJenkinsJobs(d.getPackage(), jobs, prefix, archiveBackend, hashAlgorithm)
 
 def checkRecipeCycles(p, stack=[]):
     name = p.getRecipe().getName()
@@ -568,7 +572,7 @@ def genJenkinsJobs(recipes, jenkins):
 
     for root in [ walkPackagePath(rootPackages, r) for r in config["roots"] ]:
         checkRecipeCycles(root)
-        _genJenkinsJobs(root, jobs, prefix, archiveHandler)
+        _genJenkinsJobs(root, jobs, prefix, archiveHandler, recipes.hashAlgorithm())
 
     return jobs
 
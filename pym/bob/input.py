@@ -25,6 +25,7 @@ from glob import glob
 from pipes import quote
 from string import Template
 import copy
+import fcntl
 import hashlib
 import os, os.path
 import re
@@ -39,6 +40,31 @@ def _hashString(string):
     h.update(string.encode("utf8"))
     return h.digest()
 
+def _parseSize(value, prop):
+    """Parse a size in bytes with an optional K, M, G or T suffix."""
+    if isinstance(value, int): return value
+    m = re.fullmatch(r"\s*([0-9]+)\s*([KMGT]?)B?\s*", str(value), re.IGNORECASE)
+    if m is None:
+        raise ParseError("Invalid size in {}: {}".format(prop, value))
+    return int(m.group(1)) << (10 * " KMGT".index(m.group(2).upper() or " "))
+
+def _parseHashScope(value, prop):
+    """Parse the include and exclude patterns of a hash scope."""
+    if not isinstance(value, dict):
+        raise ParseError("{} must be a dict".format(prop))
+    ret = {}
+    for (key, patterns) in value.items():
+        if key not in ("include", "exclude"):
+            raise ParseError("Unknown key '{}' in {}".format(key, prop))
+        if isinstance(patterns, str): patterns = [patterns]
+        if not isinstance(patterns, list) or \
+           not all(isinstance(p, str) and p for p in patterns):
+            raise ParseError("{}.{} must be a list of patterns".format(prop, key))
+        if any(os.path.isabs(p) for p in patterns):
+            raise ParseError("Patterns in {} must be relative".format(prop))
+        ret[key] = patterns
+    return ret
+
 def overlappingPaths(p1, p2):
     p1 = os.path.normcase(os.path.normpath(p1)).split(os.sep)
     if p1 == ["."]: p1 = []
@@ -982,6 +1008,11 @@ class CheckoutStep(Step):
             dirs.update(s.getDirectories())
         return dirs
 
+    def getGitDirectories(self):
+        """Return the directories of all git checkouts of the step."""
+        return [ d for s in self.__scmList if isinstance(s, GitScm)
+                   for d in s.getDirectories().keys() ]
+
     def isDeterministic(self):
         return self.__deterministic and all([ s.isDeterministic() for s in self.__scmList ])
 
@@ -1289,6 +1320,13 @@ class Recipe(object):
         self.__toolDepPackage = set(recipe.get("packageTools", []))
         self.__toolDepPackage |= self.__toolDepBuild
         self.__shared = recipe.get("shared", False)
+        self.__resources = recipe.get("resources", {})
+        if not isinstance(self.__resources, dict):
+            raise ParseError("resources must be a dict")
+        self.__hashScope = {
+            step : _parseHashScope(recipe.get(step + "HashScope", {}), step + "HashScope")
+            for step in ("build", "package")
+        }
         self.__properties = {
             n : p(n in recipe, recipe.get(n))
             for (n, p) in properties.items()
@@ -1329,6 +1367,12 @@ class Recipe(object):
             tmp = cls.__varSelf.copy()
             tmp.update(self.__varSelf)
             self.__varSelf = tmp
+            tmp = cls.__resources.copy()
+            tmp.update(self.__resources)
+            self.__resources = tmp
+            for (step, scope) in self.__hashScope.items():
+                for (key, patterns) in cls.__hashScope[step].items():
+                    scope[key] = patterns + scope.get(key, [])
             self.__varDepCheckout |= cls.__varDepCheckout
             self.__varDepBuild |= cls.__varDepBuild
             self.__varDepPackage |= cls.__varDepPackage
@@ -1357,6 +1401,9 @@ class Recipe(object):
         if self.__package is None:
             self.__package = ""
 
+        # validate resource hints but keep only the declared ones for inheritance
+        self.getResources()
+
         # check provided dependencies
         availDeps = [ d.recipe for d in self.__deps ]
         for d in self.__provideDeps:
@@ -1396,6 +1443,33 @@ class Recipe(object):
         """Returns True if this is a root recipe."""
         return self.__root
 
+    def getResources(self):
+        """Return the expected resource usage of the build step.
+
+        The dict holds the number of CPUs in ``cpu`` and the memory in bytes
+        in ``memory``. Hints that were not given default to one CPU and no
+        memory.
+        """
+        for key in self.__resources:
+            if key not in ("cpu", "memory"):
+                raise ParseError("Unknown resource '{}'".format(key))
+        cpu = self.__resources.get("cpu", 1)
+        if not isinstance(cpu, int) or cpu < 1:
+            raise ParseError("Invalid number of CPUs in resources: {}".format(cpu))
+        return {
+            "cpu" : cpu,
+            "memory" : _parseSize(self.__resources.get("memory", 0), "resources"),
+        }
+
+    def getHashScope(self, step):
+        """Return the part of the workspace that makes up the result hash.
+
+        The dict of the "build" or "package" *step* holds the glob patterns of
+        the hashed files in ``include`` and of the ignored files in
+        ``exclude``. Both keys are optional.
+        """
+        return self.__hashScope[step]
+
     def prepare(self, pathFormatter, inputEnv, sandboxEnabled, states, sandbox=None,
                 inputTools=Env(), inputStack=[]):
         stack = inputStack + [self.__packageName]
@@ -1540,6 +1614,7 @@ class RecipeSet:
         self.__classes = {}
         self.__whiteList = set(["TERM", "SHELL", "USER", "HOME"])
         self.__archive = { "backend" : "none" }
+        self.__hashAlgorithm = "sha1"
         self.__hooks = {}
         self.__properties = {}
         self.__states = {}
@@ -1622,6 +1697,9 @@ class RecipeSet:
     def archiveSpec(self):
         return self.__archive
 
+    def hashAlgorithm(self):
+        return self.__hashAlgorithm
+
     def loadYaml(self, path, default={}):
         if os.path.exists(path):
             data = self.__cache.loadYaml(path)
@@ -1651,6 +1729,12 @@ class RecipeSet:
                 raise ParseError("default.yaml environment must be a dict")
         self.__whiteList |= set(defaults.get("whitelist", []))
         self.__archive = defaults.get("archive", { "backend" : "none" })
+        self.__hashAlgorithm = defaults.get("hashAlgorithm", "sha1")
+        try:
+            hashlib.new(self.__hashAlgorithm).digest()
+        except (ValueError, TypeError):
+            raise ParseError("default.yaml hashAlgorithm '{}' is not supported"
+                                .format(self.__hashAlgorithm))
 
         if not os.path.isdir("recipes"):
             raise ParseError("No recipes directory found.")
@@ -1704,10 +1788,14 @@ class RecipeSet:
 
 class YamlCache:
     def open(self):
+        # The shelve must not be used by concurrent Bob processes.
+        self.__lock = open(".bob-cache.lock", "w")
+        fcntl.flock(self.__lock, fcntl.LOCK_EX)
         self.__shelve = shelve.open(".bob-cache.shelve")
 
     def close(self):
         self.__shelve.close()
+        self.__lock.close()
 
     def loadYaml(self, name):
         binStat = binLstat(name)
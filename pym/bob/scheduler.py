@@ -0,0 +1,407 @@
+# Bob build tool
+# Copyright (C) 2016  TechniSat Digital GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from .errors import BuildError
+import fcntl
+import itertools
+import multiprocessing
+import os
+import queue
+import shutil
+import tempfile
+import threading
+
+class Wait:
+    """Suspend the current task until other tasks have finished.
+
+    The *tasks* are given as list of (key, factory) tuples. A task that is not
+    known yet is created by calling the factory which must return a generator.
+    The results of all tasks are sent back as list in the same order.
+    """
+    def __init__(self, tasks):
+        self.tasks = list(tasks)
+
+class Spawn:
+    """Start other tasks in the background.
+
+    The *tasks* are given as list of (key, factory) tuples like for
+    :class:`Wait`. The current task continues right away. Other tasks can wait
+    for the spawned tasks by their key.
+    """
+    def __init__(self, tasks):
+        self.tasks = list(tasks)
+
+class Call:
+    """Run a blocking function on a worker thread.
+
+    The return value of *fn* is sent back to the task. If the function raises
+    an exception it is thrown into the task instead. The expected number of
+    used CPUs and bytes of memory may be given as *cpu* and *memory*. Calls
+    that spawn processes which use the :class:`JobServer` must set *jobToken*.
+    The call is limited by the jobs of the given *pool* if the scheduler has
+    such a pool.
+    """
+    def __init__(self, fn, *args, cpu=1, memory=0, jobToken=False, pool=None):
+        self.fn = fn
+        self.args = args
+        self.cpu = cpu
+        self.memory = memory
+        self.jobToken = jobToken
+        self.pool = pool
+
+def _memInfo():
+    ret = {}
+    try:
+        with open("/proc/meminfo") as f:
+            for l in f:
+                (key, val) = l.split(":", 1)
+                val = val.split()
+                ret[key] = int(val[0]) * (1024 if val[1:] == ["kB"] else 1)
+    except (OSError, ValueError, IndexError):
+        pass
+    return ret
+
+class Resources:
+    """Admission control based on the CPU and memory demand of calls.
+
+    Every running call reserves its declared CPUs and memory. Another call is
+    only started if it fits into what is left of the host. The CPUs that are
+    in use are the reserved ones or the load average, whichever is higher.
+    The memory must be available according to ``/proc/meminfo`` too. Calls
+    that do not use any CPU are not affected by the load. If nothing is
+    running a call is always started to guarantee progress.
+    """
+
+    def __init__(self, cpu=None, memory=None):
+        self.__cpu = cpu or multiprocessing.cpu_count()
+        self.__memory = memory or _memInfo().get("MemTotal")
+        self.__reservedCpu = 0
+        self.__reservedMemory = 0
+
+    def admit(self, call, idle):
+        cpu = min(call.cpu, self.__cpu)
+        if not idle:
+            if cpu:
+                try:
+                    load = os.getloadavg()[0]
+                except OSError:
+                    load = 0
+                if max(self.__reservedCpu, load) + cpu > self.__cpu:
+                    return False
+            if call.memory and self.__memory:
+                if self.__reservedMemory + call.memory > self.__memory:
+                    return False
+                if call.memory > _memInfo().get("MemAvailable", call.memory):
+                    return False
+        self.__reservedCpu += cpu
+        self.__reservedMemory += call.memory
+        return True
+
+    def release(self, call):
+        self.__reservedCpu -= min(call.cpu, self.__cpu)
+        self.__reservedMemory -= call.memory
+
+class JobServer:
+    """GNU make compatible jobserver.
+
+    The *jobs* tokens are shared between all calls that need a job token and
+    the make processes that they spawn. The first call gets the implicit
+    token, like a make process that is started by another make. All other
+    calls have to take a token from the pipe before they are started.
+
+    The pipe is made from a fifo so that Bob can read tokens from a non-blocking
+    descriptor without affecting the blocking descriptor of the make processes.
+    """
+
+    def __init__(self, jobs):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            fifo = os.path.join(tmpDir, "jobserver")
+            os.mkfifo(fifo)
+            self.__acquireFd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+            writeFd = os.open(fifo, os.O_WRONLY)
+            readFd = os.open(fifo, os.O_RDONLY)
+        finally:
+            shutil.rmtree(tmpDir)
+
+        # The descriptors are inherited by the steps. Keep them away from 0-9
+        # that are freely used by shell redirections.
+        self.__readFd = fcntl.fcntl(readFd, fcntl.F_DUPFD, 10)
+        self.__writeFd = fcntl.fcntl(writeFd, fcntl.F_DUPFD, 10)
+        os.close(readFd)
+        os.close(writeFd)
+
+        os.write(self.__writeFd, b'+' * (jobs-1))
+        self.__implicitUsed = False
+        self.__tokens = {}
+
+    def close(self):
+        os.close(self.__acquireFd)
+        os.close(self.__readFd)
+        os.close(self.__writeFd)
+
+    def getFds(self):
+        """Return the descriptors that must be inherited by child processes."""
+        return (self.__readFd, self.__writeFd)
+
+    def getMakeFlags(self):
+        """Return the MAKEFLAGS that make processes need to join."""
+        return "-j --jobserver-fds={R},{W} --jobserver-auth={R},{W}".format(
+            R=self.__readFd, W=self.__writeFd)
+
+    def admit(self, call, idle):
+        if not call.jobToken:
+            return True
+        if not self.__implicitUsed:
+            self.__implicitUsed = True
+            self.__tokens[call] = None
+            return True
+        try:
+            token = os.read(self.__acquireFd, 1)
+        except BlockingIOError:
+            return False
+        if not token:
+            return False
+        self.__tokens[call] = token
+        return True
+
+    def release(self, call):
+        if not call.jobToken:
+            return
+        token = self.__tokens.pop(call)
+        if token is None:
+            self.__implicitUsed = False
+        else:
+            os.write(self.__writeFd, token)
+
+class _Task:
+    def __init__(self, key, gen, weight):
+        self.key = key
+        self.gen = gen
+        self.weight = weight
+        self.deps = []
+        self.pending = 0
+        self.waiters = []
+        self.done = False
+        self.result = None
+
+class Scheduler:
+    """Execute a dynamically discovered graph of tasks.
+
+    Tasks are generators that only do the bookkeeping and always run on the
+    calling thread. Everything that blocks is delegated with :class:`Call`.
+    Such calls are put into a ready queue and at most *jobs* of them are
+    executed concurrently on worker threads. Calls of the named *pools* have
+    their own limit of jobs instead, e.g. to run I/O bound calls alongside the
+    CPU bound ones. Each task key is run only once, no matter how many other
+    tasks wait for it.
+
+    With a single job in every pool all calls are executed synchronously. The tasks are then
+    processed strictly depth first in the order they were waited for.
+    Otherwise the ready calls are ranked by the longest remaining path to the
+    requested tasks, i.e. the critical path is started first. The expected
+    duration of each task is queried from *weight* with the task key. A call
+    is only started if all *admission* controllers, e.g. :class:`Resources` or
+    :class:`JobServer`, admit it. Smaller calls may overtake the ones that do
+    not fit.
+
+    Tasks that were started with :class:`Spawn` are run to completion even if
+    nobody waits for them.
+
+    If a task fails no further calls are started and no other task is resumed.
+    Calls that are already running are still waited for and their results are
+    delivered so that their tasks can record it. Afterwards the first error is
+    raised.
+    """
+
+    def __init__(self, jobs=1, weight=lambda key: 1, admission=[], pools={}):
+        self.__jobs = { name : max(1, num) for (name, num) in pools.items() }
+        self.__jobs[None] = max(1, jobs)
+        self.__sync = all((num == 1) for num in self.__jobs.values())
+        self.__weight = weight
+        self.__admission = admission
+
+    def run(self, tasks):
+        """Run the given (key, factory) tasks and everything they wait for.
+
+        Returns the list of the task results.
+        """
+        self.__tasks = {}
+        self.__runnable = []
+        self.__ready = []
+        self.__sequence = itertools.count()
+        self.__running = 0
+        self.__poolRunning = { name : 0 for name in self.__jobs }
+        self.__finished = queue.Queue()
+        self.__error = None
+
+        root = _Task(None, Scheduler.__root(tasks), 0)
+        self.__runnable.append((root, None, None))
+        while True:
+            while self.__runnable:
+                self.__step(*self.__runnable.pop())
+            heldBack = False
+            if self.__ready and (self.__error is None):
+                self.__prioritize()
+                heldBack = self.__admit()
+            if self.__running == 0: break
+            try:
+                # Poll regularly if calls are held back by admission control.
+                item = self.__finished.get(timeout=0.1 if heldBack else None)
+            except queue.Empty:
+                continue
+            except KeyboardInterrupt as e:
+                # The running steps were interrupted too. Wait for them.
+                if self.__error is None: self.__error = e
+                continue
+            (task, call, value, exc) = item
+            self.__running -= 1
+            self.__poolRunning[self.__pool(call)] -= 1
+            for a in self.__admission: a.release(call)
+            self.__step(task, value, exc, True)
+
+        if self.__error is not None:
+            raise self.__error
+        if not root.done:
+            raise BuildError("Cyclic dependency between build steps detected!")
+        return root.result
+
+    @staticmethod
+    def __root(tasks):
+        return (yield Wait(tasks))
+
+    def __step(self, task, value, exc, called=False):
+        if (self.__error is not None) and not called:
+            # abandon task after an error somewhere else without resuming it
+            task.gen.close()
+            return
+        while True:
+            try:
+                if exc is not None:
+                    req = task.gen.throw(exc)
+                else:
+                    req = task.gen.send(value)
+            except StopIteration as e:
+                self.__finish(task, e.value)
+                return
+            except BaseException as e:
+                if self.__error is None: self.__error = e
+                return
+
+            if self.__error is not None:
+                # abandon task after an error somewhere else
+                task.gen.close()
+                return
+            elif isinstance(req, Wait):
+                self.__wait(task, req)
+                return
+            elif isinstance(req, Spawn):
+                self.__spawn(req)
+                (value, exc) = (None, None)
+            elif isinstance(req, Call):
+                if not self.__sync:
+                    self.__ready.append((next(self.__sequence), task, req))
+                    return
+                (value, exc) = Scheduler.__execute(req)
+            else:
+                (value, exc) = (None, TypeError("Invalid request: " + repr(req)))
+
+    def __wait(self, task, req):
+        new = []
+        task.deps = []
+        for (key, factory) in req.tasks:
+            dep = self.__tasks.get(key)
+            if dep is None:
+                dep = self.__tasks[key] = _Task(key, factory(), self.__weight(key))
+                new.append(dep)
+            task.deps.append(dep)
+
+        pending = set(d for d in task.deps if not d.done)
+        task.pending = len(pending)
+        for d in pending: d.waiters.append(task)
+
+        # The first new task must be on top of the stack to go depth first.
+        for d in reversed(new): self.__runnable.append((d, None, None))
+        if task.pending == 0:
+            self.__runnable.append((task, [d.result for d in task.deps], None))
+
+    def __spawn(self, req):
+        for (key, factory) in req.tasks:
+            if key in self.__tasks: continue
+            task = self.__tasks[key] = _Task(key, factory(), self.__weight(key))
+            self.__runnable.append((task, None, None))
+
+    def __finish(self, task, result):
+        task.done = True
+        task.result = result
+        for w in task.waiters:
+            w.pending -= 1
+            if w.pending == 0:
+                self.__runnable.append((w, [d.result for d in w.deps], None))
+        task.waiters = []
+
+    def __prioritize(self):
+        remaining = {}
+        def path(task):
+            ret = remaining.get(task)
+            if ret is None:
+                ret = remaining[task] = task.weight + max(
+                    [0] + [ path(w) for w in task.waiters ])
+            return ret
+
+        # longest remaining path first, then in order of arrival
+        self.__ready.sort(key=lambda r: (-path(r[1]), r[0]))
+
+    def __pool(self, call):
+        return call.pool if call.pool in self.__jobs else None
+
+    def __admit(self):
+        """Start ready calls and return True if some were held back."""
+        heldBack = False
+        i = 0
+        while i < len(self.__ready):
+            (seq, task, call) = self.__ready[i]
+            pool = self.__pool(call)
+            if self.__poolRunning[pool] >= self.__jobs[pool]:
+                i += 1
+                continue
+            admitted = []
+            for a in self.__admission:
+                if not a.admit(call, self.__running == 0): break
+                admitted.append(a)
+            if len(admitted) == len(self.__admission):
+                del self.__ready[i]
+                self.__dispatch(task, call, pool)
+            else:
+                for a in admitted: a.release(call)
+                heldBack = True
+                i += 1
+        return heldBack
+
+    def __dispatch(self, task, call, pool):
+        self.__running += 1
+        self.__poolRunning[pool] += 1
+        threading.Thread(target=self.__worker, args=(task, call), daemon=True).start()
+
+    def __worker(self, task, call):
+        self.__finished.put((task, call) + Scheduler.__execute(call))
+
+    @staticmethod
+    def __execute(call):
+        try:
+            return (call.fn(*call.args), None)
+        except BaseException as e:
+            return (None, e)
@@ -18,7 +18,11 @@ from . import BOB_VERSION
 from .errors import BobError
 from .tty import colorize, Unbuffered
 from .utils import asHexStr, hashDirectory
+from concurrent.futures import ThreadPoolExecutor
 import argparse
+import hashlib
+import multiprocessing
+import os
 import sys
 import traceback
 
@@ -102,23 +106,78 @@ Please open an issue at https://github.com/BobBuildTool/bob with the following b
 
     return ret
 
+def __algorithm(name):
+    try:
+        hashlib.new(name).digest()
+    except (ValueError, TypeError):
+        raise argparse.ArgumentTypeError("unsupported hash algorithm: " + name)
+    return name
+
+def __stateFile(stateDir, path):
+    if stateDir:
+        return os.path.join(stateDir, path.replace(os.sep, "_"))
+    else:
+        return None
+
+def __hashDirectories(executor, dirs, stateDir, algorithm, jobs):
+    """Hash all directories concurrently.
+
+    Returns a dict of futures indexed by the directory. Directories that share
+    the same state cache are hashed one after another.
+    """
+    byState = {}
+    for d in dirs:
+        byState.setdefault(__stateFile(stateDir, d) or d, []).append(d)
+    workers = max(1, jobs // max(1, len(byState)))
+
+    def hashGroup(group):
+        return { d : hashDirectory(d, __stateFile(stateDir, d), workers, algorithm)
+                 for d in group }
+
+    ret = {}
+    for group in byState.values():
+        future = executor.submit(hashGroup, group)
+        for d in group: ret[d] = future
+    return ret
+
 def hashTree():
-    parser = argparse.ArgumentParser(description="""Calculate hash sum of a directory.
+    parser = argparse.ArgumentParser(description="""Calculate hash sum of directories.
         To speed up repeated hashing of the same directory specify a state cache
         with '-s'. This cache holds the calculated file caches. Unmodified files
-        will not be read again in subsequent runs.""")
+        will not be read again in subsequent runs. If more than one directory
+        is given they are hashed concurrently. The state cache is then a
+        directory that holds one cache per hashed directory.""")
     parser.add_argument('-s', '--state', help="State cache path")
-    parser.add_argument('dir', help="Directory")
+    parser.add_argument('-a', '--algorithm', default="sha1", type=__algorithm,
+        help="Hash algorithm (default: sha1)")
+    parser.add_argument('-j', '--jobs', default=multiprocessing.cpu_count(), type=int,
+        help="Number of parallel jobs (default: number of CPUs)")
+    parser.add_argument('dirs', nargs='+', metavar="dir", help="Directory")
     args = parser.parse_args()
 
-    digest = hashDirectory(args.dir, args.state)
-    print(asHexStr(digest))
+    if len(args.dirs) == 1:
+        digest = hashDirectory(args.dirs[0], args.state, max(1, args.jobs),
+                               args.algorithm)
+        print(asHexStr(digest))
+        return 0
+
+    if args.state: os.makedirs(args.state, exist_ok=True)
+    with ThreadPoolExecutor(max(1, args.jobs)) as executor:
+        digests = __hashDirectories(executor, args.dirs, args.state,
+                                    args.algorithm, max(1, args.jobs))
+        for d in args.dirs:
+            print(asHexStr(digests[d].result()[d]), d)
     return 0
 
 def hashEngine():
-    parser = argparse.ArgumentParser(description="Create hash based on spec.")
+    parser = argparse.ArgumentParser(description="""Create hash based on spec.
+        All directories of the spec are hashed concurrently.""")
     parser.add_argument('-o', dest="output", metavar="OUTPUT", default="-", help="Output file (default: stdout)")
     parser.add_argument('--state', help="State cache directory")
+    parser.add_argument('-a', '--algorithm', default="sha1", type=__algorithm,
+        help="Hash algorithm of directories (default: sha1)")
+    parser.add_argument('-j', '--jobs', default=multiprocessing.cpu_count(), type=int,
+        help="Number of parallel jobs (default: number of CPUs)")
     parser.add_argument('spec', nargs='?', default="-", help="Spec input (default: stdin)")
     args = parser.parse_args()
 
@@ -127,47 +186,71 @@ def hashEngine():
     else:
         inFile = open(args.spec, "r")
 
-    l = inFile.readline().strip()
+    spec = __parse(inFile.readline().strip(), inFile)
+    dirs = []
+    __collectDirs(spec, dirs)
     try:
-        res = __process(l, inFile, args.state)
-        if args.output == "-":
-            sys.stdout.buffer.write(res)
-        else:
-            with open(args.output, "wb") as f:
-                f.write(res)
+        with ThreadPoolExecutor(max(1, args.jobs)) as executor:
+            digests = __hashDirectories(executor, dirs, args.state,
+                                        args.algorithm, max(1, args.jobs))
+            if args.output == "-":
+                __process(spec, digests, sys.stdout.buffer.write)
+            else:
+                try:
+                    with open(args.output, "wb") as f:
+                        __process(spec, digests, f.write)
+                except OSError:
+                    if os.path.exists(args.output): os.unlink(args.output)
+                    raise
     except OSError as e:
         print("IO error:", str(e), file=sys.stderr)
         return 1
 
     return 0
 
-def __process(l, inFile, stateDir):
-    if l.startswith("="):
-        return bytes.fromhex(l[1:])
-    elif l.startswith("<"):
-        with open(l[1:], "rb") as f:
-            return f.read()
+def __parse(l, inFile):
+    """Parse the spec into a tree of (kind, argument, children) tuples."""
+    if l.startswith(("=", "<", "#")):
+        return (l[0], l[1:], None)
     elif l.startswith("{"):
-        import hashlib
-        return __processBlock(hashlib.new(l[1:]), inFile, stateDir)
-    elif l.startswith("#"):
-        import os.path
-        if stateDir:
-            stateFile = os.path.join(stateDir, l[1:].replace(os.sep, "_"))
-        else:
-            stateFile = None
-        return hashDirectory(l[1:], stateFile)
+        children = []
+        while True:
+            n = inFile.readline().strip()
+            if n.startswith("}"):
+                return ("{", l[1:], children)
+            children.append(__parse(n, inFile))
     else:
         print("Malformed spec:", l, file=sys.stderr)
         sys.exit(1)
 
-def __processBlock(h, inFile, stateDir):
-    while True:
-        l = inFile.readline().strip()
-        if l.startswith("}"):
-            return h.digest()
-        else:
-            h.update(__process(l, inFile, stateDir))
+def __collectDirs(node, dirs):
+    (kind, arg, children) = node
+    if kind == "#":
+        if arg not in dirs: dirs.append(arg)
+    elif kind == "{":
+        for c in children: __collectDirs(c, dirs)
+
+def __process(node, digests, update):
+    """Feed the result of a spec node into *update*.
+
+    Files are streamed in blocks. Directory digests are taken from the
+    concurrently running hash jobs.
+    """
+    (kind, arg, children) = node
+    if kind == "=":
+        update(bytes.fromhex(arg))
+    elif kind == "<":
+        with open(arg, "rb") as f:
+            buf = f.read(65536)
+            while buf:
+                update(buf)
+                buf = f.read(65536)
+    elif kind == "#":
+        update(digests[arg].result()[arg])
+    else:
+        h = hashlib.new(arg)
+        for c in children: __process(c, digests, h.update)
+        update(h.digest())
 
 if __name__ == '__main__':
     if sys.argv[1] == 'bob':
@@ -14,184 +14,389 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from .errors import ParseError
 import copy
 import os
+import functools
 import pickle
+import sqlite3
+import threading
+import time
 
 class _BobState():
     # Bump CUR_VERSION if internal state is made backwards incompatible, that is
     # older versions ob Bob will choke on the persisted state. The MIN_VERSION
     # should only be incremented if it is impossible to read such an old state.
     MIN_VERSION = 2
-    CUR_VERSION = 2
+    CUR_VERSION = 3
+
+    # Sections that are stored as simple key/value tables. The values are
+    # pickled, the keys are stored as-is.
+    SECTIONS = [ "byNameDirs", "results", "inputs", "dirStates", "durations",
+                 "jenkins", "meta" ]
+
+    def __locked(fn):
+        """Serialize calls from different threads.
+
+        The state is used by the steps that run on worker threads too. They
+        share the one database connection and the cached sections.
+        """
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            with self.__lock:
+                return fn(self, *args, **kwargs)
+        return wrapper
 
     instance = None
     def __init__(self):
         self.__path = ".bob-state.pickle"
-        self.__byNameDirs = {}
-        self.__results = {}
-        self.__inputs = {}
-        self.__jenkins = {}
+        self.__dbPath = ".bob-state.sqlite3"
         self.__synchronous = True
-        self.__dirty = False
-        self.__dirStates = {}
-        self.__buildState = {}
-        if os.path.exists(self.__path):
+        self.__sections = {}
+        self.__jenkinsJobs = {}
+        self.__dataVersion = None
+        self.__lock = threading.RLock()
+
+        # Old states are migrated once. The pickle is replaced by a stub that
+        # is rejected by older versions of Bob.
+        oldState = None
+        if not os.path.exists(self.__dbPath) and os.path.exists(self.__path):
             with open(self.__path, 'rb') as f:
-                state = pickle.load(f)
-            if state["version"] < _BobState.MIN_VERSION:
-                raise ParseError("This version of bob cannot read the build tree anymore. Sorry. :-(")
-            if state["version"] > _BobState.CUR_VERSION:
-                raise ParseError("This version of bob is too old for the build tree.")
-            self.__byNameDirs = state["byNameDirs"]
-            self.__results = state["results"]
-            self.__inputs = state["inputs"]
-            self.__jenkins = state.get("jenkins", {})
-            self.__dirStates = state.get("dirStates", {})
-            self.__buildState = state.get("buildState", {})
-
-    def __save(self):
-        if self.__synchronous:
-            state = {
-                "version" : _BobState.CUR_VERSION,
-                "byNameDirs" : self.__byNameDirs,
-                "results" : self.__results,
-                "inputs" : self.__inputs,
-                "jenkins" : self.__jenkins,
-                "dirStates" : self.__dirStates,
-                "buildState" : self.__buildState,
-            }
+                oldState = pickle.load(f)
+            self.__checkVersion(oldState["version"])
+
+        self.__db = sqlite3.connect(self.__dbPath, timeout=60, isolation_level=None,
+                                    check_same_thread=False)
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.execute("PRAGMA synchronous=NORMAL")
+        self.__begin()
+        for section in _BobState.SECTIONS:
+            self.__db.execute("CREATE TABLE IF NOT EXISTS {} (name PRIMARY KEY, value BLOB)"
+                                .format(section))
+        self.__db.execute("""CREATE TABLE IF NOT EXISTS jenkinsJobs (
+                jenkins, job, value BLOB, PRIMARY KEY (jenkins, job))""")
+        version = self.__section("meta").get("version")
+        if version is None:
+            self.__put("meta", "version", _BobState.CUR_VERSION)
+            if oldState is not None: self.__migrate(oldState)
+        else:
+            self.__checkVersion(version)
+        self.__commit(True)
+
+        if oldState is not None:
             tmpFile = self.__path+".new"
             with open(tmpFile, "wb") as f:
-                pickle.dump(state, f)
+                pickle.dump({ "version" : _BobState.CUR_VERSION }, f)
                 f.flush()
                 os.fsync(f.fileno())
             os.replace(tmpFile, self.__path)
-            self.__dirty = False
-        else:
-            self.__dirty = True
 
+    @staticmethod
+    def __checkVersion(version):
+        if version < _BobState.MIN_VERSION:
+            raise ParseError("This version of bob cannot read the build tree anymore. Sorry. :-(")
+        if version > _BobState.CUR_VERSION:
+            raise ParseError("This version of bob is too old for the build tree.")
+
+    def __migrate(self, state):
+        for section in ["byNameDirs", "results", "inputs", "dirStates", "durations"]:
+            for (name, value) in state.get(section, {}).items():
+                self.__put(section, name, value)
+        for (name, jenkins) in state.get("jenkins", {}).items():
+            self.__put("jenkins", name, {
+                "config" : jenkins["config"],
+                "byNameDirs" : jenkins.get("byNameDirs", {}),
+            })
+            for (job, jobConfig) in jenkins["jobs"].items():
+                self.__putJenkinsJob(name, job, jobConfig)
+        self.__put("meta", "buildState", state.get("buildState", {}))
+
+    def __refresh(self):
+        """Drop cached sections if another Bob process changed the state.
+
+        Older SQLite libraries do not know the data version. Everything is
+        reloaded then.
+        """
+        row = self.__db.execute("PRAGMA data_version").fetchone()
+        version = row[0] if row else None
+        if (version is None) or (version != self.__dataVersion):
+            self.__sections = {}
+            self.__jenkinsJobs = {}
+            self.__dataVersion = version
+
+    def __begin(self):
+        # Take the write lock right away. Otherwise we might base our updates
+        # on a stale state if another Bob process commits in between.
+        if not self.__db.in_transaction:
+            self.__db.execute("BEGIN IMMEDIATE")
+            self.__refresh()
+
+    def __commit(self, force=False):
+        # In WAL mode a commit just appends to the log. The log is synced to
+        # the database in batches at checkpoints.
+        if (self.__synchronous or force) and self.__db.in_transaction:
+            self.__db.execute("COMMIT")
+
+    def __section(self, section):
+        """Get cached section. Every section is loaded on first use."""
+        if not self.__db.in_transaction: self.__refresh()
+        ret = self.__sections.get(section)
+        if ret is None:
+            ret = self.__sections[section] = {
+                name : pickle.loads(value) for (name, value) in
+                    self.__db.execute("SELECT name, value FROM {}".format(section))
+            }
+        return ret
+
+    def __put(self, section, name, value):
+        self.__begin()
+        self.__section(section)[name] = value
+        self.__db.execute("INSERT OR REPLACE INTO {} VALUES (?, ?)".format(section),
+                          (name, pickle.dumps(value)))
+
+    def __del(self, section, name):
+        self.__begin()
+        self.__section(section).pop(name, None)
+        self.__db.execute("DELETE FROM {} WHERE name = ?".format(section), (name,))
+
+    def __jobs(self, jenkins):
+        if not self.__db.in_transaction: self.__refresh()
+        ret = self.__jenkinsJobs.get(jenkins)
+        if ret is None:
+            ret = self.__jenkinsJobs[jenkins] = {
+                job : pickle.loads(value) for (job, value) in
+                    self.__db.execute("SELECT job, value FROM jenkinsJobs WHERE jenkins = ?",
+                                      (jenkins,))
+            }
+        return ret
+
+    def __putJenkinsJob(self, jenkins, job, jobConfig):
+        self.__begin()
+        self.__jobs(jenkins)[job] = jobConfig
+        self.__db.execute("INSERT OR REPLACE INTO jenkinsJobs VALUES (?, ?, ?)",
+                          (jenkins, job, pickle.dumps(jobConfig)))
+
+    @__locked
+    def collectGarbage(self, keepPath, maxDurationAge, dryRun=False):
+        """Drop the entries of stale paths and old step durations.
+
+        All entries of paths for which *keepPath* returns False are removed.
+        Step durations are dropped if the step was not run for
+        *maxDurationAge* seconds. Durations that were recorded without time
+        of use are considered to be used now. Returns a dict with the number
+        of dropped entries per section.
+        """
+        self.__begin()
+        stale = {}
+        stale["byNameDirs"] = [ digest for (digest, path) in self.__section("byNameDirs").items()
+                                if isinstance(path, str) and not keepPath(path) ]
+        for section in ["results", "inputs", "dirStates"]:
+            stale[section] = [ path for path in self.__section(section)
+                               if not keepPath(path) ]
+        now = time.time()
+        stale["durations"] = []
+        for (variantId, duration) in list(self.__section("durations").items()):
+            if not isinstance(duration, tuple):
+                if not dryRun: self.__put("durations", variantId, (duration, now))
+            elif duration[1] < now - maxDurationAge:
+                stale["durations"].append(variantId)
+        if not dryRun:
+            for (section, names) in stale.items():
+                for name in names: self.__del(section, name)
+        self.__commit(True)
+        return { section : len(names) for (section, names) in stale.items() }
+
+    @__locked
+    def getSize(self):
+        """Return the size of the state on disk in bytes."""
+        return sum(os.path.getsize(p) for p in (self.__dbPath, self.__dbPath+"-wal")
+                   if os.path.exists(p))
+
+    @__locked
+    def compact(self):
+        """Give space of dropped entries back to the file system."""
+        self.__commit(True)
+        self.__db.execute("VACUUM")
+        self.__db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    @__locked
     def setAsynchronous(self):
         self.__synchronous = False
 
+    @__locked
     def setSynchronous(self):
         self.__synchronous = True
-        if self.__dirty:
-            self.__save()
+        self.__commit()
 
+    @__locked
     def getByNameDirectory(self, baseDir, digest, persistent):
-        if digest in self.__byNameDirs:
-            return self.__byNameDirs[digest]
-        else:
-            num = self.__byNameDirs.setdefault(baseDir, 0) + 1
+        byNameDirs = self.__section("byNameDirs")
+        if digest in byNameDirs:
+            return byNameDirs[digest]
+        elif not persistent:
+            return "{}/{}".format(baseDir, byNameDirs.get(baseDir, 0) + 1)
+
+        # Allocate the directory under the write lock and commit it right
+        # away. Concurrent Bob processes must never share a directory.
+        self.__begin()
+        byNameDirs = self.__section("byNameDirs")
+        res = byNameDirs.get(digest)
+        if res is None:
+            num = byNameDirs.get(baseDir, 0) + 1
             res = "{}/{}".format(baseDir, num)
-            if persistent:
-                self.__byNameDirs[baseDir] = num
-                self.__byNameDirs[digest] = res
-                self.__save()
-            return res
+            self.__put("byNameDirs", baseDir, num)
+            self.__put("byNameDirs", digest, res)
+        self.__commit(True)
+        return res
 
+    @__locked
     def getAllNameDirectores(self):
         ret = set()
-        for d in self.__byNameDirs.values():
+        for d in self.__section("byNameDirs").values():
             if isinstance(d, str): ret.add(d)
         return ret
 
+    @__locked
     def getResultHash(self, stepDigest):
-        return self.__results.get(stepDigest)
+        return self.__section("results").get(stepDigest)
 
+    @__locked
     def setResultHash(self, stepDigest, hash):
         if self.getResultHash(stepDigest) != hash:
-            self.__results[stepDigest] = hash
-            self.__save()
+            self.__put("results", stepDigest, hash)
+            self.__commit()
 
+    @__locked
     def delResultHash(self, stepDigest):
-        if stepDigest in self.__results:
-            del self.__results[stepDigest]
-            self.__save()
+        if stepDigest in self.__section("results"):
+            self.__del("results", stepDigest)
+            self.__commit()
 
+    @__locked
     def getInputHashes(self, path):
-        return self.__inputs.get(path)
+        return self.__section("inputs").get(path)
 
+    @__locked
     def setInputHashes(self, path, hashes):
         if self.getInputHashes(path) != hashes:
-            self.__inputs[path] = hashes
-            self.__save()
+            self.__put("inputs", path, hashes)
+            self.__commit()
 
+    @__locked
     def delInputHashes(self, path):
-        if path in self.__inputs:
-            del self.__inputs[path]
-            self.__save()
+        if path in self.__section("inputs"):
+            self.__del("inputs", path)
+            self.__commit()
 
+    @__locked
     def getDirectoryState(self, path, default=None):
-        return copy.deepcopy(self.__dirStates.get(path, default))
+        return copy.deepcopy(self.__section("dirStates").get(path, default))
 
+    @__locked
     def setDirectoryState(self, path, digest):
-        self.__dirStates[path] = digest
-        self.__save()
+        self.__put("dirStates", path, digest)
+        self.__commit()
 
+    @__locked
     def getAllJenkins(self):
-        return self.__jenkins.keys()
+        return self.__section("jenkins").keys()
 
+    @__locked
     def addJenkins(self, name, config):
-        self.__jenkins[name] = {
+        self.__begin()
+        self.__db.execute("DELETE FROM jenkinsJobs WHERE jenkins = ?", (name,))
+        self.__jenkinsJobs[name] = {}
+        self.__put("jenkins", name, {
             "config" : copy.deepcopy(config),
-            "jobs" : {},
             "byNameDirs" : {},
-        }
-        self.__save()
+        })
+        self.__commit()
 
+    @__locked
     def delJenkins(self, name):
-        if name in self.__jenkins:
-            del self.__jenkins[name]
-            self.__save()
+        if name in self.__section("jenkins"):
+            self.__del("jenkins", name)
+            self.__db.execute("DELETE FROM jenkinsJobs WHERE jenkins = ?", (name,))
+            self.__jenkinsJobs.pop(name, None)
+            self.__commit()
 
+    @__locked
     def getJenkinsByNameDirectory(self, jenkins, baseDir, digest):
-        byNameDirs = self.__jenkins[jenkins].setdefault('byNameDirs', {})
+        entry = self.__section("jenkins")[jenkins]
+        byNameDirs = entry['byNameDirs']
         if digest in byNameDirs:
             return byNameDirs[digest]
         else:
-            num = byNameDirs.setdefault(baseDir, 0) + 1
+            num = byNameDirs.get(baseDir, 0) + 1
             res = "{}/{}".format(baseDir, num)
             byNameDirs[baseDir] = num
             byNameDirs[digest] = res
-            self.__save()
+            self.__put("jenkins", jenkins, entry)
+            self.__commit()
             return res
 
+    @__locked
     def getJenkinsConfig(self, name):
-        return copy.deepcopy(self.__jenkins[name]["config"])
+        return copy.deepcopy(self.__section("jenkins")[name]["config"])
 
+    @__locked
     def setJenkinsConfig(self, name, config):
-        self.__jenkins[name]["config"] = copy.deepcopy(config)
-        self.__save()
+        entry = self.__section("jenkins")[name]
+        entry["config"] = copy.deepcopy(config)
+        self.__put("jenkins", name, entry)
+        self.__commit()
 
+    @__locked
     def getJenkinsAllJobs(self, name):
-        return set(self.__jenkins[name]["jobs"].keys())
+        return set(self.__jobs(name).keys())
 
+    @__locked
     def addJenkinsJob(self, jenkins, job, jobConfig):
-        self.__jenkins[jenkins]["jobs"][job] = copy.deepcopy(jobConfig)
-        self.__save()
+        self.__putJenkinsJob(jenkins, job, copy.deepcopy(jobConfig))
+        self.__commit()
 
+    @__locked
     def delJenkinsJob(self, jenkins, job):
-        del self.__jenkins[jenkins]["jobs"][job]
-        self.__save()
+        self.__begin()
+        del self.__jobs(jenkins)[job]
+        self.__db.execute("DELETE FROM jenkinsJobs WHERE jenkins = ? AND job = ?",
+                          (jenkins, job))
+        self.__commit()
 
+    @__locked
     def getJenkinsJobConfig(self, jenkins, job):
-        return copy.deepcopy(self.__jenkins[jenkins]['jobs'][job])
+        return copy.deepcopy(self.__jobs(jenkins)[job])
 
+    @__locked
     def setJenkinsJobConfig(self, jenkins, job, jobConfig):
-        self.__jenkins[jenkins]['jobs'][job] = copy.deepcopy(jobConfig)
-        self.__save()
+        self.__putJenkinsJob(jenkins, job, copy.deepcopy(jobConfig))
+        self.__commit()
 
+    @__locked
     def setBuildState(self, digest2Dir):
-        self.__buildState = copy.deepcopy(digest2Dir)
-        self.__save()
+        self.__put("meta", "buildState", copy.deepcopy(digest2Dir))
+        self.__commit()
 
+    @__locked
     def getBuildState(self):
-        return copy.deepcopy(self.__buildState)
+        return copy.deepcopy(self.__section("meta").get("buildState", {}))
+
+    @__locked
+    def getStepDuration(self, variantId):
+        ret = self.__section("durations").get(variantId)
+        return ret[0] if isinstance(ret, tuple) else ret
+
+    @__locked
+    def getAllStepDurations(self):
+        return [ (d[0] if isinstance(d, tuple) else d)
+                 for d in self.__section("durations").values() ]
+
+    @__locked
+    def setStepDuration(self, variantId, duration):
+        self.__put("durations", variantId, (duration, time.time()))
+        self.__commit()
 
 def BobState():
     if _BobState.instance is None:
         _BobState.instance = _BobState()
     return _BobState.instance
-
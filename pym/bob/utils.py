@@ -16,13 +16,18 @@
 
 from .errors import BuildError
 from binascii import hexlify
+from concurrent.futures import Future, ThreadPoolExecutor
 from tempfile import NamedTemporaryFile
+import fnmatch
 import hashlib
 import logging
+import mmap
 import os
 import shutil
+import sqlite3
 import stat
 import struct
+import subprocess
 import sys
 
 def asHexStr(binary):
@@ -68,21 +73,151 @@ def compareVersion(left, right):
 
 ### directory hashing ###
 
-def hashFile(path):
-    m = hashlib.sha1()
+def hashFile(path, algorithm="sha1"):
+    m = hashlib.new(algorithm)
     try:
         with open(path, 'rb', buffering=0) as f:
-            buf = f.read(16384)
-            while len(buf) > 0:
-                m.update(buf)
-                buf = f.read(16384)
+            size = os.fstat(f.fileno()).st_size
+            if size < 65536:
+                buf = f.read(65536)
+                while len(buf) > 0:
+                    m.update(buf)
+                    buf = f.read(65536)
+            else:
+                _hashBigFile(m, f, size)
     except OSError as e:
         logging.getLogger(__name__).warning("Cannot hash file: %s", str(e))
     return m.digest()
 
+def _hashBigFile(m, f, size):
+    """Hash a big file without allocating a new buffer for every block.
+
+    The kernel is told that the file is read sequentially. Files that are
+    bigger than 16MiB are dropped from the page cache afterwards because they
+    would only push out more useful data.
+    """
+    fd = f.fileno()
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    buf = bytearray(min(size, 1 << 20))
+    view = memoryview(buf)
+    n = f.readinto(buf)
+    while n:
+        m.update(view[:n])
+        n = f.readinto(buf)
+    if hasattr(os, "posix_fadvise") and (size > 16 << 20):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
 def float2ns(v):
     return int(v * 1000000000)
 
+class GitObjectCache:
+    """Content digests of files that are unmodified in git checkouts.
+
+    Git keeps the object id of every tracked file in its index and "git
+    status" knows which of them were changed in the worktree. The digests of
+    all other tracked files are looked up by their object id and size in a
+    cache that is shared by all workspaces of the project. A file that was
+    already hashed once is thus not read again if it is checked out in
+    another workspace or again after switching branches.
+
+    Git is only asked when the first file of the workspace was not found in
+    the hash index. Files that git does not check for changes
+    (assume-unchanged, skip-worktree) are always hashed.
+    """
+
+    def __init__(self, cachePath, workspace, gitDirs, algorithm="sha1"):
+        self.__cachePath = cachePath
+        self.__workspace = workspace
+        self.__gitDirs = gitDirs
+        self.__algorithm = algorithm
+        self.__objects = None
+        self.__db = None
+        self.__learned = []
+
+    def __load(self):
+        self.__objects = {}
+        for d in self.__gitDirs:
+            try:
+                self.__objects.update(self.__listObjects(d))
+            except (OSError, subprocess.CalledProcessError) as e:
+                logging.getLogger(__name__).info(
+                    "Cannot query git in '%s': %s", d, str(e))
+        if not self.__objects: return
+        try:
+            self.__db = sqlite3.connect(self.__cachePath, timeout=60)
+            self.__db.execute("""CREATE TABLE IF NOT EXISTS objects (
+                algorithm, oid, size, digest, PRIMARY KEY (algorithm, oid, size))""")
+        except sqlite3.Error as e:
+            logging.getLogger(__name__).warning(
+                "Cannot open git object cache: %s", str(e))
+            self.__objects = {}
+            self.__db = None
+
+    def __listObjects(self, gitDir):
+        """Get the object ids of all unmodified files of a git checkout."""
+        cwd = os.path.join(self.__workspace, gitDir)
+        if not os.path.exists(os.path.join(cwd, ".git")): return {}
+        prefix = os.path.normpath(gitDir)
+        prefix = b'' if prefix == "." else os.fsencode(prefix)
+
+        ret = {}
+        files = subprocess.check_output(["git", "ls-files", "-s", "-v", "-z"],
+            cwd=cwd, stderr=subprocess.DEVNULL)
+        for f in files.split(b'\0'):
+            if not f: continue
+            (info, name) = f.split(b'\t', 1)
+            (tag, mode, oid, stage) = info.split(b' ')
+            if tag == b'H' and stage == b'0' and mode in (b'100644', b'100755'):
+                ret[os.path.join(prefix, name)] = oid
+
+        status = subprocess.check_output(["git", "status", "--porcelain", "-z",
+            "--untracked-files=no"], cwd=cwd, stderr=subprocess.DEVNULL)
+        status = iter(status.split(b'\0'))
+        for s in status:
+            if not s: continue
+            ret.pop(os.path.join(prefix, s[3:]), None)
+            # renames and copies are followed by the original name
+            if s[0:1] in (b'R', b'C'): next(status, None)
+        return ret
+
+    def check(self, name, st, path, process):
+        """Return the digest of file *name* or calculate it by *process*."""
+        if self.__objects is None: self.__load()
+        oid = self.__objects.get(name)
+        if oid is None: return process(path)
+        key = (self.__algorithm, oid, st.st_size)
+        row = self.__db.execute("SELECT digest FROM objects WHERE "
+            "algorithm=? AND oid=? AND size=?", key).fetchone()
+        if row is not None: return row[0]
+        digest = process(path)
+        self.__learned.append((key, digest))
+        return digest
+
+    def close(self, resolve=None):
+        """Store the digests of newly hashed objects.
+
+        Digests that are still calculated in the background are obtained
+        from *resolve*. Without it only the already known digests are stored.
+        """
+        if self.__db is None: return
+        if resolve is None:
+            resolve = lambda digest: digest if isinstance(digest, bytes) else None
+        try:
+            with self.__db:
+                for (key, digest) in self.__learned:
+                    digest = resolve(digest)
+                    if digest is None: continue
+                    self.__db.execute("INSERT OR REPLACE INTO objects VALUES "
+                        "(?, ?, ?, ?)", key + (digest,))
+        except sqlite3.Error as e:
+            logging.getLogger(__name__).warning(
+                "Cannot update git object cache: %s", str(e))
+        finally:
+            self.__db.close()
+            self.__db = None
+            self.__learned = []
+
 class DirHasher:
     IGNORE_DIRS = frozenset([
         os.fsencode(".git"),
@@ -94,107 +229,376 @@ class DirHasher:
     ])
 
     class FileIndex:
-        SIGNATURE        = b'BOB1'
-        CACHE_ENTRY_FMT  = '=QQLqLQ20sH'
-        CACHE_ENTRY_SIZE = struct.calcsize(CACHE_ENTRY_FMT)
-
-        class Stat:
-            def __init__(self):
-                self.name = b""
-                self.ctime = 0
-                self.mtime = 0
-                self.dev = 0
-                self.ino = 0
-                self.mode = 0
-                self.size = 0
-                self.digest = b''
-
-        def __init__(self, cachePath):
+        """Persistent cache of file and directory digests.
+
+        The index file starts with a header and the sorted tables of the
+        offsets of all file and directory records. The file is mapped into
+        memory and entries are looked up by binary search. Records of files
+        that have changed are updated in place. New entries are appended to a
+        log at the end of the file. Only if the log or the number of stale
+        entries has grown too large the whole index is rewritten in sorted
+        order.
+
+        The digest of a directory is stored together with a fingerprint of
+        the stat data of all entries below it. If the fingerprint is still
+        the same the whole subtree is unchanged and the digest can be reused.
+
+        The index is flagged as dirty while it is modified. A dirty index is
+        ignored and rebuilt from scratch. The same happens if the digests were
+        calculated with another algorithm than *algorithm* or for another hash
+        scope than *scope*.
+        """
+        SIGNATURE   = b'BOB3'
+        HEADER_FMT  = '=4sLLLQ16s20s'
+        HEADER_SIZE = struct.calcsize(HEADER_FMT)
+        LOG_FILE    = b'F'
+        LOG_DIR     = b'D'
+        FLAG_DIRTY  = 1
+
+        def __init__(self, cachePath, algorithm="sha1", scope=b''):
             self.__cachePath = cachePath
             self.__cacheDir = os.path.dirname(cachePath)
+            self.__algorithm = algorithm.encode("ascii")
+            self.__scope = scope.ljust(20, b'\0')
+            digestSize = hashlib.new(algorithm).digest_size
+            self.__fileFmt = '=QQLqLQ{}sH'.format(digestSize)
+            self.__fileSize = struct.calcsize(self.__fileFmt)
+            self.__dirFmt = '=20s{}sH'.format(digestSize)
+            self.__dirSize = struct.calcsize(self.__dirFmt)
 
         def open(self):
-            self.__inPos = 0
-            self.__inPosOld = 0
-            self.__outFile = None
+            self.__file = None
+            self.__map = None
+            self.__flags = 0
+            self.__files = 0
+            self.__filesPos = 0
+            self.__cursor = 0
+            self.__log = {}
+            self.__logEnd = 0
+            self.__dirs = {}
+            self.__tableDirs = 0
+            self.__appended = 0
+            self.__seen = bytearray()
+            self.__seenLog = set()
+            self.__seenDirs = {}
+            self.__keptTrees = []
+            self.__updates = []
+            self.__dirUpdates = []
+            self.__new = {}
+            self.__newDirs = {}
             try:
-                if os.path.exists(self.__cachePath):
-                    self.__inFile = open(self.__cachePath, "rb")
-                    sig = self.__inFile.read(4)
-                    if sig == DirHasher.FileIndex.SIGNATURE:
-                        self.__mismatch = False
-                        self.__inPos = self.__inPosOld = 4
-                    else:
-                        logging.getLogger(__name__).info(
-                            "Wrong signature at '%s': %s", self.__cachePath, sig)
-                        self.__inFile.close()
-                        self.__inFile = None
-                        self.__mismatch = True
-                else:
-                    self.__inFile = None
-                    self.__mismatch = True
+                self.__file = open(self.__cachePath, "r+b")
+                self.__load()
+            except FileNotFoundError:
+                pass
             except OSError as e:
+                self.__release()
                 raise BuildError("Error opening hash cache: " + str(e))
-            self.__current = DirHasher.FileIndex.Stat()
-
-        def close(self):
+            except (ValueError, struct.error):
+                logging.getLogger(__name__).info(
+                    "Corrupt hash cache at '%s'", self.__cachePath)
+                self.__release()
+
+        def __load(self):
+            header = self.__file.read(DirHasher.FileIndex.HEADER_SIZE)
+            if len(header) < DirHasher.FileIndex.HEADER_SIZE:
+                raise ValueError("truncated")
+            (sig, flags, files, dirs, logPos, algorithm, scope) = struct.unpack(
+                DirHasher.FileIndex.HEADER_FMT, header)
+            if sig != DirHasher.FileIndex.SIGNATURE:
+                raise ValueError("wrong signature")
+            if algorithm.rstrip(b'\0') != self.__algorithm:
+                raise ValueError("other algorithm")
+            if scope != self.__scope:
+                raise ValueError("other scope")
+            if flags & DirHasher.FileIndex.FLAG_DIRTY:
+                raise ValueError("dirty")
+
+            m = self.__map = mmap.mmap(self.__file.fileno(), 0)
+            self.__flags = flags
+            self.__files = files
+            self.__filesPos = DirHasher.FileIndex.HEADER_SIZE
+            self.__seen = bytearray(files)
+            self.__tableDirs = dirs
+            dirsPos = self.__filesPos + 8*files
+            for i in range(dirs):
+                (off,) = struct.unpack_from('=Q', m, dirsPos + 8*i)
+                self.__dirs[self.__recordName(off, self.__dirSize)] = off
+
+            # Replay log. A truncated record at the end is ignored.
+            pos = logPos
+            while pos < len(m):
+                kind = m[pos:pos+1]
+                if kind == DirHasher.FileIndex.LOG_FILE:
+                    (size, entries) = (self.__fileSize, self.__log)
+                elif kind == DirHasher.FileIndex.LOG_DIR:
+                    (size, entries) = (self.__dirSize, self.__dirs)
+                else:
+                    break
+                if pos + 1 + size > len(m): break
+                name = self.__recordName(pos + 1, size)
+                if pos + 1 + size + len(name) > len(m): break
+                entries[name] = pos + 1
+                self.__appended += 1
+                pos += 1 + size + len(name)
+            self.__logEnd = pos
+
+        def __release(self):
+            if self.__map is not None:
+                self.__map.close()
+                self.__map = None
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
+            self.__files = 0
+            self.__log = {}
+            self.__dirs = {}
+            self.__tableDirs = 0
+            self.__appended = 0
+
+        def close(self, resolve=None):
+            """Write back all changes.
+
+            Digests that are still calculated in the background are obtained
+            from *resolve*. Without it hashing was aborted. Only the already
+            known digests are stored then and the index is not compacted
+            because not all entries were visited.
+            """
+            complete = resolve is not None
+            if not complete:
+                resolve = lambda digest: digest if isinstance(digest, bytes) else None
             try:
-                if self.__inFile:
-                    self.__inFile.close()
-                if self.__outFile:
-                    self.__outFile.close()
-                    os.replace(self.__outFile.name, self.__cachePath)
+                updates = [ (off, fields, resolve(digest))
+                            for (off, fields, digest) in self.__updates ]
+                dirUpdates = [ (off, fingerprint, resolve(digest))
+                               for (off, fingerprint, digest) in self.__dirUpdates ]
+                new = sorted((name, (fields, resolve(digest)))
+                             for (name, (fields, digest)) in self.__new.items())
+                newDirs = sorted((name, (fingerprint, resolve(digest)))
+                                 for (name, (fingerprint, digest)) in self.__newDirs.items())
+
+                stale = ((self.__files - self.__seen.count(1)) +
+                         (len(self.__log) - len(self.__seenLog)) +
+                         sum(1 for name in self.__dirs if not self.__isSeenDir(name)))
+                appended = self.__appended + len(new) + len(newDirs)
+                if self.__map is None:
+                    self.__compact(new, newDirs)
+                elif complete and ((stale + appended) * 4 > self.__files + self.__tableDirs):
+                    self.__patch(updates, dirUpdates)
+                    self.__compact(new, newDirs)
+                else:
+                    self.__update(updates, dirUpdates, new, newDirs)
             except OSError as e:
                 raise BuildError("Error closing hash cache: " + str(e))
-
-        def __readEntry(self):
-            if not self.__inFile: return False
-            raw = self.__inFile.read(DirHasher.FileIndex.CACHE_ENTRY_SIZE)
-            if len(raw) < DirHasher.FileIndex.CACHE_ENTRY_SIZE: return False
-            e = self.__current
-            (e.ctime, e.mtime, e.dev, e.ino, e.mode, e.size, e.digest,
-                nameLen) = struct.unpack(DirHasher.FileIndex.CACHE_ENTRY_FMT, raw)
-            e.name = self.__inFile.read(nameLen)
-            self.__inPosOld = self.__inPos
-            self.__inPos += DirHasher.FileIndex.CACHE_ENTRY_SIZE + nameLen
-            return True
-
-        def __writeEntry(self, name, st, digest):
-            if not self.__outFile:
-                self.__outFile = NamedTemporaryFile(mode="wb", dir=self.__cacheDir, delete=False)
-                if self.__inFile:
-                    pos = self.__inFile.tell()
-                    self.__inFile.seek(0)
-                    self.__outFile.write(self.__inFile.read(self.__inPosOld))
-                    self.__inFile.seek(pos)
+            finally:
+                self.__release()
+
+        def __patch(self, updates, dirUpdates):
+            for (off, fields, digest) in updates:
+                if digest is None: continue
+                struct.pack_into(self.__fileFmt[:-1], self.__map, off,
+                                 *(fields + (digest,)))
+            for (off, fingerprint, digest) in dirUpdates:
+                if digest is None: continue
+                struct.pack_into(self.__dirFmt[:-1], self.__map, off,
+                                 fingerprint, digest)
+
+        def __update(self, updates, dirUpdates, new, newDirs):
+            """Update entries in place and append new entries to the log."""
+            new = [ e for e in new if e[1][1] is not None ]
+            newDirs = [ e for e in newDirs if e[1][1] is not None ]
+            if not (updates or dirUpdates or new or newDirs): return
+
+            self.__setFlags(self.__flags | DirHasher.FileIndex.FLAG_DIRTY)
+            self.__patch(updates, dirUpdates)
+            self.__map.flush()
+            if new or newDirs:
+                self.__file.seek(self.__logEnd)
+                for (name, (fields, digest)) in new:
+                    self.__file.write(DirHasher.FileIndex.LOG_FILE)
+                    self.__file.write(struct.pack(self.__fileFmt,
+                        *(fields + (digest, len(name)))))
+                    self.__file.write(name)
+                for (name, (fingerprint, digest)) in newDirs:
+                    self.__file.write(DirHasher.FileIndex.LOG_DIR)
+                    self.__file.write(struct.pack(self.__dirFmt,
+                        fingerprint, digest, len(name)))
+                    self.__file.write(name)
+                self.__file.truncate()
+                self.__file.flush()
+                os.fsync(self.__file.fileno())
+            self.__setFlags(self.__flags)
+
+        def __setFlags(self, flags):
+            header = list(struct.unpack_from(DirHasher.FileIndex.HEADER_FMT,
+                                             self.__map, 0))
+            header[1] = flags
+            struct.pack_into(DirHasher.FileIndex.HEADER_FMT, self.__map, 0, *header)
+            self.__map.flush(0, DirHasher.FileIndex.HEADER_SIZE)
+
+        def __compact(self, new, newDirs):
+            """Rewrite the index with all visited entries in sorted order."""
+            m = self.__map
+            files = {}
+            for i in range(self.__files):
+                if self.__seen[i]:
+                    off = self.__offset(i)
+                    files[self.__name(i)] = self.__readFile(off)
+            for name in self.__seenLog:
+                files[name] = self.__readFile(self.__log[name])
+            files.update((n, e) for (n, e) in new if e[1] is not None)
+            dirs = {}
+            for (name, off) in self.__dirs.items():
+                if self.__isSeenDir(name):
+                    dirs[name] = struct.unpack_from(self.__dirFmt, m, off)[:2]
+            dirs.update((n, e) for (n, e) in newDirs if e[1] is not None)
+
+            offsets = []
+            records = []
+            pos = DirHasher.FileIndex.HEADER_SIZE + 8 * (len(files) + len(dirs))
+            for name in sorted(files):
+                (fields, digest) = files[name]
+                records.append(struct.pack(self.__fileFmt,
+                    *(fields + (digest, len(name)))) + name)
+                offsets.append(pos)
+                pos += len(records[-1])
+            for name in sorted(dirs):
+                (fingerprint, digest) = dirs[name]
+                records.append(struct.pack(self.__dirFmt,
+                    fingerprint, digest, len(name)) + name)
+                offsets.append(pos)
+                pos += len(records[-1])
+
+            with NamedTemporaryFile(mode="wb", dir=self.__cacheDir, delete=False) as f:
+                f.write(struct.pack(DirHasher.FileIndex.HEADER_FMT,
+                    DirHasher.FileIndex.SIGNATURE, 0, len(files), len(dirs), pos,
+                    self.__algorithm, self.__scope))
+                f.write(struct.pack('={}Q'.format(len(offsets)), *offsets))
+                f.write(b''.join(records))
+            os.replace(f.name, self.__cachePath)
+
+        def __readFile(self, off):
+            e = struct.unpack_from(self.__fileFmt, self.__map, off)
+            return (e[:6], e[6])
+
+        def __recordName(self, off, size):
+            (nameLen,) = struct.unpack_from('=H', self.__map, off + size - 2)
+            return self.__map[off+size:off+size+nameLen]
+
+        def __offset(self, i):
+            return struct.unpack_from('=Q', self.__map, self.__filesPos + 8*i)[0]
+
+        def __name(self, i):
+            return self.__recordName(self.__offset(i), self.__fileSize)
+
+        def __bisect(self, name, lo, hi):
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.__name(mid) < name:
+                    lo = mid + 1
                 else:
-                    self.__outFile.write(DirHasher.FileIndex.SIGNATURE)
-            self.__outFile.write(struct.pack(DirHasher.FileIndex.CACHE_ENTRY_FMT, float2ns(st.st_ctime),
-                float2ns(st.st_mtime), st.st_dev, st.st_ino, st.st_mode, st.st_size,
-                digest, len(name)))
-            self.__outFile.write(name)
-
-        def __match(self, name, st):
-            while self.__current.name < name:
-                if not self.__readEntry(): break
-            e = self.__current
-            res = ((e.name == name) and (e.ctime == float2ns(st.st_ctime)) and
-                (e.mtime == float2ns(st.st_mtime)) and (e.dev == st.st_dev) and
-                (e.ino == st.st_ino) and (e.mode == st.st_mode) and
-                (e.size == st.st_size))
-            #if not res: print("Mismatch", e.name, name)
-            return res
+                    hi = mid
+            return lo
+
+        def __find(self, name):
+            """Return index of the first file entry that is not less than name.
+
+            The directories are hashed in sorted order. The search thus starts
+            at the previous position and gallops forward.
+            """
+            n = self.__files
+            i = self.__cursor
+            if (i >= n) or (self.__name(i) >= name):
+                if (i > 0) and (self.__name(i-1) >= name):
+                    i = self.__bisect(name, 0, i-1)
+            else:
+                lo = i + 1
+                step = 1
+                while (lo + step <= n) and (self.__name(lo + step - 1) < name):
+                    lo += step
+                    step *= 2
+                i = self.__bisect(name, lo, min(lo + step, n))
+            self.__cursor = i
+            return i
+
+        @staticmethod
+        def __fields(st):
+            return (float2ns(st.st_ctime), float2ns(st.st_mtime), st.st_dev,
+                    st.st_ino, st.st_mode, st.st_size)
+
+        def __lookup(self, name):
+            if self.__files:
+                i = self.__find(name)
+                if (i < self.__files) and (self.__name(i) == name):
+                    self.__seen[i] = 1
+                    return self.__offset(i)
+            off = self.__log.get(name)
+            if off is not None: self.__seenLog.add(name)
+            return off
 
         def check(self, prefix, name, st, process):
-            if self.__match(name, st):
-                digest = self.__current.digest
+            fields = DirHasher.FileIndex.__fields(st)
+            off = self.__lookup(name)
+            if off is not None:
+                (old, digest) = self.__readFile(off)
+                if old == fields: return digest
+                digest = process(os.path.join(prefix, name))
+                self.__updates.append((off, fields, digest))
             else:
                 digest = process(os.path.join(prefix, name))
-                self.__mismatch = True
-            if self.__mismatch:
-                self.__writeEntry(name, st, digest)
+                self.__new[name] = (fields, digest)
             return digest
 
+        def skip(self, prefix):
+            """Keep all entries below prefix as they are."""
+            if self.__files:
+                lo = self.__find(prefix)
+                if prefix:
+                    hi = self.__bisect(prefix[:-1] + bytes([prefix[-1] + 1]), lo,
+                                       self.__files)
+                else:
+                    hi = self.__files
+                self.__seen[lo:hi] = b'\x01' * (hi - lo)
+                self.__cursor = hi
+            self.__seenLog.update(n for n in self.__log if n.startswith(prefix))
+
+        def getDir(self, name, fingerprint):
+            """Register directory and return its digest if it is unchanged."""
+            self.__seenDirs[name] = fingerprint
+            off = self.__dirs.get(name)
+            if off is not None:
+                (oldFingerprint, digest, nameLen) = struct.unpack_from(
+                    self.__dirFmt, self.__map, off)
+                if oldFingerprint == fingerprint: return digest
+            return None
+
+        def keepDir(self, name, fingerprint):
+            """Register directory of an unchanged subtree."""
+            self.__seenDirs[name] = fingerprint
+
+        def trustDir(self, name):
+            """Register the whole subtree of a directory that is known to be
+            unchanged and return its fingerprint.
+
+            Returns None if the directory is not in the index.
+            """
+            off = self.__dirs.get(name)
+            if off is None: return None
+            fingerprint = struct.unpack_from(self.__dirFmt, self.__map, off)[0]
+            self.__seenDirs[name] = fingerprint
+            self.__keptTrees.append(os.path.join(name, b''))
+            return fingerprint
+
+        def __isSeenDir(self, name):
+            return (name in self.__seenDirs) or name.startswith(tuple(self.__keptTrees))
+
+        def setDir(self, name, digest):
+            off = self.__dirs.get(name)
+            if off is not None:
+                self.__dirUpdates.append((off, self.__seenDirs[name], digest))
+            else:
+                self.__newDirs[name] = (self.__seenDirs[name], digest)
+
     class NullIndex:
         def __init__(self):
             pass
@@ -202,25 +606,70 @@ class DirHasher:
         def open(self):
             pass
 
-        def close(self):
+        def close(self, resolve=None):
             pass
 
         def check(self, prefix, name, st, process):
             return process(os.path.join(prefix, name))
 
-    def __init__(self, basePath=None):
+        def skip(self, prefix):
+            pass
+
+        def getDir(self, name, fingerprint):
+            return None
+
+        def keepDir(self, name, fingerprint):
+            pass
+
+        def trustDir(self, name):
+            return None
+
+        def setDir(self, name, digest):
+            pass
+
+    def __init__(self, basePath=None, workers=1, algorithm="sha1", include=None,
+                 exclude=None):
+        self.__include = [ os.fsencode(p) for p in include ] if include else None
+        self.__exclude = [ os.fsencode(p) for p in exclude ] if exclude else []
+        if self.__include is not None or self.__exclude:
+            scope = hashlib.sha1(repr((self.__include, self.__exclude)).encode("ascii")).digest()
+        else:
+            scope = b''
         if basePath:
-            self.__index = DirHasher.FileIndex(basePath)
+            self.__index = DirHasher.FileIndex(basePath, algorithm, scope)
+            self.__dirCache = True
         else:
             self.__index = DirHasher.NullIndex()
+            self.__dirCache = False
+        self.__workers = workers
+        self.__algorithm = algorithm
+        self.__journal = None
+        self.__objects = None
+        self.__executor = None
+        self.__inodes = {}
+
+    def __hashFile(self, path):
+        if self.__executor is None:
+            return hashFile(path, self.__algorithm)
+        else:
+            return self.__executor.submit(hashFile, path, self.__algorithm)
 
-    def __hashEntry(self, prefix, entry, file, s):
+    def __hashEntry(self, prefix, entry, file, s, sub):
         if stat.S_ISREG(s.st_mode):
-            digest = self.__index.check(prefix, entry, s, hashFile)
+            # Hard linked files are only read once per run.
+            inode = (s.st_dev, s.st_ino)
+            digest = self.__inodes.get(inode)
+            if digest is not None:
+                digest = self.__index.check(prefix, entry, s, lambda path: digest)
+            else:
+                process = self.__hashFile if self.__objects is None else \
+                    (lambda path: self.__objects.check(entry, s, path, self.__hashFile))
+                digest = self.__index.check(prefix, entry, s, process)
+                if s.st_nlink > 1: self.__inodes[inode] = digest
         elif stat.S_ISDIR(s.st_mode):
-            digest = self.__hashDir(prefix, entry)
+            digest = self.__hashDir(prefix, entry, sub)
         elif stat.S_ISLNK(s.st_mode):
-            digest = self.__index.check(prefix, entry, s, DirHasher.__hashLink)
+            digest = self.__index.check(prefix, entry, s, self.__hashLink)
         elif stat.S_ISBLK(s.st_mode) or stat.S_ISCHR(s.st_mode):
             digest = struct.pack("<L", s.st_rdev)
         elif stat.S_ISFIFO(s.st_mode):
@@ -229,27 +678,67 @@ class DirHasher:
             digest = b''
             logging.getLogger(__name__).warning("Unknown file: %s", entry)
 
-        return struct.pack("=L", s.st_mode) + digest + file
+        return (struct.pack("=L", s.st_mode), digest, file)
 
-    @staticmethod
-    def __hashLink(path):
-        m = hashlib.sha1()
+    def __hashLink(self, path):
+        m = hashlib.new(self.__algorithm)
         try:
             m.update(os.readlink(path))
         except OSError as e:
             logging.getLogger(__name__).warning("Cannot hash link: %s", str(e))
         return m.digest()
 
-    def __hashDir(self, prefix, path=b''):
+    @staticmethod
+    def __listDir(path):
+        """Get list of (name, isDir) tuples of a directory.
+
+        Where available the type is taken from the directory entry. Otherwise
+        isDir is None and the entry must be stat'ed.
+        """
+        if not hasattr(os, "scandir"):
+            return [ (f, None) for f in os.listdir(path) ]
+        ret = []
+        for e in os.scandir(path):
+            try:
+                ret.append((e.name, e.is_dir(follow_symlinks=False)))
+            except OSError:
+                ret.append((e.name, None))
+        return ret
+
+    @staticmethod
+    def __matches(patterns, path, name):
+        """Check if any pattern matches. Patterns without a slash are matched
+        against the name of an entry, all others against its whole path."""
+        return any(fnmatch.fnmatchcase(path if b'/' in p else name, p)
+                   for p in patterns)
+
+    def __scanDir(self, prefix, path=b'', included=True):
+        """Stat the whole tree.
+
+        Returns the sorted list of (entry, file, stat, subtree) tuples and the
+        fingerprint of the stat data of the whole tree if a directory cache is
+        used. Directories that are clean according to the journal are not
+        scanned if their fingerprint is known. Their list of entries is None.
+
+        Excluded entries are skipped. Unless the directory is *included* as a
+        whole only matching entries and directories that contain some are
+        kept.
+        """
         entries = []
         try:
-            dirEntries = os.listdir(os.path.join(prefix, path if path else b'.'))
+            dirEntries = DirHasher.__listDir(os.path.join(prefix, path if path else b'.'))
         except OSError as e:
             logging.getLogger(__name__).warning("Cannot list directory: %s", str(e))
             dirEntries = []
 
-        for f in dirEntries:
+        for (f, isDir) in dirEntries:
+            # skip useless entries before stat'ing them
+            if isDir is not None:
+                if f in (DirHasher.IGNORE_DIRS if isDir else DirHasher.IGNORE_FILES):
+                    continue
             e = os.path.join(path, f)
+            if self.__exclude and DirHasher.__matches(self.__exclude, e, f):
+                continue
             try:
                 s = os.lstat(os.path.join(prefix, e))
                 if stat.S_ISDIR(s.st_mode):
@@ -264,21 +753,117 @@ class DirHasher:
             except OSError as err:
                 logging.getLogger(__name__).warning("Cannot stat '%s': %s", e, str(err))
         entries = sorted(entries, key=lambda x: x[1])
-        dirList = [ self.__hashEntry(prefix, e, f, s) for (e, f, s) in entries ]
-        dirBlob = b"".join(dirList)
-        m = hashlib.sha1()
-        m.update(dirBlob)
+
+        ret = []
+        m = hashlib.sha1() if self.__dirCache else None
+        for (e, f, s) in entries:
+            inc = included or DirHasher.__matches(self.__include, e, os.path.basename(e))
+            if stat.S_ISDIR(s.st_mode):
+                sub = self.__trustDir(e) or self.__scanDir(prefix, e, inc)
+                if not inc and sub[0] == []: continue
+            elif inc:
+                sub = None
+            else:
+                continue
+            ret.append((e, f, s, sub))
+            if m is None: continue
+            m.update(f + b'\0' + struct.pack('=QQLqLQL', float2ns(s.st_ctime),
+                float2ns(s.st_mtime), s.st_dev, s.st_ino, s.st_mode, s.st_size,
+                s.st_rdev if (stat.S_ISBLK(s.st_mode) or stat.S_ISCHR(s.st_mode)) else 0))
+            if sub is not None: m.update(sub[1])
+        return (ret, m.digest() if m is not None else None)
+
+    def __trustDir(self, path):
+        if (self.__journal is None) or not self.__journal.isClean(path): return None
+        fingerprint = self.__index.trustDir(path)
+        return None if fingerprint is None else (None, fingerprint)
+
+    def __keepDir(self, path, scan):
+        (entries, fingerprint) = scan
+        if entries is None: return # registered by trustDir()
+        self.__index.keepDir(path, fingerprint)
+        for (e, f, s, sub) in entries:
+            if sub is not None: self.__keepDir(e, sub)
+
+    def __hashDir(self, prefix, path, scan):
+        (entries, fingerprint) = scan
+        if self.__dirCache:
+            digest = self.__index.getDir(path, fingerprint)
+            if digest is not None:
+                for (e, f, s, sub) in (entries or []):
+                    if sub is not None: self.__keepDir(e, sub)
+                self.__index.skip(os.path.join(path, b''))
+                return digest
+
+        dirList = [ self.__hashEntry(prefix, e, f, s, sub) for (e, f, s, sub) in entries ]
+        if self.__executor is None:
+            digest = self.__digest(dirList)
+        else:
+            # file digests are not known yet
+            digest = dirList
+        if self.__dirCache: self.__index.setDir(path, digest)
+        return digest
+
+    def __digest(self, dirList):
+        m = hashlib.new(self.__algorithm)
+        for (mode, d, file) in dirList:
+            m.update(mode + self.__resolve(d) + file)
         return m.digest()
 
-    def hashDirectory(self, path):
+    def __resolve(self, digest):
+        """Calculate the final digest of files that are hashed in parallel.
+
+        Directories are represented by the list of their entries until all
+        files have been hashed.
+        """
+        if isinstance(digest, list):
+            # The list is kept alive in the memo so that its id stays unique.
+            ret = self.__resolved.get(id(digest))
+            if ret is None:
+                ret = self.__resolved[id(digest)] = (digest, self.__digest(digest))
+            return ret[1]
+        elif isinstance(digest, Future):
+            return digest.result()
+        else:
+            return digest
+
+    def hashDirectory(self, path, journal=None, objects=None):
+        """Calculate the digest of a directory.
+
+        If a :class:`bob.watcher.Journal` of the directory is given the digests
+        of clean subtrees are taken from the index without looking at them.
+        Files that are not in the index are looked up in the
+        :class:`GitObjectCache` *objects* before they are read.
+        """
+        self.__inodes = {}
+        self.__resolved = {}
+        self.__journal = journal
+        self.__objects = objects
+        if self.__workers > 1:
+            self.__executor = ThreadPoolExecutor(self.__workers)
+        path = os.fsencode(path)
         self.__index.open()
         try:
-            return self.__hashDir(os.fsencode(path))
-        finally:
+            scan = self.__trustDir(b'') or self.__scanDir(path, b'',
+                                                          self.__include is None)
+            ret = self.__resolve(self.__hashDir(path, b'', scan))
+        except BaseException:
             self.__index.close()
-
-def hashDirectory(path, index=None):
-    return DirHasher(index).hashDirectory(path)
+            if objects is not None: objects.close()
+            raise
+        finally:
+            if self.__executor is not None:
+                self.__executor.shutdown()
+                self.__executor = None
+            self.__objects = None
+        if objects is not None: objects.close(self.__resolve)
+        self.__index.close(self.__resolve)
+        return ret
+
+def hashDirectory(path, index=None, workers=1, algorithm="sha1", journal=None,
+                  objects=None, include=None, exclude=None):
+    return DirHasher(index, workers, algorithm, include, exclude).hashDirectory(
+        path, journal, objects)
 
 def binLstat(path):
     st = os.lstat(path)
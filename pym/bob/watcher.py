@@ -0,0 +1,392 @@
+# Bob build tool
+# Copyright (C) 2016  TechniSat Digital GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from .utils import DirHasher
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import json
+import logging
+import os
+import select
+import socket
+import stat
+import struct
+import subprocess
+import sys
+import time
+
+WATCH_DIR = ".bob-watch"
+SOCKET = os.path.join(WATCH_DIR, "sock")
+
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR       = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+    IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+class _Inotify:
+    EVENT_FMT  = '=iIII'
+    EVENT_SIZE = struct.calcsize(EVENT_FMT)
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.__addWatch = libc.inotify_add_watch
+        self.__addWatch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.__rmWatch = libc.inotify_rm_watch
+        self.__rmWatch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0: _Inotify.__error()
+
+    @staticmethod
+    def __error(path=None):
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), path)
+
+    def addWatch(self, path, mask):
+        wd = self.__addWatch(self.fd, path, mask)
+        if wd < 0: _Inotify.__error(path)
+        return wd
+
+    def rmWatch(self, wd):
+        self.__rmWatch(self.fd, wd)
+
+    def read(self):
+        """Return list of pending (wd, mask, name) events."""
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        ret = []
+        pos = 0
+        while pos + _Inotify.EVENT_SIZE <= len(data):
+            (wd, mask, cookie, length) = struct.unpack_from(_Inotify.EVENT_FMT, data, pos)
+            pos += _Inotify.EVENT_SIZE
+            ret.append((wd, mask, data[pos:pos+length].rstrip(b'\0')))
+            pos += length
+        return ret
+
+class _Workspace:
+    def __init__(self, path, gen):
+        self.path = path
+        self.unknown = gen
+        self.broken = False
+        self.dirty = {}
+        self.watches = {}
+
+class Watcher:
+    """Record the changed directories of workspaces.
+
+    The watcher runs as daemon in the project root. Bob asks it with a "sync"
+    request for the changes of a workspace. Unknown workspaces are watched
+    from then on but all changes before are unknown. Otherwise the watcher
+    creates a cookie file and waits for its event. Because all events are
+    delivered in order, every change that happened before the request is
+    known at this point. The reply holds all directories that were changed
+    since the last "ack" request of the workspace. Changes are tagged with the
+    generation of the sync request that reported them first. They are only
+    forgotten when Bob acknowledges that it has hashed the workspace
+    successfully with this generation.
+
+    If the kernel event queue overflows or not all directories could be
+    watched the changes of the affected workspaces are unknown again.
+    """
+
+    IDLE_TIMEOUT = 24 * 60 * 60
+
+    def __init__(self):
+        self.__inotify = _Inotify()
+        self.__gen = 1
+        self.__workspaces = {}
+        self.__wds = {}
+        self.__cookies = {}
+        self.__cookieSeq = 0
+        self.__clients = {}
+        self.__cookieWd = self.__inotify.addWatch(os.fsencode(WATCH_DIR),
+                                                  IN_CREATE | IN_ONLYDIR)
+        if os.path.exists(SOCKET): os.unlink(SOCKET)
+        self.__server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.__server.bind(SOCKET)
+        self.__server.listen(16)
+
+    def run(self):
+        lastRequest = time.time()
+        while True:
+            timeout = lastRequest + Watcher.IDLE_TIMEOUT - time.time()
+            if (timeout <= 0) and not self.__clients: break
+            (r, w, x) = select.select([self.__inotify.fd, self.__server] +
+                                      list(self.__clients), [], [], max(timeout, 1))
+            for s in r:
+                if s == self.__inotify.fd:
+                    self.__events()
+                elif s is self.__server:
+                    (conn, addr) = self.__server.accept()
+                    self.__clients[conn] = b''
+                else:
+                    self.__receive(s)
+                    lastRequest = time.time()
+        self.__server.close()
+        os.unlink(SOCKET)
+
+    def __receive(self, conn):
+        try:
+            data = conn.recv(65536)
+            if not data:
+                self.__close(conn)
+                return
+            buf = self.__clients[conn] + data
+            while b'\n' in buf:
+                (line, buf) = buf.split(b'\n', 1)
+                self.__request(conn, json.loads(line.decode("utf8")))
+            self.__clients[conn] = buf
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.getLogger(__name__).warning("Bad request: %s", str(e))
+            self.__close(conn)
+
+    def __close(self, conn):
+        self.__clients.pop(conn, None)
+        conn.close()
+
+    @staticmethod
+    def __reply(conn, reply):
+        try:
+            conn.sendall(json.dumps(reply).encode("utf8") + b'\n')
+        except OSError:
+            pass
+
+    def __request(self, conn, req):
+        op = req["op"]
+        if op == "ping":
+            Watcher.__reply(conn, {})
+        elif op == "sync":
+            path = os.fsencode(os.path.normpath(req["path"]))
+            if path in self.__workspaces:
+                self.__cookieSeq += 1
+                name = "cookie.{}".format(self.__cookieSeq)
+                self.__cookies[os.fsencode(name)] = (conn, path)
+                open(os.path.join(WATCH_DIR, name), "wb").close()
+            else:
+                self.__register(conn, path)
+        elif op == "ack":
+            ws = self.__workspaces.get(os.fsencode(os.path.normpath(req["path"])))
+            gen = req["gen"]
+            if ws is not None:
+                ws.dirty = { d : g for (d, g) in ws.dirty.items() if g > gen }
+                if (ws.unknown is not None) and (ws.unknown <= gen) and not ws.broken:
+                    ws.unknown = None
+            Watcher.__reply(conn, {})
+        else:
+            raise ValueError("invalid operation: " + op)
+
+    def __register(self, conn, path):
+        ws = _Workspace(path, self.__gen)
+        self.__watch(ws, b'')
+        if b'' in ws.watches:
+            self.__workspaces[path] = ws
+        else:
+            # Nothing to watch (yet). Do not keep the workspace because
+            # changes after its creation would go unnoticed.
+            self.__unwatch(ws, b'')
+        self.__sync(conn, ws)
+
+    def __sync(self, conn, ws):
+        Watcher.__reply(conn, {
+            "gen" : self.__gen,
+            "unknown" : ws.unknown is not None,
+            "dirty" : [ os.fsdecode(d) for d in ws.dirty ],
+        })
+        self.__gen += 1
+
+    def __watch(self, ws, d):
+        """Watch directory and all directories below it."""
+        path = os.path.join(ws.path, d) if d else ws.path
+        try:
+            wd = self.__inotify.addWatch(path, WATCH_MASK)
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                logging.getLogger(__name__).warning("Cannot watch '%s': %s",
+                                                    os.fsdecode(path), str(e))
+                if ws.unknown is None: ws.unknown = self.__gen
+                ws.broken = True
+            return
+        self.__wds[wd] = (ws, d)
+        ws.watches[d] = wd
+        ws.dirty[d] = self.__gen
+        try:
+            names = os.listdir(path)
+        except OSError:
+            return
+        for name in names:
+            if name in DirHasher.IGNORE_DIRS: continue
+            try:
+                if stat.S_ISDIR(os.lstat(os.path.join(path, name)).st_mode):
+                    self.__watch(ws, os.path.join(d, name))
+            except OSError:
+                pass
+
+    def __unwatch(self, ws, d):
+        """Stop watching directory and all directories below it."""
+        prefix = os.path.join(d, b'')
+        for sub in [ s for s in ws.watches if (s == d) or s.startswith(prefix) ]:
+            wd = ws.watches.pop(sub)
+            del self.__wds[wd]
+            self.__inotify.rmWatch(wd)
+
+    def __drop(self, ws):
+        self.__unwatch(ws, b'')
+        del self.__workspaces[ws.path]
+
+    def __events(self):
+        for (wd, mask, name) in self.__inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                self.__overflow()
+            elif wd == self.__cookieWd:
+                if mask & IN_CREATE: self.__cookie(name)
+            elif wd in self.__wds:
+                (ws, d) = self.__wds[wd]
+                if mask & IN_IGNORED:
+                    del self.__wds[wd]
+                    if ws.watches.get(d) == wd: del ws.watches[d]
+                elif mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    # Only the workspace itself is handled here. Everything
+                    # else is covered by the event of the parent directory.
+                    if d == b'': self.__drop(ws)
+                else:
+                    ws.dirty[d] = self.__gen
+                    if (mask & IN_ISDIR) and name:
+                        sub = os.path.join(d, name)
+                        if mask & IN_MOVED_FROM:
+                            self.__unwatch(ws, sub)
+                        elif mask & (IN_CREATE | IN_MOVED_TO):
+                            self.__unwatch(ws, sub)
+                            self.__watch(ws, sub)
+
+    def __cookie(self, name):
+        if name not in self.__cookies: return
+        try:
+            os.unlink(os.path.join(os.fsencode(WATCH_DIR), name))
+        except OSError:
+            pass
+        (conn, path) = self.__cookies.pop(name)
+        ws = self.__workspaces.get(path)
+        if ws is None:
+            self.__register(conn, path)
+        else:
+            self.__sync(conn, ws)
+
+    def __overflow(self):
+        """Events were lost. Start over with all workspaces."""
+        logging.getLogger(__name__).warning("Event queue overflow")
+        for ws in list(self.__workspaces.values()): self.__drop(ws)
+        cookies = self.__cookies
+        self.__cookies = {}
+        for (conn, path) in cookies.values(): self.__register(conn, path)
+
+class Journal:
+    """Changes of a workspace since it was hashed the last time.
+
+    A directory is clean if neither it nor anything below it was changed. If
+    the changes are not known nothing is clean.
+    """
+
+    def __init__(self, workspace, gen, dirty):
+        self.__workspace = workspace
+        self.__gen = gen
+        if dirty is None:
+            self.__touched = None
+        else:
+            self.__touched = set()
+            for d in dirty:
+                while d not in self.__touched:
+                    self.__touched.add(d)
+                    d = os.path.dirname(d)
+
+    def isClean(self, path):
+        return (self.__touched is not None) and (path not in self.__touched)
+
+    def commit(self):
+        """Tell the watcher that the workspace was hashed successfully."""
+        _request({ "op" : "ack", "path" : self.__workspace, "gen" : self.__gen })
+
+def _request(req, timeout=10):
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(timeout)
+            s.connect(SOCKET)
+            s.sendall(json.dumps(req).encode("utf8") + b'\n')
+            buf = []
+            while not buf or not buf[-1].endswith(b'\n'):
+                data = s.recv(65536)
+                if not data: return None
+                buf.append(data)
+            return json.loads(b''.join(buf).decode("utf8"))
+    except (OSError, ValueError):
+        return None
+
+def getJournal(workspace):
+    """Get the changes of a workspace from the watcher of the project.
+
+    Returns None if no watcher is running in the current directory.
+    """
+    reply = _request({ "op" : "sync", "path" : workspace })
+    if reply is None: return None
+    return Journal(workspace, reply["gen"], None if reply["unknown"]
+                   else [ os.fsencode(d) for d in reply["dirty"] ])
+
+def startWatcher():
+    """Start the watcher in the current directory unless it is running.
+
+    Returns True if the watcher is available.
+    """
+    if _request({ "op" : "ping" }, 1) is not None: return True
+    pym = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.Popen([sys.executable, "-c",
+        "import sys; sys.path.insert(0, {!r}); from bob.watcher import main; sys.exit(main())"
+            .format(pym)],
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL, start_new_session=True)
+    for i in range(100):
+        if _request({ "op" : "ping" }, 1) is not None: return True
+        time.sleep(0.05)
+    return False
+
+def main():
+    os.makedirs(WATCH_DIR, mode=0o700, exist_ok=True)
+    with open(os.path.join(WATCH_DIR, "lock"), "w") as lock:
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            # another watcher is already running
+            return 0
+        try:
+            watcher = Watcher()
+        except (OSError, AttributeError) as e:
+            logging.getLogger(__name__).error("Cannot start watcher: %s", str(e))
+            return 1
+        watcher.run()
+    return 0
@@ -38,6 +38,14 @@ run_blackbox_test()
 		RES=$(sed -ne '/^Build result is in/s/.* //p' log.txt)
 		diff -Nurp $RES output
 
+		run_bob build -j 4 -f root > log.txt
+		RES=$(sed -ne '/^Build result is in/s/.* //p' log.txt)
+		diff -Nurp $RES output
+
+		run_bob build -j 4 -n -f root > log.txt
+		RES=$(sed -ne '/^Build result is in/s/.* //p' log.txt)
+		diff -Nurp $RES output
+
 		run_bob clean
 	)
 
@@ -0,0 +1,478 @@
+# Bob build tool
+# Copyright (C) 2016  Jan Klötzke
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import datetime
+from io import StringIO
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+import fcntl
+import os
+import shutil
+import threading
+
+from bob.cmds.build import LocalBuilder, UploadQueue
+from bob.errors import BuildError
+from bob.input import RecipeSet, walkPackagePath
+from bob.scheduler import Scheduler
+from bob.state import BobState, _BobState
+
+BOB_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class FakeArchive:
+    """Archive that keeps the name.txt file of each package in memory.
+
+    Uploads wait until *gate* is set. Packages in *broken* cannot be uploaded.
+    The names of the requested downloads are recorded in *downloaded*.
+    """
+
+    def __init__(self, broken=set()):
+        self.gate = threading.Event()
+        self.gate.set()
+        self.started = threading.Semaphore(0)
+        self.broken = broken
+        self.uploaded = []
+        self.downloaded = []
+        self.names = {}
+        self.packages = {}
+        self.lock = threading.Lock()
+
+    def uploadPackage(self, buildId, path):
+        self.started.release()
+        self.gate.wait()
+        with open(os.path.join(path, "name.txt")) as f:
+            name = f.read().strip()
+        if name in self.broken:
+            raise BuildError("Cannot upload " + name)
+        with self.lock:
+            self.uploaded.append(name)
+            self.names[buildId] = name
+            self.packages[buildId] = name
+
+    def downloadPackage(self, buildId, path):
+        with self.lock:
+            self.downloaded.append(self.names.get(buildId))
+            name = self.packages.get(buildId)
+        if name is None: return False
+        with open(os.path.join(path, "name.txt"), "w") as f:
+            f.write(name + "\n")
+        return True
+
+    def remove(self, *names):
+        self.packages = { buildId : name for (buildId, name) in self.packages.items()
+                          if name not in names }
+
+class BuildTestCase(TestCase):
+    """Build recipes of a temporary project in release mode.
+
+    Every script appends its name to the "log" file of the project. The
+    project directory is available as {DIR} in the recipes.
+    """
+
+    def setUp(self):
+        self.oldCwd = os.getcwd()
+        self.tmp = TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        os.makedirs("recipes")
+        _BobState.instance = None
+
+    def tearDown(self):
+        _BobState.instance = None
+        os.chdir(self.oldCwd)
+        self.tmp.cleanup()
+
+    def writeRecipe(self, name, recipe):
+        with open(os.path.join("recipes", name + ".yaml"), "w") as f:
+            f.write(recipe.format(LOG=os.path.join(self.tmp.name, "log"),
+                                  DIR=self.tmp.name))
+
+    def write(self, name, content):
+        with open(name, "w") as f:
+            f.write(content)
+
+    def readLog(self):
+        if not os.path.exists("log"): return []
+        with open("log") as f:
+            ret = f.read().split()
+        os.unlink("log")
+        return ret
+
+    def makeBuilder(self, force=False, skipDeps=False, jobs=1, **kwargs):
+        recipes = RecipeSet()
+        recipes.defineHook('releaseNameFormatter', LocalBuilder.releaseNameFormatter)
+        recipes.parse()
+        nameFormatter = recipes.getHook('releaseNameFormatter')
+        nameFormatter = LocalBuilder.releaseNamePersister(nameFormatter)
+        nameFormatter = LocalBuilder.makeRunnable(nameFormatter)
+        self.packages = recipes.generatePackages(nameFormatter, {}, False)
+        return LocalBuilder(recipes, -2, force, skipDeps, False, False, set(),
+                            BOB_ROOT, True, jobs, **kwargs)
+
+    def cook(self, builder, *paths):
+        steps = [ walkPackagePath(self.packages, p).getPackageStep() for p in paths ]
+        with patch("sys.stdout", new=StringIO()):
+            return builder.cook(steps)
+
+    def build(self, *paths, **kwargs):
+        hashBuilds = kwargs.pop("hashBuilds", False)
+        builder = self.makeBuilder(**kwargs)
+        builder.setHashBuilds(hashBuilds)
+        return self.cook(builder, *paths)
+
+class TestHashBuilds(BuildTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # Only the first word of the source ends up in the build result.
+        self.write("src.txt", "A 1\n")
+        self.writeRecipe("root", """
+root: True
+checkoutScript: |
+    cp {DIR}/src.txt .
+buildScript: |
+    echo build >> {LOG}
+    cut -d ' ' -f 1 $1/src.txt > out.txt
+packageScript: |
+    echo package >> {LOG}
+    cp $1/out.txt .
+""")
+
+    def testTimestamp(self):
+        """Without --hash-builds a rebuilt build step always repackages"""
+        self.build("root")
+        assert self.readLog() == ["build", "package"]
+        assert isinstance(BobState().getResultHash("work/root/build/1/workspace"),
+                          datetime)
+
+        self.write("src.txt", "A 2\n")
+        self.build("root")
+        assert self.readLog() == ["build", "package"]
+
+    def testHashBuilds(self):
+        """An unchanged build result does not repackage"""
+        self.build("root", hashBuilds=True)
+        assert self.readLog() == ["build", "package"]
+        result = BobState().getResultHash("work/root/build/1/workspace")
+        assert isinstance(result, bytes)
+
+        self.build("root", hashBuilds=True)
+        assert self.readLog() == []
+
+        self.write("src.txt", "A 2\n")
+        self.build("root", hashBuilds=True)
+        assert self.readLog() == ["build"]
+        assert BobState().getResultHash("work/root/build/1/workspace") == result
+        with open("work/root/dist/1/workspace/out.txt") as f:
+            assert f.read() == "A\n"
+
+    def testHashBuildsChanged(self):
+        """A changed build result is packaged again"""
+        self.build("root", hashBuilds=True)
+        assert self.readLog() == ["build", "package"]
+        self.write("src.txt", "B 1\n")
+        self.build("root", hashBuilds=True)
+        assert self.readLog() == ["build", "package"]
+        with open("work/root/dist/1/workspace/out.txt") as f:
+            assert f.read() == "B\n"
+
+class TestAsyncHash(BuildTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.writeRecipe("root", """
+root: True
+depends: [lib]
+buildScript: |
+    echo root-build >> {LOG}
+    cp $2/lib.txt .
+packageScript: |
+    echo root-package >> {LOG}
+    cp $1/lib.txt .
+""")
+        self.writeRecipe("lib", """
+packageScript: |
+    echo lib-package >> {LOG}
+    echo lib > lib.txt
+""")
+
+    def testForceTwice(self):
+        """A package that is requested again is hashed and recorded"""
+        self.build("root")
+        assert self.readLog() == ["lib-package", "root-build", "root-package"]
+
+        # Without dependencies the steps of root and lib are not ordered.
+        # Building them in parallel would race.
+        for (skipDeps, jobs) in ((True, 1), (False, 1), (False, 4)):
+            self.build("root", "root/lib", force=True, skipDeps=skipDeps, jobs=jobs)
+            assert sorted(self.readLog()) == ["lib-package", "root-build",
+                                              "root-package"]
+            libPath = "work/lib/dist/1/workspace"
+            assert BobState().getInputHashes(libPath) == []
+            assert isinstance(BobState().getResultHash(libPath), bytes)
+
+            self.build("root")
+            assert self.readLog() == []
+
+class TestUploads(BuildTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.writeRecipe("root", """
+root: True
+depends: [lib, util]
+buildScript: |
+    true
+packageScript: |
+    echo root > name.txt
+""")
+        self.writeRecipe("lib", """
+packageScript: |
+    echo lib > name.txt
+""")
+        self.writeRecipe("util", """
+packageScript: |
+    echo util > name.txt
+""")
+
+    def makeUploader(self, archive, **kwargs):
+        builder = self.makeBuilder(**kwargs)
+        builder.setArchiveHandler(archive)
+        builder.setDownloadMode("no")
+        builder.setUploadMode(True)
+        return builder
+
+    def isLocked(self, name):
+        """Check if the package workspace is locked for other processes"""
+        fd = os.open(os.path.join("work", name, "dist", "1", "lock"), os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return False
+        except BlockingIOError:
+            return True
+        finally:
+            os.close(fd)
+
+    def testDrain(self):
+        """The build does not wait for uploads but finishUploads() does"""
+        archive = FakeArchive()
+        archive.gate.clear()
+        builder = self.makeUploader(archive)
+        self.cook(builder, "root")
+        assert archive.uploaded == []
+        archive.gate.set()
+        builder.finishUploads()
+        assert sorted(archive.uploaded) == ["lib", "root", "util"]
+
+    def testLocked(self):
+        """Workspaces stay locked until they were uploaded"""
+        archive = FakeArchive()
+        archive.gate.clear()
+        builder = self.makeUploader(archive)
+        self.cook(builder, "root")
+        assert all(self.isLocked(n) for n in ["lib", "root", "util"])
+        archive.gate.set()
+        builder.finishUploads()
+        assert not any(self.isLocked(n) for n in ["lib", "root", "util"])
+
+    def testLockClosed(self):
+        """The lock of an upload is closed when it is done or dropped"""
+        archive = FakeArchive()
+        archive.gate.clear()
+        for name in ["a", "b"]:
+            os.makedirs(name)
+            self.write(os.path.join(name, "name.txt"), name)
+        def isOpen(fd):
+            try:
+                os.fstat(fd)
+                return True
+            except OSError:
+                return False
+        locks = [ os.open(os.devnull, os.O_RDONLY) for i in range(3) ]
+        uploads = UploadQueue(archive, 1, 2)
+        assert uploads.put(b'a', "a", lock=locks[0])
+        archive.started.acquire()
+        assert uploads.put(b'a', "a", lock=locks[1])
+        assert not isOpen(locks[1])
+        assert uploads.put(b'b', "b", lock=locks[2])
+        assert isOpen(locks[0]) and isOpen(locks[2])
+        timer = threading.Timer(0.2, archive.gate.set)
+        timer.start()
+        assert uploads.close(True) == []
+        timer.join()
+        assert not isOpen(locks[0]) and not isOpen(locks[2])
+        assert archive.uploaded == ["a"]
+
+    def testFailed(self):
+        """A failed upload fails the build"""
+        archive = FakeArchive({"lib"})
+        builder = self.makeUploader(archive)
+        self.cook(builder, "root")
+        self.assertRaises(BuildError, builder.finishUploads)
+        assert sorted(archive.uploaded) == ["root", "util"]
+
+    def testFailedCancel(self):
+        """Cancelling drops pending uploads and only warns about failures"""
+        archive = FakeArchive({"lib", "root", "util"})
+        archive.gate.clear()
+        builder = self.makeUploader(archive)
+        self.cook(builder, "root")
+        # Two workers are busy and the third upload is still queued.
+        archive.started.acquire()
+        archive.started.acquire()
+        timer = threading.Timer(0.5, archive.gate.set)
+        timer.start()
+        with patch("sys.stdout", new=StringIO()) as out:
+            builder.finishUploads(True)
+        timer.join()
+        assert out.getvalue().count("WARNING: upload failed") == 2
+        assert archive.uploaded == []
+        assert not archive.started.acquire(False)
+        assert not any(self.isLocked(n) for n in ["lib", "root", "util"])
+
+    def testQueueFull(self):
+        """Packages wait for a free upload slot if the queue is full"""
+        archive = FakeArchive()
+        archive.gate.clear()
+        timer = threading.Timer(0.5, archive.gate.set)
+        timer.start()
+        for jobs in (1, 2):
+            with patch("bob.cmds.build.UploadQueue",
+                       lambda archive, jobs: UploadQueue(archive, 1, 1)):
+                builder = self.makeUploader(archive, force=True, jobs=jobs)
+                self.cook(builder, "root")
+            builder.finishUploads()
+            assert sorted(archive.uploaded) == ["lib", "root", "util"]
+            archive.uploaded = []
+        timer.join()
+
+    def testBackPressure(self):
+        """Uploads exceeding the queue size are not taken without blocking"""
+        archive = FakeArchive()
+        archive.gate.clear()
+        for name in ["a", "b", "c"]:
+            os.makedirs(name)
+            self.write(os.path.join(name, "name.txt"), name)
+        uploads = UploadQueue(archive, 1, 1)
+        assert uploads.put(b'a', "a", False)
+        archive.started.acquire()
+        assert uploads.put(b'b', "b", False)
+        assert not uploads.put(b'c', "c", False)
+        assert uploads.put(b'b', "b", False)
+        archive.gate.set()
+        assert uploads.put(b'c', "c")
+        assert uploads.close() == []
+        assert archive.uploaded == ["a", "b", "c"]
+
+class TestDownloads(BuildTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.writeRecipe("root", """
+root: True
+depends: [a, b]
+buildScript: |
+    true
+packageScript: |
+    echo root >> {LOG}
+    echo root > name.txt
+""")
+        for name in ["a", "b"]:
+            self.writeRecipe(name, """
+depends: [lib]
+buildScript: |
+    true
+packageScript: |
+    echo NAME >> {LOG}
+    echo NAME > name.txt
+""".replace("NAME", name))
+        self.writeRecipe("lib", """
+packageScript: |
+    echo lib >> {LOG}
+    echo lib > name.txt
+""")
+
+        # Fill the archive and start again with an empty project
+        self.archive = FakeArchive()
+        builder = self.makeBuilder()
+        builder.setArchiveHandler(self.archive)
+        builder.setDownloadMode("no")
+        builder.setUploadMode(True)
+        self.cook(builder, "root")
+        builder.finishUploads()
+        assert sorted(self.archive.uploaded) == ["a", "b", "lib", "root"]
+        self.readLog()
+        self.clean()
+
+    def clean(self):
+        shutil.rmtree("work")
+        os.unlink(".bob-state.sqlite3")
+        _BobState.instance = None
+        self.archive.downloaded = []
+
+    def download(self, mode="yes", **kwargs):
+        builder = self.makeBuilder(**kwargs)
+        builder.setArchiveHandler(self.archive)
+        builder.setDownloadMode(mode)
+        return self.cook(builder, "root")
+
+    def testDownload(self):
+        """Only the root package is downloaded if it is in the archive"""
+        for jobs in (1, 4):
+            self.download(jobs=jobs)
+            assert self.readLog() == []
+            assert self.archive.downloaded == ["root"]
+            with open("work/root/dist/1/workspace/name.txt") as f:
+                assert f.read() == "root\n"
+            self.clean()
+
+    def testDeduplicate(self):
+        """A dependency of several packages is downloaded once"""
+        self.archive.remove("root", "a", "b")
+        for jobs in (1, 4):
+            self.download(jobs=jobs, downloadJobs=2)
+            assert sorted(self.readLog()) == ["a", "b", "root"]
+            assert sorted(self.archive.downloaded) == ["a", "b", "lib", "root"]
+            self.clean()
+
+    def testFallback(self):
+        """Packages that cannot be downloaded are built"""
+        self.archive.remove("root", "a", "lib")
+        for jobs in (1, 4):
+            self.download(jobs=jobs)
+            log = self.readLog()
+            assert sorted(log) == ["a", "lib", "root"]
+            assert log.index("lib") < log.index("a") < log.index("root")
+            assert sorted(self.archive.downloaded) == ["a", "b", "lib", "root"]
+            self.clean()
+
+    def testDownloadDeps(self):
+        """The root package is built if only dependencies are downloaded"""
+        self.download(mode="deps", jobs=4)
+        assert self.readLog() == ["root"]
+        assert sorted(self.archive.downloaded) == ["a", "b"]
+
+    def testSync(self):
+        """With -j1 the downloads are synchronous unless requested otherwise"""
+        pools = []
+        def scheduler(jobs, weight, admission, pool):
+            pools.append(pool)
+            return Scheduler(jobs, weight, admission, pool)
+        with patch("bob.cmds.build.Scheduler", scheduler):
+            self.download(jobs=1)
+            self.clean()
+            self.download(jobs=1, downloadJobs=3)
+        assert set(pools[0].values()) == {1}
+        assert pools[1]["download"] == 3
@@ -0,0 +1,71 @@
+# Bob build tool
+# Copyright (C) 2016  Jan Klötzke
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+import os
+
+from bob.errors import ParseError
+from bob.input import RecipeSet
+
+class TestResources(TestCase):
+
+    def setUp(self):
+        self.oldCwd = os.getcwd()
+        self.tmp = TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        os.makedirs("recipes")
+        os.makedirs("classes")
+
+    def tearDown(self):
+        os.chdir(self.oldCwd)
+        self.tmp.cleanup()
+
+    def write(self, name, content):
+        with open(name, "w") as f:
+            f.write(content)
+
+    def resources(self, recipe):
+        self.write("recipes/root.yaml", "root: True\n" + recipe)
+        recipes = RecipeSet()
+        recipes.parse()
+        return recipes.getRecipe("root").getResources()
+
+    def testDefault(self):
+        """Missing hints default to one CPU and no memory"""
+        assert self.resources("") == { "cpu" : 1, "memory" : 0 }
+        assert self.resources("resources: { memory: 1K }\n") == \
+            { "cpu" : 1, "memory" : 1024 }
+
+    def testInherit(self):
+        """Only declared hints of classes are inherited"""
+        self.write("classes/a.yaml", "buildScript: 'true'\n")
+        self.write("classes/b.yaml", "resources: { cpu: 8, memory: 2G }\n")
+        self.write("classes/c.yaml", "resources: { cpu: 2 }\n")
+        assert self.resources("inherit: [b, a]\n") == \
+            { "cpu" : 8, "memory" : 2 << 30 }
+        assert self.resources("inherit: [b, c]\n") == \
+            { "cpu" : 2, "memory" : 2 << 30 }
+        assert self.resources("inherit: [b, c]\nresources: { memory: 1M }\n") == \
+            { "cpu" : 2, "memory" : 1 << 20 }
+
+    def testInvalid(self):
+        """Invalid hints are rejected while parsing"""
+        self.assertRaises(ParseError, self.resources, "resources: { disk: 1 }\n")
+        self.assertRaises(ParseError, self.resources, "resources: { cpu: 0 }\n")
+        self.assertRaises(ParseError, self.resources, "resources: { memory: lots }\n")
+        self.write("classes/bad.yaml", "resources: { cpu: many }\n")
+        self.assertRaises(ParseError, self.resources, "inherit: [bad]\n")
@@ -0,0 +1,277 @@
+# Bob build tool
+# Copyright (C) 2016  Jan Klötzke
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from unittest import TestCase
+from unittest.mock import patch
+import os
+import threading
+import time
+
+from bob.errors import BuildError
+from bob.scheduler import Call, JobServer, Resources, Scheduler, Spawn, Wait
+
+class Graph:
+    """Simple task graph where each node waits for its deps and then runs."""
+
+    def __init__(self, graph, delay=0.0, pools={}):
+        self.graph = graph
+        self.delay = delay
+        self.pools = pools
+        self.order = []
+        self.started = []
+        self.lock = threading.Lock()
+        self.running = 0
+        self.maxRunning = 0
+
+    def task(self, name):
+        return (name, lambda: self.cook(name))
+
+    def cook(self, name):
+        yield Wait([ self.task(d) for d in self.graph.get(name, []) ])
+        return (yield Call(self.run, name, pool=self.pools.get(name)))
+
+    def run(self, name):
+        with self.lock:
+            self.started.append(name)
+            self.running += 1
+            self.maxRunning = max(self.maxRunning, self.running)
+        time.sleep(self.delay)
+        with self.lock:
+            self.running -= 1
+            self.order.append(name)
+        if name == "fail":
+            raise BuildError("failed")
+        return name.upper()
+
+class TestScheduler(TestCase):
+
+    def testSequentialDepthFirst(self):
+        """A single job processes the tasks depth first"""
+        g = Graph({ "root" : ["a", "b"], "a" : ["a1", "a2"], "b" : ["b1"] })
+        assert Scheduler(1).run([g.task("root")]) == ["ROOT"]
+        assert g.order == ["a1", "a2", "a", "b1", "b", "root"]
+
+    def testRunOnce(self):
+        """Shared dependencies are only run once"""
+        g = Graph({ "root" : ["a", "b"], "a" : ["c"], "b" : ["c"] })
+        assert Scheduler(4).run([g.task("root"), g.task("c")]) == ["ROOT", "C"]
+        assert sorted(g.order) == ["a", "b", "c", "root"]
+        assert g.order.index("c") < g.order.index("a")
+        assert g.order.index("c") < g.order.index("b")
+        assert g.order[-1] == "root"
+
+    def testParallel(self):
+        """Independent tasks run in parallel up to the job limit"""
+        g = Graph({ "root" : ["a", "b", "c", "d", "e", "f"] }, 0.05)
+        Scheduler(3).run([g.task("root")])
+        assert g.maxRunning == 3
+        assert g.order[-1] == "root"
+
+    def testCriticalPathFirst(self):
+        """The longest remaining path is started first"""
+        g = Graph({ "root" : ["a", "b", "c", "d"], "d" : ["e"] }, 0.05)
+        weights = { "c" : 10, "e" : 5 }
+        Scheduler(2, lambda k: weights.get(k, 1)).run([g.task("root")])
+        assert set(g.started[0:2]) == set(["c", "e"])
+        assert g.order[-1] == "root"
+
+    def testPools(self):
+        """Calls of a pool have their own job limit"""
+        g = Graph({ "root" : ["a", "b", "c", "x", "y"] }, 0.05,
+                  { "a" : "io", "b" : "io", "c" : "io" })
+        Scheduler(2, pools={ "io" : 3 }).run([g.task("root")])
+        assert g.maxRunning == 5
+        assert g.order[-1] == "root"
+
+        g = Graph({ "root" : ["a", "b", "c", "x", "y"] }, 0.05,
+                  { "a" : "io", "b" : "io", "c" : "io" })
+        Scheduler(1, pools={ "io" : 2 }).run([g.task("root")])
+        assert g.maxRunning == 3
+
+    def testSpawn(self):
+        """Spawned tasks run in the background and can be waited for later"""
+        g = Graph({}, 0.05)
+        log = []
+
+        def producer():
+            yield Spawn([ ("hash", lambda: g.cook("hash")) ])
+            log.append("produced")
+            return "P"
+
+        def consumer():
+            yield Wait([ ("producer", producer) ])
+            log.append("consume")
+            yield Wait([ ("hash", lambda: g.cook("never")) ])
+            log.append("hashed" if "hash" in g.order else "not hashed")
+            return "C"
+
+        def sibling():
+            yield Wait([ ("producer", producer) ])
+            return (yield Call(g.run, "sibling"))
+
+        assert Scheduler(2).run([ ("consumer", consumer), ("sibling", sibling) ]) \
+            == ["C", "SIBLING"]
+        assert log == ["produced", "consume", "hashed"]
+        assert set(g.started) == set(["hash", "sibling"])
+        assert g.maxRunning == 2
+
+        # nobody waits for the spawned task
+        g = Graph({})
+        def lonely():
+            yield Spawn([ ("bg", lambda: g.cook("bg")) ])
+            return "L"
+        assert Scheduler(1).run([ ("lonely", lonely) ]) == ["L"]
+        assert g.order == ["bg"]
+
+    def testError(self):
+        """The first error is raised and no further tasks are started"""
+        g = Graph({ "root" : ["fail", "a"], "a" : ["b"] })
+        self.assertRaises(BuildError, Scheduler(1).run, [g.task("root")])
+        assert g.order == ["fail"]
+
+        g = Graph({ "root" : ["fail", "a"] }, 0.05)
+        self.assertRaises(BuildError, Scheduler(2).run, [g.task("root")])
+        assert "root" not in g.order
+
+    def testNoResumeAfterError(self):
+        """Tasks that wait for others are not resumed after an error"""
+        g = Graph({}, 0.1)
+        log = []
+
+        def waiter():
+            try:
+                yield Wait([ g.task("slow") ])
+                log.append("resumed")
+                return (yield Call(g.run, "waiter"))
+            finally:
+                log.append("closed")
+
+        def raiseError():
+            raise BuildError("failed")
+
+        def fail():
+            return (yield Call(raiseError))
+
+        self.assertRaises(BuildError, Scheduler(2).run,
+                          [ ("waiter", waiter), ("fail", fail) ])
+        # The running call was waited for but its waiter was not resumed.
+        assert g.order == ["slow"]
+        assert log == ["closed"]
+
+class TestResources(TestCase):
+
+    def setUp(self):
+        self.meminfo = patch('bob.scheduler._memInfo',
+            return_value={ "MemTotal" : 16 << 30, "MemAvailable" : 8 << 30 })
+        self.meminfo.start()
+        self.loadavg = patch('os.getloadavg', return_value=(0.0, 0.0, 0.0))
+        self.loadavg.start()
+
+    def tearDown(self):
+        self.loadavg.stop()
+        self.meminfo.stop()
+
+    def testIdle(self):
+        """Anything is admitted if nothing is running"""
+        r = Resources(4)
+        assert r.admit(Call(None, cpu=64, memory=64 << 30), True)
+
+    def testCpu(self):
+        """CPUs are reserved and released"""
+        r = Resources(4)
+        big = Call(None, cpu=3)
+        small = Call(None)
+        assert r.admit(big, True)
+        assert r.admit(small, False)
+        assert not r.admit(small, False)
+        r.release(big)
+        assert r.admit(small, False)
+
+    def testLoad(self):
+        """Nothing is started if the load is too high"""
+        r = Resources(4)
+        assert r.admit(Call(None), True)
+        with patch('os.getloadavg', return_value=(3.5, 3.0, 2.0)):
+            assert not r.admit(Call(None), False)
+
+    def testNoCpu(self):
+        """Calls without CPU usage ignore the load"""
+        r = Resources(4)
+        assert r.admit(Call(None, cpu=4), True)
+        with patch('os.getloadavg', return_value=(8.0, 8.0, 8.0)):
+            assert r.admit(Call(None, cpu=0), False)
+
+    def testMemory(self):
+        """Memory must be available"""
+        r = Resources(16)
+        assert r.admit(Call(None, memory=4 << 30), True)
+        assert not r.admit(Call(None, memory=9 << 30), False)
+        assert r.admit(Call(None, memory=8 << 30), False)
+        assert not r.admit(Call(None, memory=5 << 30), False)
+
+    def testScheduler(self):
+        """Calls that do not fit are held back"""
+        g = Graph({ "root" : ["a", "b", "c"] }, 0.05)
+        Scheduler(3, admission=[Resources(1)]).run([g.task("root")])
+        assert g.maxRunning == 1
+
+class TestJobServer(TestCase):
+
+    def setUp(self):
+        self.js = JobServer(3)
+
+    def tearDown(self):
+        self.js.close()
+
+    def testTokens(self):
+        """The first call gets the implicit token, others take one from the pipe"""
+        calls = [ Call(None, jobToken=True) for i in range(4) ]
+        assert self.js.admit(calls[0], True)
+        assert self.js.admit(calls[1], False)
+        assert self.js.admit(calls[2], False)
+        assert not self.js.admit(calls[3], False)
+        self.js.release(calls[1])
+        assert self.js.admit(calls[3], False)
+        self.js.release(calls[0])
+        assert self.js.admit(Call(None, jobToken=True), False)
+
+    def testOtherCalls(self):
+        """Calls without job token are not limited"""
+        for i in range(5): assert self.js.admit(Call(None), False)
+
+    def testMakeProtocol(self):
+        """Tokens taken by child processes are returned to the pool"""
+        (r, w) = self.js.getFds()
+        assert "--jobserver-auth={},{}".format(r, w) in self.js.getMakeFlags()
+        assert r >= 10 and w >= 10
+        call = Call(None, jobToken=True)
+        assert self.js.admit(call, True)
+        token = os.read(r, 1)
+        assert self.js.admit(Call(None, jobToken=True), False)
+        assert not self.js.admit(Call(None, jobToken=True), False)
+        os.write(w, token)
+        assert self.js.admit(Call(None, jobToken=True), False)
+
+    def testScheduler(self):
+        """The job tokens limit the concurrently running calls"""
+        g = Graph({ "root" : ["a", "b", "c", "d"] }, 0.05)
+        def cook(name):
+            yield Wait([ g.task(d) for d in g.graph.get(name, []) ])
+            return (yield Call(g.run, name, jobToken=True))
+        g.cook = cook
+        Scheduler(4, admission=[self.js]).run([g.task("root")])
+        assert g.maxRunning == 3
+        assert g.order[-1] == "root"
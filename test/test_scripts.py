@@ -0,0 +1,133 @@
+# Bob build tool
+# Copyright (C) 2016  Jan Klötzke
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+import hashlib
+import os
+
+from bob.scripts import hashEngine, hashTree
+from bob.utils import asHexStr, hashDirectory
+
+# Digests of the fixture as calculated by the sequential implementation
+SPEC = "{sha1\n=0102ab\n<f\n{md5\n#d1\n=ff\n#d2\n}\n#d1\n}\n"
+SPEC_DIGEST = "1e3a6b4e39b308b9647807db5cf02a1322605cbd"
+D1_DIGEST = "a02807f23450f8a0796788d78566b78d083386f6"
+D2_DIGEST = "916a87b0f9056971b338d5195408909e9e3fd1b4"
+
+class TestHashScripts(TestCase):
+
+    def setUp(self):
+        self.oldCwd = os.getcwd()
+        self.tmp = TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        os.makedirs("d1/sub")
+        os.makedirs("d2")
+        self.write("d1/a", b'hello\n')
+        self.write("d1/sub/b", b'world')
+        self.write("d2/c", b'x' * 100)
+        self.write("f", b'file content\n')
+        for d in ["d1", "d1/sub", "d2"]: os.chmod(d, 0o755)
+        os.symlink("a", "d1/lnk")
+        self.write("spec", SPEC.encode("ascii"))
+
+    def tearDown(self):
+        os.chdir(self.oldCwd)
+        self.tmp.cleanup()
+
+    def write(self, name, content):
+        with open(name, "wb") as f:
+            f.write(content)
+        os.chmod(name, 0o644)
+
+    def read(self, name):
+        with open(name, "rb") as f:
+            return f.read()
+
+    def engine(self, *args):
+        with patch("sys.argv", ["bob-hash-engine"] + list(args)):
+            return hashEngine()
+
+    def tree(self, *args):
+        with patch("sys.argv", ["bob-hash-tree"] + list(args)):
+            with patch("sys.stdout", new=StringIO()) as out:
+                ret = hashTree()
+        return (ret, out.getvalue())
+
+    def testEngineBaseline(self):
+        """Nested specs give the same result as before"""
+        assert self.engine("-o", "out", "spec") == 0
+        assert asHexStr(self.read("out")) == SPEC_DIGEST
+        assert self.engine("-j", "1", "-o", "out", "spec") == 0
+        assert asHexStr(self.read("out")) == SPEC_DIGEST
+
+    def testEngineState(self):
+        """State caches do not change the result"""
+        os.makedirs("state")
+        for i in range(2):
+            assert self.engine("--state", "state", "-o", "out", "spec") == 0
+            assert asHexStr(self.read("out")) == SPEC_DIGEST
+        assert sorted(os.listdir("state")) == ["d1", "d2"]
+
+    def testEngineError(self):
+        """The output file is deleted on errors"""
+        self.write("bad", b"{sha1\n#d1\n<missing\n}\n")
+        assert self.engine("-o", "out", "bad") == 1
+        assert not os.path.exists("out")
+
+    def testEngineAlgorithm(self):
+        """Directories are hashed with the given algorithm"""
+        self.write("md5", b"{sha1\n#d1\n}\n")
+        assert self.engine("-a", "md5", "-o", "out", "md5") == 0
+        assert self.read("out") == hashlib.sha1(
+            hashDirectory("d1", algorithm="md5")).digest()
+        self.assertRaises(SystemExit, self.engine, "-a", "nope", "md5")
+
+    def testEngineJobs(self):
+        """The number of jobs is shared between the directories"""
+        executors = []
+        workers = []
+        def executor(jobs):
+            executors.append(jobs)
+            return ThreadPoolExecutor(jobs)
+        def hashDir(path, state, jobs, algorithm):
+            workers.append(jobs)
+            return hashDirectory(path, state, jobs, algorithm)
+        with patch("bob.scripts.ThreadPoolExecutor", executor), \
+             patch("bob.scripts.hashDirectory", hashDir):
+            assert self.engine("-j", "4", "-o", "out", "spec") == 0
+        assert asHexStr(self.read("out")) == SPEC_DIGEST
+        assert executors == [4]
+        assert workers == [2, 2]
+
+    def testTree(self):
+        (ret, out) = self.tree("d1")
+        assert ret == 0
+        assert out == D1_DIGEST + "\n"
+
+        (ret, out) = self.tree("-j", "2", "-s", "state", "d1", "d2")
+        assert ret == 0
+        assert out == "{} d1\n{} d2\n".format(D1_DIGEST, D2_DIGEST)
+        assert sorted(os.listdir("state")) == ["d1", "d2"]
+
+    def testTreeAlgorithm(self):
+        (ret, out) = self.tree("-a", "md5", "d1")
+        assert ret == 0
+        assert out == asHexStr(hashDirectory("d1", algorithm="md5")) + "\n"
+        assert len(out.strip()) == 32
@@ -0,0 +1,230 @@
+# Bob build tool
+# Copyright (C) 2016  Jan Klötzke
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from tempfile import TemporaryDirectory
+from threading import Thread
+from unittest import TestCase
+from unittest.mock import patch
+import os
+import pickle
+import sqlite3
+
+from bob.errors import ParseError
+from bob.state import BobState, _BobState
+
+class TestState(TestCase):
+
+    def setUp(self):
+        self.oldCwd = os.getcwd()
+        self.tmp = TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        _BobState.instance = None
+
+    def tearDown(self):
+        _BobState.instance = None
+        os.chdir(self.oldCwd)
+        self.tmp.cleanup()
+
+    def reopen(self):
+        _BobState.instance = None
+        return BobState()
+
+    def testPersistence(self):
+        """Every update is persisted immediately"""
+        s = BobState()
+        assert s.getByNameDirectory("work/a", b'\x01', True) == "work/a/1"
+        assert s.getByNameDirectory("work/a", b'\x02', True) == "work/a/2"
+        s.setResultHash("work/a/1", b'result')
+        s.setInputHashes("work/a/1", [b'in'])
+        s.setDirectoryState("work/a/1", { None : b'\x01', "src" : b'\x03' })
+        s.setStepDuration(b'\x01', 1.5)
+        s.setResultHash("work/a/2", b'gone')
+        s.delResultHash("work/a/2")
+
+        s = self.reopen()
+        assert s.getByNameDirectory("work/a", b'\x02', True) == "work/a/2"
+        assert s.getByNameDirectory("work/a", b'\x03', False) == "work/a/3"
+        assert s.getAllNameDirectores() == set(["work/a/1", "work/a/2"])
+        assert s.getResultHash("work/a/1") == b'result'
+        assert s.getResultHash("work/a/2") is None
+        assert s.getInputHashes("work/a/1") == [b'in']
+        assert s.getDirectoryState("work/a/1") == { None : b'\x01', "src" : b'\x03' }
+        assert s.getStepDuration(b'\x01') == 1.5
+
+    def testAsynchronous(self):
+        """Asynchronous updates are committed in one go"""
+        s = BobState()
+        s.setAsynchronous()
+        s.setResultHash("a", b'a')
+        s.setResultHash("b", b'b')
+        s.setSynchronous()
+        s = self.reopen()
+        assert s.getResultHash("a") == b'a'
+        assert s.getResultHash("b") == b'b'
+
+    def testConcurrent(self):
+        """Concurrent processes see each others updates"""
+        s1 = _BobState()
+        s2 = _BobState()
+        assert s1.getByNameDirectory("work/a", b'\x01', True) == "work/a/1"
+        assert s2.getByNameDirectory("work/a", b'\x02', True) == "work/a/2"
+        assert s1.getByNameDirectory("work/a", b'\x03', True) == "work/a/3"
+        assert s2.getByNameDirectory("work/a", b'\x01', True) == "work/a/1"
+
+        s1.setResultHash("work/a/1", b'1')
+        assert s2.getResultHash("work/a/1") == b'1'
+        s2.setResultHash("work/a/2", b'2')
+        assert s1.getResultHash("work/a/2") == b'2'
+        assert s1.getResultHash("work/a/1") == b'1'
+
+    def testThreads(self):
+        """The state may be used from worker threads"""
+        s = BobState()
+        s.setResultHash("main", b'main')
+        errors = []
+        def worker(i):
+            try:
+                assert s.getResultHash("main") == b'main'
+                s.getByNameDirectory("work/t", bytes([i]), True)
+                s.setResultHash("work/t/" + str(i), bytes([i]))
+            except Exception as e:
+                errors.append(e)
+        threads = [ Thread(target=worker, args=(i,)) for i in range(8) ]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        assert errors == []
+
+        s = self.reopen()
+        assert len(s.getAllNameDirectores()) == 8
+        for i in range(8):
+            assert s.getResultHash("work/t/" + str(i)) == bytes([i])
+
+    def testNoDataVersion(self):
+        """Without data version of SQLite all sections are reloaded"""
+        class Connection(sqlite3.Connection):
+            def execute(self, sql, *args):
+                if sql == "PRAGMA data_version": sql = "SELECT 1 WHERE 0"
+                return super().execute(sql, *args)
+        connect = sqlite3.connect
+        with patch("bob.state.sqlite3.connect",
+                   lambda *args, **kwargs: connect(*args, factory=Connection, **kwargs)):
+            s1 = _BobState()
+            s2 = _BobState()
+            s1.setResultHash("a", b'1')
+            assert s2.getResultHash("a") == b'1'
+            s1.setResultHash("a", b'2')
+            assert s2.getResultHash("a") == b'2'
+
+    def testCollectGarbage(self):
+        """Stale entries are dropped"""
+        s = BobState()
+        s.getByNameDirectory("work/a", "01", True)
+        s.getByNameDirectory("work/a", "02", True)
+        for d in ["work/a/1", "work/a/2"]:
+            s.setResultHash(d + "/workspace", b'result')
+            s.setInputHashes(d + "/workspace", [])
+            s.setDirectoryState(d + "/workspace", b'digest')
+        with patch("bob.state.time.time", return_value=1000.0):
+            s.setStepDuration(b'\x01', 1.0)
+        with patch("bob.state.time.time", return_value=100.0):
+            s.setStepDuration(b'\x02', 1.0)
+
+        keepPath = lambda p: p.startswith("work/a/1")
+        with patch("bob.state.time.time", return_value=1500.0):
+            stale = s.collectGarbage(keepPath, 1000, True)
+        assert stale == { "byNameDirs" : 1, "results" : 1, "inputs" : 1,
+                          "dirStates" : 1, "durations" : 1 }
+        assert s.getResultHash("work/a/2/workspace") == b'result'
+
+        with patch("bob.state.time.time", return_value=1500.0):
+            assert s.collectGarbage(keepPath, 1000) == stale
+        s.compact()
+        s = self.reopen()
+        assert s.getAllNameDirectores() == set(["work/a/1"])
+        assert s.getByNameDirectory("work/a", "03", False) == "work/a/3"
+        assert s.getResultHash("work/a/1/workspace") == b'result'
+        assert s.getResultHash("work/a/2/workspace") is None
+        assert s.getInputHashes("work/a/2/workspace") is None
+        assert s.getDirectoryState("work/a/2/workspace") is None
+        assert s.getStepDuration(b'\x01') == 1.0
+        assert s.getStepDuration(b'\x02') is None
+
+    def testCollectOldDurations(self):
+        """Durations without time of use start to age at the next collection"""
+        s = BobState()
+        s.setStepDuration(b'\x01', 1.0)
+        s._BobState__put("durations", b'\x02', 2.0)
+        assert sorted(s.getAllStepDurations()) == [1.0, 2.0]
+        assert s.getStepDuration(b'\x02') == 2.0
+
+        with patch("bob.state.time.time", return_value=1e12):
+            assert s.collectGarbage(lambda p: True, 10)["durations"] == 1
+        assert s.getStepDuration(b'\x01') is None
+        assert s.getStepDuration(b'\x02') == 2.0
+        with patch("bob.state.time.time", return_value=1e12 + 20):
+            assert s.collectGarbage(lambda p: True, 10)["durations"] == 1
+        assert s.getStepDuration(b'\x02') is None
+
+    def testJenkins(self):
+        s = BobState()
+        s.addJenkins("ci", { "url" : "http://ci/" })
+        s.addJenkinsJob("ci", "job", { "a" : 1 })
+        s.addJenkinsJob("ci", "other", { "b" : 2 })
+        s.delJenkinsJob("ci", "other")
+        assert s.getJenkinsByNameDirectory("ci", "work/a", b'\x01') == "work/a/1"
+
+        s = self.reopen()
+        assert list(s.getAllJenkins()) == ["ci"]
+        assert s.getJenkinsConfig("ci") == { "url" : "http://ci/" }
+        assert s.getJenkinsAllJobs("ci") == set(["job"])
+        assert s.getJenkinsJobConfig("ci", "job") == { "a" : 1 }
+        assert s.getJenkinsByNameDirectory("ci", "work/a", b'\x01') == "work/a/1"
+        s.delJenkins("ci")
+
+        s = self.reopen()
+        assert list(s.getAllJenkins()) == []
+
+    def testMigration(self):
+        """The old pickle is migrated once and then locked for older versions"""
+        with open(".bob-state.pickle", "wb") as f:
+            pickle.dump({
+                "version" : 2,
+                "byNameDirs" : { "work/a" : 1, b'\x01' : "work/a/1" },
+                "results" : { "work/a/1" : b'result' },
+                "inputs" : { "work/a/1" : [b'in'] },
+                "jenkins" : { "ci" : { "config" : {}, "jobs" : { "job" : 1 } } },
+                "dirStates" : { "work/a/1" : b'\x01' },
+                "buildState" : { b'\x01' : "work/a/1" },
+            }, f)
+
+        s = BobState()
+        assert s.getByNameDirectory("work/a", b'\x01', True) == "work/a/1"
+        assert s.getResultHash("work/a/1") == b'result'
+        assert s.getInputHashes("work/a/1") == [b'in']
+        assert s.getJenkinsJobConfig("ci", "job") == 1
+        assert s.getDirectoryState("work/a/1") == b'\x01'
+        assert s.getBuildState() == { b'\x01' : "work/a/1" }
+        with open(".bob-state.pickle", "rb") as f:
+            assert pickle.load(f)["version"] > 2
+
+        s.setResultHash("work/a/1", b'new')
+        s = self.reopen()
+        assert s.getResultHash("work/a/1") == b'new'
+
+    def testTooNew(self):
+        with open(".bob-state.pickle", "wb") as f:
+            pickle.dump({ "version" : _BobState.CUR_VERSION + 1 }, f)
+        self.assertRaises(ParseError, BobState)
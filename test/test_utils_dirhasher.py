@@ -15,12 +15,15 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from tempfile import NamedTemporaryFile, TemporaryDirectory
-from unittest import TestCase
+from unittest import TestCase, skipUnless
 from unittest.mock import MagicMock, mock_open, patch
 import binascii
+import hashlib
+import shutil
+import subprocess
 
 import os
-from bob.utils import hashFile, hashDirectory
+from bob.utils import hashFile, hashDirectory, GitObjectCache
 
 class TestHashFile(TestCase):
     def testBigFile(self):
@@ -29,9 +32,19 @@ class TestHashFile(TestCase):
                 f.write(b'0123456789' * 1024)
             f.flush()
 
-            hashFile(f.name) == binascii.unhexlify(
+            assert hashFile(f.name) == binascii.unhexlify(
                 "c94d8ee379dcbef70b3da8fb57df8020b76b0c70")
 
+    def testFileSizes(self):
+        """Files are hashed correctly regardless of the block size"""
+        for size in [0, 1, 65535, 65536, 65537, (1 << 20) + 1, (3 << 20) - 1]:
+            data = os.urandom(size)
+            with NamedTemporaryFile() as f:
+                f.write(data)
+                f.flush()
+                assert hashFile(f.name) == hashlib.sha1(data).digest()
+                assert hashFile(f.name, "sha256") == hashlib.sha256(data).digest()
+
     def testMissingFile(self):
         """Missing files should be treated as empty"""
         assert hashFile("does-not-exist") == binascii.unhexlify(
@@ -98,17 +111,240 @@ class TestHashDir(TestCase):
                 sum1 = hashDirectory(tmp, index.name)
 
                 with open(index.name, "rb") as f:
-                    assert f.read(4) == b'BOB1'
+                    assert f.read(4) == b'BOB3'
 
                 with open(os.path.join(tmp, "foo"), 'wb') as f:
                     f.write(b'qwer')
                 sum2 = hashDirectory(tmp, index.name)
 
                 with open(index.name, "rb") as f:
-                    assert f.read(4) == b'BOB1'
+                    assert f.read(4) == b'BOB3'
 
                 assert sum1 != sum2
 
+    def testParallel(self):
+        """Parallel hashing yields the same digest and index"""
+
+        with TemporaryDirectory() as tmp:
+            for d in ["a", "a/b", "c"]:
+                os.mkdir(os.path.join(tmp, d))
+                for i in range(20):
+                    with open(os.path.join(tmp, d, "f" + str(i)), 'wb') as f:
+                        f.write(os.urandom(i * 1000))
+            os.symlink("a/f1", os.path.join(tmp, "link"))
+
+            with NamedTemporaryFile() as index1, NamedTemporaryFile() as index2:
+                sum1 = hashDirectory(tmp, index1.name)
+                sum2 = hashDirectory(tmp, index2.name, 4)
+                assert sum1 == sum2
+                with open(index1.name, "rb") as f1, open(index2.name, "rb") as f2:
+                    assert f1.read() == f2.read()
+
+                # partially changed
+                with open(os.path.join(tmp, "a", "f3"), 'wb') as f:
+                    f.write(b'changed')
+                sum1 = hashDirectory(tmp, index1.name)
+                sum2 = hashDirectory(tmp, index2.name, 4)
+                assert sum1 == sum2
+                assert sum1 == hashDirectory(tmp)
+                with open(index1.name, "rb") as f1, open(index2.name, "rb") as f2:
+                    assert f1.read() == f2.read()
+
+    def testHardlinks(self):
+        """Hard linked files are only hashed once"""
+
+        with TemporaryDirectory() as tmp:
+            os.mkdir(os.path.join(tmp, "dir"))
+            with open(os.path.join(tmp, "foo"), 'wb') as f:
+                f.write(b'abc')
+            os.link(os.path.join(tmp, "foo"), os.path.join(tmp, "dir", "bar"))
+            os.link(os.path.join(tmp, "foo"), os.path.join(tmp, "baz"))
+            with open(os.path.join(tmp, "other"), 'wb') as f:
+                f.write(b'abc')
+
+            with patch('bob.utils.hashFile', wraps=hashFile) as mock_hash:
+                sum1 = hashDirectory(tmp)
+                assert mock_hash.call_count == 2
+
+            os.unlink(os.path.join(tmp, "baz"))
+            with open(os.path.join(tmp, "baz"), 'wb') as f:
+                f.write(b'abc')
+            sum2 = hashDirectory(tmp)
+            assert sum1 == sum2
+
+    def testDirCache(self):
+        """Unchanged directories are not hashed again"""
+
+        with TemporaryDirectory() as tmp:
+            for d in ["a", "a/b", "c"]:
+                os.mkdir(os.path.join(tmp, d))
+                for i in range(3):
+                    with open(os.path.join(tmp, d, "f" + str(i)), 'wb') as f:
+                        f.write(b'abc' * i)
+
+            with NamedTemporaryFile() as index:
+                sum1 = hashDirectory(tmp, index.name)
+                with patch('bob.utils.hashFile', wraps=hashFile) as mock_hash:
+                    assert hashDirectory(tmp, index.name) == sum1
+                    assert mock_hash.call_count == 0
+                with open(index.name, "rb") as f:
+                    index1 = f.read()
+
+                # Only the changed file is hashed. The index stays valid.
+                with open(os.path.join(tmp, "a", "b", "f1"), 'wb') as f:
+                    f.write(b'changed')
+                with patch('bob.utils.hashFile', wraps=hashFile) as mock_hash:
+                    sum2 = hashDirectory(tmp, index.name)
+                    assert mock_hash.call_count == 1
+                assert sum2 == hashDirectory(tmp)
+                with open(index.name, "rb") as f:
+                    assert len(f.read()) == len(index1)
+
+                os.rename(os.path.join(tmp, "a", "b"), os.path.join(tmp, "c", "b"))
+                assert hashDirectory(tmp, index.name) == hashDirectory(tmp)
+                assert hashDirectory(tmp, index.name, 4) == hashDirectory(tmp)
+
+    def testIndexUpdate(self):
+        """The index is updated in place and compacted only if necessary"""
+
+        with TemporaryDirectory() as tmp:
+            for i in range(20):
+                with open(os.path.join(tmp, "f" + str(i)), 'wb') as f:
+                    f.write(b'abc' * i)
+
+            with NamedTemporaryFile() as index:
+                sum1 = hashDirectory(tmp, index.name)
+                with open(index.name, "rb") as f:
+                    index1 = f.read()
+
+                # New entries are appended
+                with open(os.path.join(tmp, "new"), 'wb') as f:
+                    f.write(b'new')
+                assert hashDirectory(tmp, index.name) == hashDirectory(tmp)
+                with open(index.name, "rb") as f:
+                    index2 = f.read()
+                assert len(index2) > len(index1)
+                # only the record of the root directory was updated in place
+                assert index2[:len(index1)-42] == index1[:-42]
+                with patch('bob.utils.hashFile', wraps=hashFile) as mock_hash:
+                    hashDirectory(tmp, index.name)
+                    assert mock_hash.call_count == 0
+
+                # Stale entries are dropped eventually
+                for i in range(10):
+                    os.unlink(os.path.join(tmp, "f" + str(i)))
+                assert hashDirectory(tmp, index.name) == hashDirectory(tmp)
+                with open(index.name, "rb") as f:
+                    assert len(f.read()) < len(index1)
+
+                # A dirty index is ignored
+                with open(index.name, "r+b") as f:
+                    f.seek(4)
+                    f.write(b'\x01')
+                with patch('bob.utils.hashFile', wraps=hashFile) as mock_hash:
+                    sum2 = hashDirectory(tmp, index.name)
+                    assert mock_hash.call_count == 11
+                assert sum2 == hashDirectory(tmp)
+
+    def testAlgorithm(self):
+        """The hash algorithm is configurable and recorded in the index"""
+
+        with TemporaryDirectory() as tmp:
+            os.mkdir(os.path.join(tmp, "dir"))
+            with open(os.path.join(tmp, "dir", "foo"), 'wb') as f:
+                f.write(b'abc')
+
+            with NamedTemporaryFile() as index:
+                sum1 = hashDirectory(tmp, index.name)
+                with patch('bob.utils.hashFile', wraps=hashFile) as mock_hash:
+                    sum2 = hashDirectory(tmp, index.name, algorithm="sha256")
+                    assert mock_hash.call_count == 1
+                assert len(sum1) == 20
+                assert len(sum2) == 32
+                assert sum2 == hashDirectory(tmp, algorithm="sha256")
+                assert sum2 == hashDirectory(tmp, index.name, 4, "sha256")
+                assert sum1 == hashDirectory(tmp, index.name)
+
+    def testScope(self):
+        """Only files in the hash scope are hashed"""
+
+        def tree(root, files):
+            for (name, content) in files.items():
+                name = os.path.join(root, name)
+                os.makedirs(os.path.dirname(name), exist_ok=True)
+                with open(name, 'wb') as f:
+                    f.write(content)
+
+        with TemporaryDirectory() as full:
+            with TemporaryDirectory() as scoped:
+                tree(full, { "install/bin/app" : b'app', "lib.a" : b'lib' })
+                tree(scoped, { "install/bin/app" : b'app', "lib.a" : b'lib',
+                               "obj/a.o" : b'a', "obj/x.c" : b'x', "cache/x" : b'x' })
+                include = [ "install", "*.a" ]
+                exclude = [ "*.o", "obj/*.c", "cache" ]
+                assert hashDirectory(scoped, include=include) == \
+                    hashDirectory(full)
+                # the emptied directory is kept
+                os.mkdir(os.path.join(full, "obj"))
+                assert hashDirectory(scoped, exclude=exclude) == \
+                    hashDirectory(full)
+
+                # excluded files are not read
+                with NamedTemporaryFile() as index:
+                    with patch('bob.utils.hashFile', wraps=hashFile) as mock_hash:
+                        sum1 = hashDirectory(scoped, index.name, 1, "sha1",
+                                             exclude=exclude)
+                        assert mock_hash.call_count == 2
+                    assert sum1 == hashDirectory(full)
+
+                    # a changed scope is not taken from the index
+                    assert hashDirectory(scoped, index.name) == \
+                        hashDirectory(scoped)
+                    assert hashDirectory(scoped, index.name, exclude=exclude) == sum1
+
+    @skipUnless(shutil.which("git"), "requires git")
+    def testGitObjects(self):
+        """Unmodified files of git checkouts are not read again"""
+
+        def git(*args):
+            subprocess.check_call(["git", "-c", "user.name=bob",
+                "-c", "user.email=bob@localhost"] + list(args),
+                cwd=os.path.join(tmp, "ws", "git"), stdout=subprocess.DEVNULL)
+
+        with TemporaryDirectory() as tmp:
+            os.makedirs(os.path.join(tmp, "ws", "git", "sub"))
+            for name in ["a", "b", "sub/c"]:
+                with open(os.path.join(tmp, "ws", "git", name), 'wb') as f:
+                    f.write(name.encode("ascii"))
+            git("init", "-q")
+            git("add", ".")
+            git("commit", "-q", "-m", "init")
+            with open(os.path.join(tmp, "ws", "git", "a"), 'wb') as f:
+                f.write(b'modified')
+            with open(os.path.join(tmp, "ws", "git", "untracked"), 'wb') as f:
+                f.write(b'untracked')
+
+            cache = os.path.join(tmp, "objects.sqlite3")
+            objects = lambda: GitObjectCache(cache, os.path.join(tmp, "ws"), ["git"])
+            ws = os.path.join(tmp, "ws")
+            sum1 = hashDirectory(ws, None, 1, "sha1", None, objects())
+            assert sum1 == hashDirectory(ws)
+
+            # Only modified and untracked files are read again
+            with patch('bob.utils.hashFile', wraps=hashFile) as mock_hash:
+                assert hashDirectory(ws, None, 1, "sha1", None, objects()) == sum1
+                assert mock_hash.call_count == 2
+
+            # The restored file is a new object. All others are known.
+            git("checkout", "-q", "-f")
+            with patch('bob.utils.hashFile', wraps=hashFile) as mock_hash:
+                sum2 = hashDirectory(ws, None, 2, "sha1", None, objects())
+                assert mock_hash.call_count == 2
+            assert sum2 == hashDirectory(ws)
+            with patch('bob.utils.hashFile', wraps=hashFile) as mock_hash:
+                assert hashDirectory(ws, None, 1, "sha1", None, objects()) == sum2
+                assert mock_hash.call_count == 1
+
     def testBigIno(self):
         """Test that index handles big inode numbers as found on Windows"""
 
@@ -135,7 +371,7 @@ class TestHashDir(TestCase):
                     hashDirectory(tmp, index.name)
 
                 with open(index.name, "rb") as f:
-                    assert f.read(4) == b'BOB1'
+                    assert f.read(4) == b'BOB3'
 
     def testBlockDev(self):
         """Test that index handles block devices"""
@@ -0,0 +1,119 @@
+# Bob build tool
+# Copyright (C) 2016  Jan Klötzke
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from tempfile import TemporaryDirectory
+from threading import Thread
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
+import os
+import sys
+
+from bob.utils import hashDirectory
+from bob.watcher import Watcher, WATCH_DIR, getJournal
+
+@skipUnless(sys.platform.startswith("linux"), "requires inotify")
+class TestWatcher(TestCase):
+
+    def setUp(self):
+        self.oldCwd = os.getcwd()
+        self.tmp = TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        os.makedirs(WATCH_DIR)
+        os.makedirs("ws/a/b")
+        os.makedirs("ws/c")
+        self.write("ws/a/b/f", "f")
+        self.write("ws/c/g", "g")
+        self.idle = patch.object(Watcher, "IDLE_TIMEOUT", 1)
+        self.idle.start()
+        self.thread = Thread(target=Watcher().run)
+        self.thread.start()
+
+    def tearDown(self):
+        self.thread.join()
+        self.idle.stop()
+        os.chdir(self.oldCwd)
+        self.tmp.cleanup()
+
+    def write(self, name, content):
+        with open(name, "w") as f:
+            f.write(content)
+
+    def hash(self):
+        j = getJournal("ws")
+        assert j is not None
+        d = hashDirectory("ws", "index", 1, "sha1", j)
+        assert d == hashDirectory("ws")
+        j.commit()
+        return j
+
+    def testNoWatcher(self):
+        """Without watcher there is no journal"""
+        assert getJournal("other") is not None
+        with TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                assert getJournal("ws") is None
+            finally:
+                os.chdir(self.tmp.name)
+
+    def testChanges(self):
+        """Only changed directories and their parents are unclean"""
+        j = self.hash()
+        assert not j.isClean(b'')
+        j = self.hash()
+        assert j.isClean(b'')
+
+        self.write("ws/a/b/f", "changed")
+        j = self.hash()
+        assert not j.isClean(b'')
+        assert not j.isClean(b'a')
+        assert not j.isClean(b'a/b')
+        assert j.isClean(b'c')
+
+        os.rename("ws/a/b", "ws/c/b")
+        j = self.hash()
+        assert not j.isClean(b'a')
+        assert not j.isClean(b'c')
+
+        self.write("ws/c/b/f", "again")
+        j = self.hash()
+        assert not j.isClean(b'c/b')
+        assert j.isClean(b'a')
+
+        os.makedirs("ws/n/m")
+        self.write("ws/n/m/x", "x")
+        self.hash()
+        self.write("ws/n/m/x", "y")
+        j = self.hash()
+        assert not j.isClean(b'n/m')
+
+        os.chmod("ws/c", 0o700)
+        j = self.hash()
+        assert not j.isClean(b'c')
+        j = self.hash()
+        assert j.isClean(b'')
+
+    def testUnacknowledged(self):
+        """Changes are kept until the workspace was hashed successfully"""
+        self.hash()
+        self.write("ws/c/g", "changed")
+        j = getJournal("ws")
+        assert not j.isClean(b'c')
+        j = getJournal("ws")
+        assert not j.isClean(b'c')
+        j.commit()
+        j = getJournal("ws")
+        assert j.isClean(b'c')